@@ -1,7 +1,9 @@
 import argparse
-import copy
+from collections import namedtuple
+import itertools
 import json
 import logging
+import multiprocessing
 import numpy as np
 import os
 import random
@@ -45,11 +47,48 @@ parser.add_argument('--num-fl-sims', type=int, default=100,
                     help='number of fantasyland simulations to do')
 parser.add_argument('--oracle-outcome-weighting', type=float, default=1.0,
                     help='exponent for how outcomes are weighted for the oracle')
+parser.add_argument('--exact-streets', type=int, default=0,
+                    help='number of final streets (0/1/2) the oracle policies evaluate exactly by enumerating draws '
+                         'instead of sampling')
+parser.add_argument('--endgame', action='store_true',
+                    help='for the oracle policies, solve the last two decisions exactly with the endgame solver')
+parser.add_argument('--endgame-cache-file', type=str, default='',
+                    help='pickle file the endgame solver loads its table from and saves it to on exit')
+parser.add_argument('--common-draws', action='store_true',
+                    help='for the oracle policies, evaluate every action of a decision on the same sampled draws '
+                         'and report the variance saved')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes oracle_eval evaluates actions in (chosen actions do not depend on it)')
+parser.add_argument('--scheduler', type=str, default='halving', choices=['halving', 'race'],
+                    help='how vs_oracle_eval policies split sims between actions: successive halving, or a race that '
+                         'also drops actions once they trail the leader by --race-confidence standard errors')
+parser.add_argument('--race-confidence', type=float, default=2.,
+                    help='standard errors by which an action must trail the leader to be dropped from the race')
+parser.add_argument('--race-tolerance', type=float, default=0.,
+                    help='the race stops once no action can beat the leader by more than this many royalties')
+parser.add_argument('--race-sim-budget', type=int, default=0,
+                    help='max sims per decision for the race (0 for no limit)')
+parser.add_argument('--race-time-budget', type=float, default=0.,
+                    help='max seconds per decision for the race (0 for no limit)')
 parser.add_argument('--distinguish-draws', action='store_true',
                     help='for feature extraction, whether to consider every num_to_draw differently')
 parser.add_argument('--log-file', type=str, default='',
                     help='file to write all final states to')
+parser.add_argument('--int-cards', action='store_true',
+                    help='represent cards as ints from 0 to 51 instead of strings')
+parser.add_argument('--cache-size', type=int, default=hand_optimizer.DEFAULT_CACHE_SIZE,
+                    help='max entries in the hand optimizer cache (0 disables caching)')
+parser.add_argument('--seed', type=int, default=None,
+                    help='master seed; every game and fantasyland sim is seeded from it and its number, so results do '
+                         'not depend on --jobs')
+parser.add_argument('--duplicate', action='store_true',
+                    help='play every deal twice with seats swapped, and report the paired utility difference '
+                         '(evaluation only, --num-test counts deals)')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of processes to shard games and fantasyland sims across (evaluation only, needs '
+                         '--num-train 0)')
 args = parser.parse_args()
+hand_optimizer.set_cache_size(args.cache_size)
 
 policy_name_to_policy = {
   'human': policies.HumanPolicy,
@@ -71,8 +110,8 @@ def prompt_bool(prompt):
 
 start_time = time.time()
 
-player_game = PineappleGame2('player')
-opp_game = PineappleGame2('opponent')
+player_game = PineappleGame2('player', int_cards=args.int_cards)
+opp_game = PineappleGame2('opponent', int_cards=args.int_cards)
 
 player_utilities = []
 player_non_bust_utilities = [] # Essentially royalties
@@ -107,74 +146,130 @@ if args.log_file != '':
   logging.info("Player policy: {}".format(args.player_policy))
   logging.info("Opp policy: {}\n".format(args.opp_policy))
 
-for game_num in range(args.num_test + args.num_train):
-  # No exploration during testing
+if args.jobs > 1 or args.duplicate:
+  if args.num_train > 0 or policies.HumanPolicy in (type(player_policy), type(opp_policy)):
+    raise RuntimeError('--jobs and --duplicate only support evaluation of non human policies (--num-train 0)')
+  if args.jobs > 1 and args.workers > 1:
+    raise RuntimeError('--jobs and --workers cannot be combined')
+  # Both games of a duplicate pair deal from a deck seeded by the deal number
+  if args.seed is None:
+    args.seed = random.randrange(2 ** 31)
+    print "Seed: {}".format(args.seed)
+
+# Seeds the global RNG for the given game or fantasyland sim. Fantasyland sims are numbered after the
+# games, and duplicate decks from -1 down.
+def seed_task(task_num):
+  if args.seed is not None:
+    random.seed(args.seed * 1000003 + task_num)
+
+# Streams func over the task numbers in order, across args.jobs processes. Pools fork on creation,
+# so workers see the globals as they are at the time of the call.
+def map_tasks(func, task_nums):
+  if args.jobs <= 1:
+    return itertools.imap(func, task_nums), None
+  pool = multiprocessing.Pool(args.jobs)
+  return pool.imap(func, task_nums), pool
+
+# Shuts down a pool from map_tasks: lets the workers exit once the results are drained, or kills them
+# if the loop over the results was cut short
+def end_pool(pool, drained):
+  if pool is None:
+    return
+  if drained:
+    pool.close()
+  else:
+    pool.terminate()
+  pool.join()
+
+GameRecord = namedtuple('GameRecord', ['player_utility', 'player_royalties', 'player_bust', 'player_fantasyland',
+  'player_rows', 'opp_utility', 'opp_royalties', 'opp_bust', 'opp_fantasyland', 'opp_rows'])
+
+# In duplicate mode, game 2k plays deal k with the player in the first seat, and game 2k + 1 plays
+# it again with the seats swapped
+def play_game(game_num):
+  # No exploration during testing. Every game sets this, since shards may never see game num_train.
   if game_num == args.num_train:
     print "Training ended. Now testing:"
+  if game_num >= args.num_train:
     player_policy.train = False
     opp_policy.train = False
-    
-  try:
-    player_state, opp_state = player_game.get_start_state()
-
-    while not player_game.is_end(player_state):
-      def take_action(game, state, opp_state, policy):
-        # if args.verbose:
-        #   game.print_state(state)
-        action_state = copy.deepcopy(state)
-        action_state.remaining = state.fake_remaining
-        action = policy.get_action(action_state)
-        # if args.verbose:
-        #   print "Action:", action
-        new_state = game.get_outcome(state, action, opp_state)
-        if isinstance(policy, policies.RLPolicy):
-          policy.incorporate_feedback(state, action, new_state)
-        return new_state
-
-      player_state = take_action(player_game, player_state, opp_state, player_policy)
-      opp_state = take_action(opp_game, opp_state, player_state, opp_policy)
-
-    player_utility = player_game.utility(player_state)
-    player_royalties = player_game.royalties_for_hand(player_state)
-    opp_utility = opp_game.utility(opp_state)
-    opp_royalties = opp_game.royalties_for_hand(opp_state)
-
-    if player_utility != -opp_utility:
-      print "Incongrous player and opponent utilities!"
-      player_game.print_state(player_state)
-      print "Player utility:", player_utility
-      print "Opp utility:", opp_utility
-      raise Exception('Incongrous player and opponent utilities!')
-
-    player_utilities += [player_utility]
-    if player_game.is_fantasyland(player_state):
+  swapped = False
+  if args.duplicate:
+    seed_task(-1 - game_num / 2)
+    player_game.deck = opp_game.deck = g.Deck.shuffled(player_game.cards)
+    swapped = game_num % 2 == 1
+  seed_task(game_num)
+
+  # The first seat deals and acts first
+  seats = [(player_game, player_policy), (opp_game, opp_policy)]
+  if swapped:
+    seats.reverse()
+  first_state, second_state = player_game.get_start_state()
+  while not player_game.is_end(first_state):
+    def take_action(game, state, opp_state, policy):
+      # if args.verbose:
+      #   game.print_state(state)
+      action = policy.get_action(state.fake_view())
+      # if args.verbose:
+      #   print "Action:", action
+      new_state = game.get_outcome(state, action, opp_state)
+      if isinstance(policy, policies.RLPolicy):
+        policy.incorporate_feedback(state, action, new_state)
+      return new_state
+
+    first_state = take_action(seats[0][0], first_state, second_state, seats[0][1])
+    second_state = take_action(seats[1][0], second_state, first_state, seats[1][1])
+  player_state, opp_state = (second_state, first_state) if swapped else (first_state, second_state)
+
+  player_utility = player_game.utility(player_state)
+  opp_utility = opp_game.utility(opp_state)
+
+  if player_utility != -opp_utility:
+    print "Incongrous player and opponent utilities!"
+    player_game.print_state(player_state)
+    print "Player utility:", player_utility
+    print "Opp utility:", opp_utility
+    raise Exception('Incongrous player and opponent utilities!')
+
+  if args.verbose or type(player_policy) is policies.HumanPolicy or type(opp_policy) is policies.HumanPolicy:
+    print player_game.name, "\'s Final board:"
+    player_game.print_state(player_state)
+
+  return GameRecord(player_utility, player_game.royalties_for_hand(player_state), player_game.is_bust(player_state),
+    player_game.is_fantasyland(player_state), player_state.rows, opp_utility, opp_game.royalties_for_hand(opp_state),
+    opp_game.is_bust(opp_state), opp_game.is_fantasyland(opp_state), opp_state.rows)
+
+game_num = -1
+num_games = args.num_test * 2 if args.duplicate else args.num_test
+records, pool = map_tasks(play_game, xrange(num_games + args.num_train))
+drained = False
+try:
+  for game_num, record in enumerate(records):
+    player_utilities += [record.player_utility]
+    if record.player_fantasyland:
       player_fantasylands += 1
     if game_num >= args.num_train:
-      if player_game.is_bust(player_state):
+      if record.player_bust:
         player_busts += 1
-      player_non_bust_utilities += [player_royalties]
-      player_final_hands += [g.rows_to_hands(player_state.rows)]
+      player_non_bust_utilities += [record.player_royalties]
+      player_final_hands += [g.rows_to_hands(record.player_rows)]
 
-    opp_utilities += [opp_utility]
-    if opp_game.is_fantasyland(opp_state):
+    opp_utilities += [record.opp_utility]
+    if record.opp_fantasyland:
       opp_fantasylands += 1
     if game_num >= args.num_train:
-      if opp_game.is_bust(opp_state):
+      if record.opp_bust:
         opp_busts += 1
-      opp_non_bust_utilities += [opp_royalties]
-      opp_final_hands += [g.rows_to_hands(player_state.rows)]
-
-    if args.verbose or type(player_policy) is policies.HumanPolicy or type(opp_policy) is policies.HumanPolicy:
-      print player_game.name, "\'s Final board:"
-      player_game.print_state(player_state)
+      opp_non_bust_utilities += [record.opp_royalties]
+      opp_final_hands += [g.rows_to_hands(record.opp_rows)]
 
     if args.log_file != '':
       logging.info("Game: {}".format(game_num))
-      logging.info("Utility: {}".format(player_utility))
-      for row in player_state.rows:
-        logging.info("+ "+ ' '.join(row))
-      for row in player_state.opp_rows:
-        logging.info("- "+ ' '.join(row))
+      logging.info("Utility: {}".format(record.player_utility))
+      for row in record.player_rows:
+        logging.info("+ "+ ' '.join(g.cards_to_strs(row)))
+      for row in record.opp_rows:
+        logging.info("- "+ ' '.join(g.cards_to_strs(row)))
       logging.info("")
 
     if args.print_util_freq != -1:
@@ -184,14 +279,18 @@ for game_num in range(args.num_test + args.num_train):
         opp_avg_utility = sum(opp_utilities[start_game:]) / float(args.print_util_freq)
         print "Player games {:4} -{:4} average utility: {}".format(start_game, game_num, player_avg_utility)
     else:
-      print "Game {:4} / {:4}\r".format(game_num+1, args.num_test),
+      print "Game {:4} / {:4}\r".format(game_num+1, num_games),
 
     if type(player_policy) == policies.HumanPolicy or type(opp_policy) == policies.HumanPolicy:
       print "\n"
-  # keyboard interrupt breaks early
-  except KeyboardInterrupt as e:
-    game_num -= 1
-    break
+  drained = True
+# keyboard interrupt breaks early
+except KeyboardInterrupt as e:
+  pass
+finally:
+  end_pool(pool, drained)
+player_policy.close()
+opp_policy.close()
 
 print "\n"
 
@@ -201,34 +300,45 @@ print "\n"
 # Note: The current version overestimates the performance of players against fantasyland since their
 # hands were created with knowledge of opponent draws.
 fl_train_cutoff = len(player_final_hands) / 2
+
+# Returns (opp_fl_worth, opp_fl_utilities, player_fl_worth, player_fl_utilities) for one fantasyland draw
+def fl_sim(fl_sim_num):
+  seed_task(args.num_train + num_games + fl_sim_num)
+  draw = random.sample(player_game.cards, NUM_FANTASYLAND_DRAW)
+
+  # Optimize vs player
+  # TODO: make hand_optimizer return an actual set of rows making the best hand
+  opp_fl_worth, fl_combo = hand_optimizer.optimize_hand_adv([[], [], []], draw, player_final_hands[:fl_train_cutoff],
+    return_combo=True, fl_bonus=False)
+  fl_hands = hand_optimizer.combo_to_hand(fl_combo)
+  # TODO: remove code duplication with utility calculation
+  opp_fl_utilities = [g.adv_utility(fl_hands, player_hands) for player_hands in player_final_hands[fl_train_cutoff:]]
+
+  # Optimize vs opp
+  player_fl_worth, fl_combo = hand_optimizer.optimize_hand_adv([[], [], []], draw, opp_final_hands[:fl_train_cutoff],
+    return_combo=True, fl_bonus=False)
+  fl_hands = hand_optimizer.combo_to_hand(fl_combo)
+  player_fl_utilities = [g.adv_utility(fl_hands, opp_hands) for opp_hands in opp_final_hands[fl_train_cutoff:]]
+  return opp_fl_worth, opp_fl_utilities, player_fl_worth, player_fl_utilities
+
 opp_fl_utilities = []
 player_fl_utilities = []
 opp_fl_worths = []
 player_fl_worths = []
+results, pool = map_tasks(fl_sim, xrange(args.num_fl_sims))
+drained = False
 try:
-  for fl_sim_num in xrange(args.num_fl_sims):
+  for fl_sim_num, (opp_fl_worth, opp_utilities_vs_fl, player_fl_worth, player_utilities_vs_fl) in enumerate(results):
     print "Performing FL sim {:4} / {:4}\r".format(fl_sim_num + 1, args.num_fl_sims),
-    draw = random.sample(player_game.cards, NUM_FANTASYLAND_DRAW)
-
-    # Optimize vs player
-    # TODO: make hand_optimizer return an actual set of rows making the best hand
-    worth, fl_combo = hand_optimizer.optimize_hand_adv([[], [], []], draw, player_final_hands[:fl_train_cutoff],
-      return_combo=True, fl_bonus=False)
-    opp_fl_worths += [worth]
-    fl_hands = hand_optimizer.combo_to_hand(fl_combo)
-    # TODO: remove code duplication with utility calculation
-    for player_hands in player_final_hands[fl_train_cutoff:]:
-      opp_fl_utilities += [g.adv_utility(fl_hands, player_hands)]
-
-    # Optimize vs opp
-    worth, fl_combo = hand_optimizer.optimize_hand_adv([[], [], []], draw, opp_final_hands[:fl_train_cutoff],
-      return_combo=True, fl_bonus=False)
-    player_fl_worths += [worth]
-    fl_hands = hand_optimizer.combo_to_hand(fl_combo)
-    for opp_hands in opp_final_hands[fl_train_cutoff:]:
-      player_fl_utilities += [g.adv_utility(fl_hands, opp_hands)]
+    opp_fl_worths += [opp_fl_worth]
+    opp_fl_utilities += opp_utilities_vs_fl
+    player_fl_worths += [player_fl_worth]
+    player_fl_utilities += player_utilities_vs_fl
+  drained = True
 except KeyboardInterrupt:
   pass
+finally:
+  end_pool(pool, drained)
 
 opp_fl_utilities = np.array(opp_fl_utilities)
 player_fl_utilities = np.array(player_fl_utilities)
@@ -304,5 +414,29 @@ print_stats(player_game.name, player_utilities, player_non_bust_utilities, game_
 print_stats(opp_game.name, opp_utilities, opp_non_bust_utilities, game_num, opp_busts, opp_fantasylands,
   opp_fl_utilities, opp_fl_worths, player_fantasylands, player_fl_utilities)
 
+# Each deal's paired result is the player's utility averaged over both seats. The opponent's card
+# luck cancels out, so its spread is the policy difference plus the noise left after swapping.
+if args.duplicate:
+  num_deals = len(player_utilities) / 2
+  if num_deals > 0:
+    paired = np.array(player_utilities[:2 * num_deals]).reshape(num_deals, 2).mean(axis=1)
+    paired_ci = 1.96 * np.std(paired) / np.sqrt(num_deals)
+    unpaired_ci = 1.96 * np.std(player_utilities[:2 * num_deals]) / np.sqrt(2 * num_deals)
+    print "\nDuplicate: player utility {} +/- {} (95% CI) over {} deals, vs +/- {} unpaired".format(
+      np.mean(paired), paired_ci, num_deals, unpaired_ci)
+    if args.log_file != '':
+      logging.info("Duplicate: player utility {} +/- {} (95% CI) over {} deals, vs +/- {} unpaired".format(
+        np.mean(paired), paired_ci, num_deals, unpaired_ci))
+
 print "\nTook {} seconds.".format(time.time() - start_time)
+# Shards keep their own caches and reports
+if args.jobs <= 1:
+  print hand_optimizer.format_cache_stats()
+  for name, policy in (('Player', player_policy), ('Opponent', opp_policy)):
+    if policy.variance_report is not None:
+      print "{}: {}".format(name, policy.variance_report.format())
+    if getattr(policy, 'race', None) is not None:
+      print "{}: {}".format(name, policy.race.format())
+    if isinstance(policy, policies.QLearningPolicy) and policy.row_cache.hits + policy.row_cache.misses > 0:
+      print "{}: {}".format(name, policy.format_row_cache_stats())
 
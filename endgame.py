@@ -0,0 +1,166 @@
+import atexit
+import cPickle as pickle
+import itertools
+import numpy as np
+import os
+
+import game as g
+import suit_isomorphism
+
+'''
+Endgame solver
+
+Exact expectimax values for the last two streets of PineappleGame1, using the game's utility
+(royalties including the fantasyland bonus, or the bust penalty). Unlike the hand_optimizer oracle,
+which sees the whole future draw, each placement here is only made knowing the cards dealt so far.
+
+Chance nodes are boards with 9 or 11 cards placed and no draw in hand. The last chance node (11
+cards placed, two open slots) is solved in closed form: every ordered pair of remaining cards is
+scored once for the two slots, and every possible 3 card draw takes the best pair it contains. The
+node before it enumerates draws by suit relevance class and maximizes over actions.
+
+Chance node values are stored in a transposition table keyed by the suit-canonical board and dead
+cards, and can be persisted to a pickle file.
+'''
+
+def final_value(rows):
+  ranks = g.rows_to_ranks(rows)
+  if g.ranks_are_bust(ranks):
+    return g.BUST_PENALTY
+  return sum(g.royalties(g.RANK_TO_HAND[rank], row_num) for row_num, rank in enumerate(ranks))
+
+# Returns the index arrays (a, b, c) of every 3 card draw out of n cards, cached per n
+TRIPLE_INDICES = {}
+def triple_indices(n):
+  if n not in TRIPLE_INDICES:
+    triples = np.array(list(itertools.combinations(xrange(n), 3)), dtype=np.intp).reshape(-1, 3)
+    TRIPLE_INDICES[n] = (triples[:, 0], triples[:, 1], triples[:, 2])
+  return TRIPLE_INDICES[n]
+
+class EndgameSolver(object):
+  def __init__(self, cache_file=''):
+    self.table = {}
+    self.hits = 0
+    self.misses = 0
+    self.cache_file = cache_file
+    if cache_file != '':
+      if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as fp:
+          self.table = pickle.load(fp)
+      atexit.register(self.save)
+
+  def save(self):
+    if self.cache_file != '':
+      with open(self.cache_file, 'wb') as fp:
+        pickle.dump(self.table, fp, pickle.HIGHEST_PROTOCOL)
+
+  # Transposition table key: the board and the dead cards (neither placed nor remaining), as ints
+  # relabeled to canonical suits
+  def key(self, rows, remaining):
+    rows = [g.cards_to_ints(row) for row in rows]
+    seen = g.cards_to_mask(remaining)
+    for row in rows:
+      seen |= g.cards_to_mask(row)
+    dead = g.mask_to_cards(g.FULL_DECK_MASK & ~seen)
+    canonical_rows, _, suit_map = suit_isomorphism.canonicalize(rows, (), dead)
+    return canonical_rows, tuple(sorted(suit_isomorphism.relabel_cards(dead, suit_map)))
+
+  # Expected final utility of the board before the next draw, with optimal play on every remaining
+  # street
+  def chance_value(self, rows, remaining):
+    num_placed = sum(len(row) for row in rows)
+    if num_placed == sum(g.ROW_LENGTHS):
+      return final_value(rows)
+    if num_placed not in (9, 11):
+      raise ValueError("Endgame solver only covers the last two streets, got {} cards placed".format(num_placed))
+    key = self.key(rows, remaining)
+    if key in self.table:
+      self.hits += 1
+      return self.table[key]
+    self.misses += 1
+    if num_placed == 11:
+      value = self.last_street_value(rows, remaining)
+    else:
+      value = self.street_value(rows, remaining)
+    self.table[key] = value
+    return value
+
+  # Averages the best action value over every 3 card draw, one draw per suit relevance class. Suits
+  # are live if a flush can be made with the cards of both remaining streets.
+  def street_value(self, rows, remaining):
+    total = 0.
+    total_weight = 0
+    for draw, weight in suit_isomorphism.draw_classes(rows, remaining, 3, num_seen=6):
+      left = frozenset(remaining).difference(draw)
+      total += weight * max(self.chance_value(next_rows, left) for next_rows in self.next_rows(rows, draw))
+      total_weight += weight
+    return total / total_weight
+
+  def next_rows(self, rows, draw):
+    capacities = [max_cards - len(row) for max_cards, row in zip(g.ROW_LENGTHS, rows)]
+    for action in g.ActionSpace(draw, capacities):
+      next_rows = [tuple(row) for row in rows]
+      for card, placement in action:
+        next_rows[placement] += (card,)
+      yield next_rows
+
+  def last_street_value(self, rows, remaining):
+    cards = sorted(remaining)
+    n = len(cards)
+    slots = [row_num for row_num, row in enumerate(rows) for _ in xrange(g.ROW_LENGTHS[row_num] - len(row))]
+    assert len(slots) == 2
+    first, second = slots
+
+    # Cards are grouped in (value, live suit or None) classes, which all rank the same in any slot.
+    # Two cards of one class can only both be drawn when their suit is not live, and then the class
+    # representative twice ranks the same as the pair.
+    live = suit_isomorphism.live_suits(rows, 3)
+    keys = [(g.card_value(card), g.card_suit(card) if g.card_suit(card) in live else None) for card in cards]
+    unique_keys = sorted(set(keys))
+    representatives = dict(zip(keys, cards))
+    k = len(unique_keys)
+
+    # ranks[row_num] broadcasts to a k x k grid: entry (i, j) has class i in the first slot and class
+    # j in the second
+    ranks = [np.full((k, k), g.hand_rank(row), dtype=np.int64) for row in rows]
+    if first == second:
+      ranks[first] = np.array([[g.hand_rank(tuple(rows[first]) + (representatives[key1], representatives[key2]))
+        for key2 in unique_keys] for key1 in unique_keys], dtype=np.int64)
+    else:
+      ranks[first] = np.repeat(np.array([g.hand_rank(tuple(rows[first]) + (representatives[key],))
+        for key in unique_keys])[:, np.newaxis], k, 1)
+      ranks[second] = np.repeat(np.array([g.hand_rank(tuple(rows[second]) + (representatives[key],))
+        for key in unique_keys])[np.newaxis, :], k, 0)
+
+    class_values = np.zeros((k, k))
+    for row_num in xrange(g.NUM_ROWS):
+      unique_ranks, inverse = np.unique(ranks[row_num], return_inverse=True)
+      row_royalties = np.array([g.royalties(g.RANK_TO_HAND[rank], row_num) for rank in unique_ranks])
+      class_values += row_royalties[inverse].reshape(k, k)
+    bust = (ranks[0] > ranks[1]) | (ranks[1] > ranks[2])
+    class_values[bust] = g.BUST_PENALTY
+    classes = np.array([unique_keys.index(key) for key in keys], dtype=np.intp)
+    values = class_values[np.ix_(classes, classes)]
+
+    # Every draw keeps the best ordered pair of its cards
+    pair_values = np.maximum(values, values.T)
+    a, b, c = triple_indices(n)
+    return np.maximum.reduce([pair_values[a, b], pair_values[a, c], pair_values[b, c]]).mean()
+
+  # Returns (value, action) for every action available from a state whose draw is in hand
+  def action_values(self, game, state):
+    results = []
+    for action in game.actions(state):
+      with game.applied(state, action):
+        results += [(self.chance_value(state.rows, state.remaining), action)]
+    return results
+
+  def best_action(self, game, state):
+    return max(self.action_values(game, state))[1]
+
+# Returns the solver for the cache file, shared by every policy that asks for it
+SOLVERS = {}
+def get_solver(cache_file=''):
+  if cache_file not in SOLVERS:
+    SOLVERS[cache_file] = EndgameSolver(cache_file)
+  return SOLVERS[cache_file]
@@ -0,0 +1,89 @@
+from endgame import *
+
+import itertools
+import numpy as np
+import random
+
+import game as g
+
+def brute_force_value(rows, remaining):
+  if sum(len(row) for row in rows) == sum(g.ROW_LENGTHS):
+    return final_value(rows)
+  capacities = [max_cards - len(row) for max_cards, row in zip(g.ROW_LENGTHS, rows)]
+  values = []
+  for draw in itertools.combinations(sorted(remaining), 3):
+    best = None
+    for action in g.ActionSpace(draw, capacities):
+      next_rows = [tuple(row) for row in rows]
+      for card, placement in action:
+        next_rows[placement] += (card,)
+      value = brute_force_value(next_rows, set(remaining).difference(draw))
+      best = value if best is None else max(best, value)
+    values += [best]
+  return np.mean(values)
+
+def random_board(num_placed, num_remaining):
+  cards = random.sample(g.STR_CARDS, num_placed + num_remaining)
+  num_top = random.randint(max(0, num_placed - 10), 3)
+  num_mid = random.randint(max(0, num_placed - num_top - 5), min(5, num_placed - num_top))
+  rows = [cards[:num_top], cards[num_top:num_top + num_mid], cards[num_top + num_mid:num_placed]]
+  return rows, cards[num_placed:]
+
+def brute_force_test():
+  random.seed(11)
+  solver = EndgameSolver()
+  for _ in xrange(40):
+    rows, remaining = random_board(11, 10)
+    assert abs(solver.chance_value(rows, remaining) - brute_force_value(rows, remaining)) < 1e-9
+  for _ in xrange(3):
+    rows, remaining = random_board(9, 8)
+    assert abs(solver.chance_value(rows, remaining) - brute_force_value(rows, remaining)) < 1e-9
+
+  # A five card row holding one card can still make a flush over the last two streets
+  for rows in [[['8S', 'JD', 'TC'], ['2S', 'TS', 'AS', '5C', '2C'], ['KH']],
+               [['KC', 'AD', 'TC'], ['3S', 'QC', 'QS', 'JS', '8C'], ['JH']]]:
+    used = set(card for row in rows for card in row)
+    remaining = ['2H', '4H', '7H', '9H', 'QH'] + random.sample([card for card in g.STR_CARDS if card not in used and card[1] != 'H'], 5)
+    assert abs(solver.chance_value(rows, remaining) - brute_force_value(rows, remaining)) < 1e-9
+
+  # Flush draws on both slots of one row
+  rows = [['AH', 'AD', '2C'], ['3S', '3D', '9C', '9D', 'KS'], ['4H', '8H', 'JH']]
+  remaining = ['2H', '5H', 'TH', 'QS', 'QH', '7C', '7H', '9H', '9S']
+  assert abs(solver.chance_value(rows, remaining) - brute_force_value(rows, remaining)) < 1e-9
+
+  print "Brute force test passed!"
+
+def transposition_test():
+  random.seed(5)
+  solver = EndgameSolver()
+  rows, remaining = random_board(11, 30)
+  value = solver.chance_value(rows, remaining)
+  assert solver.misses == 1
+  for suits in itertools.permutations(g.SUITS):
+    suit_map = dict(zip(g.SUITS, suits))
+    permuted_rows = [suit_isomorphism.relabel_cards(row, suit_map) for row in rows]
+    assert solver.chance_value(permuted_rows, suit_isomorphism.relabel_cards(remaining, suit_map)) == value
+  assert solver.hits == 24 and solver.misses == 1
+
+  # Int cards share entries with str cards
+  assert solver.chance_value([g.cards_to_ints(row) for row in rows], g.cards_to_ints(remaining)) == value
+  assert solver.misses == 1
+
+  print "Transposition test passed!"
+
+def best_action_test():
+  game = g.PineappleGame1()
+  solver = EndgameSolver()
+  state = g.PineappleGame1State(rows=[['QH', 'QD'], ['5C', '5S', '8D', '8C', 'JS'], ['2H', '6H', '9H', 'KH']],
+    draw=['QS', 'AH', '3C'], remaining=['4D', '7S', 'TC', 'JD', 'AS'])
+  values = solver.action_values(game, state)
+  assert len(values) == len(game.actions(state))
+  # Trip queens on top would beat the two pair in the middle and bust
+  assert solver.best_action(game, state) == (('3C', 0), ('AH', 2))
+  assert state.draw == ('QS', 'AH', '3C')
+
+  print "Best action test passed!"
+
+brute_force_test()
+transposition_test()
+best_action_test()
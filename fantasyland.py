@@ -13,10 +13,14 @@ parser.add_argument('--num-cards', type=int, default=14,
                     help='number of cards to be dealt')
 parser.add_argument('--save-file', type=str, default='',
                     help='file to save utilities to')
-
+parser.add_argument('--int-cards', action='store_true',
+                    help='represent cards as ints from 0 to 51 instead of strings')
+parser.add_argument('--cache-size', type=int, default=hand_optimizer.DEFAULT_CACHE_SIZE,
+                    help='max entries in the hand optimizer cache (0 disables caching)')
 args = parser.parse_args()
+hand_optimizer.set_cache_size(args.cache_size)
 
-game = g.PineappleGame1()
+game = g.PineappleGame1(int_cards=args.int_cards)
 
 start = time.time()
 utilities = []
@@ -26,6 +30,7 @@ for iter_num in xrange(args.num_games):
   utilities += [hand_optimizer.optimize_hand([[], [], []], draw, fl_bonus=False)]
 print ''
 print "Took {} seconds.".format(time.time() - start)
+print hand_optimizer.format_cache_stats()
 
 utilities = np.array(utilities)
 if args.save_file != '':
@@ -1,10 +1,12 @@
 from collections import defaultdict
 import itertools
 import numpy as np
+import os
 import random
 
 import hand_optimizer
-from game import DECK_CARD_VALUES, ROW_LENGTHS
+import hand_probabilities
+from game import DECK_CARD_VALUES, MIN_VALUE, ROW_LENGTHS, card_suit, card_value, cards_to_strs
 
 def name_to_extractor(name):
 	d = {
@@ -21,26 +23,50 @@ Constants
 '''
 
 SUITS = 'CDHS'
-DECK_SIZE = 52
 CARDS_PER_VALUE = 4
 CARDS_PER_SUIT = 13
-MIN_DECK_SIZE = 18
-TOTAL_CARDS_SEEN = 17
 
 '''
 File names
 '''
 
-CARDINALITY_PROBABLITIES_FILE = 'cardinality_probabilities.txt'
-STRAIGHT_PROBABILITIES_FILE = 'straight_probabilities.txt'
-FLUSH_PROBABILITIES_FILE = 'flush_probabilities.txt'
+# Dense binary tables written by precompute_hand_probs
+CARDINALITY_TABLE_FILE = 'cardinality_table.npy'
+STRAIGHT_TABLE_FILE = 'straight_table.npy'
+FLUSH_TABLE_FILE = 'flush_table.npy'
 
 '''
 Global variables
 '''
 
 card_to_value = {v:k for k, v in enumerate(DECK_CARD_VALUES)} # relative ordering of cards (2 is lowest, A is highest)
-probability_lookup_table = defaultdict(float) # all keys are tuples of strings, all values are floats
+
+# Probability tables, indexed by integer coordinates and memory-mapped by load_probability_tables
+#	cardinality_table	[target_freq, row_freq, deck_freq, num_to_draw, deck_size]
+#	straight_table		[multiplicity_index(sorted_multiplicity), num_to_draw, deck_size]
+#	flush_table			[num_empty_space, num_suit_left, num_to_draw, deck_size]
+cardinality_table = None
+straight_table = None
+flush_table = None
+
+# Every sorted multiplicity of up to 5 needed straight cards, each with 0 to 4 copies left in the deck
+MULTIPLICITIES = [multiplicity for length in range(ROW_LENGTHS[2] + 1)
+	for multiplicity in itertools.combinations_with_replacement(range(CARDS_PER_VALUE + 1), length)]
+multiplicity_to_index = {multiplicity: i for i, multiplicity in enumerate(MULTIPLICITIES)}
+
+# Multiplicity index by the number of needed straight cards with 0, 1, 2, 3 and 4 copies left
+multiplicity_index_by_counts = np.zeros((ROW_LENGTHS[2] + 1,) * (CARDS_PER_VALUE + 1), dtype=np.intp)
+for i, multiplicity in enumerate(MULTIPLICITIES):
+	multiplicity_index_by_counts[tuple(multiplicity.count(c) for c in range(CARDS_PER_VALUE + 1))] = i
+
+# Straights by high card ('5' for A-5), and the mask of the card values each one needs
+STRAIGHT_HIGH_CARDS = '5' + DECK_CARD_VALUES[card_to_value['6']:]
+STRAIGHT_VALUE_MASKS = np.array([[value in '2345A' if high_card == '5' else 0 <= card_to_value[high_card] - i < 5
+	for i, value in enumerate(DECK_CARD_VALUES)] for high_card in STRAIGHT_HIGH_CARDS])
+
+# Columns of the feature_extractor_1_batch matrix
+FEATURE_1_KEYS = [(str(target_freq), value) for target_freq in range(1, CARDS_PER_VALUE + 1) for value in DECK_CARD_VALUES] + \
+	[('St', high_card) for high_card in STRAIGHT_HIGH_CARDS] + [('Fl', suit) for suit in SUITS]
 
 # For comparison between rows
 proxy_hand_score = defaultdict(float, {
@@ -59,167 +85,97 @@ def get_frequency_map(arr):
 		freq[val] += 1
 	return freq
 
-### Runs a monte carlo simulation of card drawings and averages the results
-### over a set number of trials 
-### Note: 'needed' parameter is typed depending on 'satisfies_hand' function
-def monte_carlo_sim(deck, num_to_draw, satisfies_hand, needed):
-	num_trials = 500
-	success_cnt = 0
-	for trial in range(num_trials):
-		chosen_cards = random.sample(deck, num_to_draw)
-		if (satisfies_hand(chosen_cards, needed)):
-			success_cnt += 1
-	return 1.0*success_cnt/num_trials
-
-### Precomputes all hand probabilities and outputs to three files
+### Returns the index of a sorted multiplicity tuple in the straight table
+def multiplicity_index(multiplicity):
+	return multiplicity_to_index[tuple(multiplicity)]
+
+### Computes all hand probability tables exactly with hand_probabilities, which fills the last two
+### axes (num_to_draw, deck_size) of each table one grid at a time
+def compute_probability_tables():
+	grid_shape = hand_probabilities.GRID_SHAPE
+
+	# Single / Pair / Triple / Four of a kind: at least target_freq - row_freq of the deck_freq cards
+	cardinality = np.zeros((CARDS_PER_VALUE + 1,) * 3 + grid_shape)
+	for target_freq, row_freq, deck_freq in itertools.product(range(CARDS_PER_VALUE + 1), repeat=3):
+		cardinality[target_freq, row_freq, deck_freq] = hand_probabilities.at_least_probabilities(target_freq - row_freq, deck_freq)
+
+	# Straight: at least one card of every needed value
+	straight = np.zeros((len(MULTIPLICITIES),) + grid_shape)
+	for i, multiplicity in enumerate(MULTIPLICITIES):
+		straight[i] = hand_probabilities.all_present_probabilities(multiplicity)
+
+	# Flush: at least num_empty_space of the num_suit_left cards. Full rows (no empty space) are left at
+	# 0, so that finished flushes do not count as flush draws.
+	flush = np.zeros((ROW_LENGTHS[2] + 1, CARDS_PER_SUIT + 1) + grid_shape)
+	for num_empty_space, num_suit_left in itertools.product(range(1, ROW_LENGTHS[2] + 1), range(CARDS_PER_SUIT + 1)):
+		flush[num_empty_space, num_suit_left] = hand_probabilities.at_least_probabilities(num_empty_space, num_suit_left)
+
+	return cardinality, straight, flush
+
+### Saves an array to file_name, through a temporary file so that concurrent readers never see a
+### partially written table
+def save_table(file_name, table):
+	tmp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+	with open(tmp_file_name, 'wb') as f:
+		np.save(f, table)
+	os.rename(tmp_file_name, file_name)
+
+### Precomputes all hand probabilities and outputs to three .npy files
 def precompute_hand_probs():
-	raise Exception("Comment this line out if you REALLY want to precompute all probabilities again. Otherwise call parse_probability_files :)")
-
-	for i, card in enumerate(DECK_CARD_VALUES):
-		card_to_value[card] = i
-	full_deck = set([a + b for a, b in itertools.product(DECK_CARD_VALUES, 'CDHS')])
-	reference_card_values = ['A', '2', '3', '4' , '5'] # arbitrary values used to construct deck
-
-	# Single / Pair / Triple / Four of a kind
-	# probability_lookup_table -- key: (target_freq, row_freq, deck_freq, num_to_draw, deck_size)
-	def satisfies_hand(chosen_cards, needed):
-		card_value, num_cards_needed = needed
-		chosen = [card[0] for card in chosen_cards]
-		cnt = chosen.count(card_value)
-		return (cnt >= num_cards_needed)
-
-	print 'Normal'
-
-	output_file = open(CARDINALITY_PROBABLITIES_FILE, 'w')
-	parameters = ['Probability', 'Target freq', 'Row freq', 'Deck freq', 'Number to draw', 'Deck size']
-	output_file.write('\t'.join(parameters) + '\n')
-	
-	card_value = reference_card_values[0] 
-	for target_freq in range(1, 5):
-		for row_freq in range(CARDS_PER_VALUE):
-			for deck_freq in range(CARDS_PER_VALUE - row_freq + 1):
-				for deck_size in range(MIN_DECK_SIZE, DECK_SIZE + 1):
-					# Build customized deck
-					if (target_freq > row_freq):
-						deck = full_deck.copy()
-						deck -= set([a + b for a, b in itertools.product(card_value, 'CDHS')])
-						deck = set(list(deck)[:(deck_size - deck_freq)])
-						for i in range(deck_freq):
-							deck.add(card_value + SUITS[i])
-					for num_to_draw in range(min(deck_size, TOTAL_CARDS_SEEN) + 1):
-						if (row_freq >= target_freq):
-							prob = 1.0
-						elif (num_to_draw == 0):
-							prob = 0.0
-						else:
-							num_cards_needed = target_freq - row_freq
-							if (num_cards_needed > deck_freq): 
-								continue
-							needed = (card_value, num_cards_needed)
-							prob = monte_carlo_sim(deck, num_to_draw, satisfies_hand, needed)
-						key = tuple([str(x) for x in [target_freq, row_freq, deck_freq, num_to_draw, deck_size]])
-						probability_lookup_table[key] = prob
-						output_file.write('\t'.join([str(x).rjust(9) for x in [prob, target_freq, row_freq, deck_freq, num_to_draw, deck_size]]) + '\n')
-	output_file.close()
-
-	print 'Straight'
-
-	# Straight
-	# probability_lookup_table -- key: ('St', sorted_multiplicity, num_to_draw, deck_size)
-	def satisfies_straight(chosen_cards, needed):
-		chosen = set(card[0] for card in chosen_cards)
-		for val in needed:
-			if (val not in chosen):
-				return False
-		return True
-
-	output_file = open(STRAIGHT_PROBABILITIES_FILE, 'w')
-	parameters = ['probability', 'multiplicity', 'num_to_draw', 'deck_size']
-	output_file.write('\t'.join(parameters) + '\n')
-
-	for num_empty_space in range(ROW_LENGTHS[1], -1, -1):
-		possibilities = []
-		for i in range(1, 5):
-			for j in range(num_empty_space):
-				possibilities.append(i)
-		multiplicities = set(itertools.combinations(possibilities, num_empty_space))
-		for multiplicity in multiplicities:
-			deck_freq = sum(multiplicity)
-			for deck_size in range(MIN_DECK_SIZE, DECK_SIZE + 1):
-				# Build customized deck
-				deck = full_deck.copy()
-				deck -= set([a + b for a, b in itertools.product(reference_card_values[:num_empty_space], 'CDHS')])
-				deck = set(list(deck)[:(deck_size - deck_freq)])	
-				needed = []
-				for idx in range(len(multiplicity)):
-					val = multiplicity[idx]
-					for suit_idx in range(val):
-						deck.add(reference_card_values[idx] + SUITS[suit_idx])
-					needed.append(reference_card_values[idx])
-
-				for num_to_draw in range(num_empty_space, min(deck_size, TOTAL_CARDS_SEEN) + 1):
-					prob = monte_carlo_sim(deck, num_to_draw, satisfies_straight, set(needed))
-					key = tuple([str(x) for x in ['St', multiplicity, num_to_draw, deck_size]])
-					probability_lookup_table[key] = prob
-					output_file.write('\t'.join([str(x).rjust(10) for x in [prob, multiplicity, num_to_draw, deck_size]]) + '\n')
-	output_file.close()
-
-	print 'Flush'
-
-	# Flush
-	# probability_lookup_table -- key: ('Fl', num_empty_space, num_suit_left, num_to_draw, deck_size)
-	def satisfies_flush(chosen_cards, needed):
-		chosen_card_suits = [card[1] for card in chosen_cards]
-		flush_suit, num_cards_needed = needed
-		return (chosen_card_suits.count(flush_suit) >= num_cards_needed)
-
-	output_file = open(FLUSH_PROBABILITIES_FILE, 'w')
-	parameters = ['probability', 'num_empty_space', 'num_suit_left', 'num_to_draw', 'deck_size']
-	output_file.write('\t'.join(parameters) + '\n')
-
-	reference_suit = 'C'
-	for num_empty_space in range(1, ROW_LENGTHS[1] + 1):
-		for num_suit_left in range(num_empty_space, CARDS_PER_SUIT + 1):
-			for deck_size in range(MIN_DECK_SIZE, DECK_SIZE + 1):
-				# Build customized deck
-				deck = full_deck.copy()
-				deck -= set([a + b for a, b in itertools.product(DECK_CARD_VALUES, reference_suit)])
-				deck = set(list(deck)[:(deck_size - num_suit_left)])
-				deck |= set([a + b for a, b in itertools.product(DECK_CARD_VALUES[:num_suit_left], reference_suit)])
-				needed = (reference_suit, num_empty_space)
-				for num_to_draw in range(num_empty_space, min(deck_size, TOTAL_CARDS_SEEN) + 1):
-					prob = monte_carlo_sim(deck, num_to_draw, satisfies_flush, needed)
-					key = tuple([str(x) for x in ['Fl', num_empty_space, num_suit_left, num_to_draw, deck_size]])
-					probability_lookup_table[key] = prob
-					output_file.write('\t'.join([str(x).rjust(13) for x in [prob, num_empty_space, num_suit_left, num_to_draw, deck_size]]) + '\n')
-	output_file.close()
-
-
-### Call this function to read precomputed probabilities from corresponding files.
-### All probabilities are stored in probability_lookup_table.
-def parse_probability_files():
-	with open(CARDINALITY_PROBABLITIES_FILE) as cf:
-		cf.readline()
-		for line in cf:
-			line = [x.strip() for x in line.strip().split('\t')]
-			probability_lookup_table[tuple(line[1:])] = float(line[0])
-
-	with open(STRAIGHT_PROBABILITIES_FILE) as sf:
-		sf.readline()
-		hand_name = ['St']
-		for line in sf:
-			line = [x.strip() for x in line.strip().split('\t')]
-			probability_lookup_table[tuple(hand_name + line[1:])] = float(line[0])
-
-	with open(FLUSH_PROBABILITIES_FILE) as ff:
-		ff.readline()
-		hand_name = ['Fl']
-		for line in ff:
-			line = [x.strip() for x in line.strip().split('\t')]
-			probability_lookup_table[tuple(hand_name + line[1:])] = float(line[0])
-
-
-### Returns a monte-carlo simulated hand probability feature vector of a given row
+	cardinality, straight, flush = compute_probability_tables()
+	save_table(CARDINALITY_TABLE_FILE, cardinality)
+	save_table(STRAIGHT_TABLE_FILE, straight)
+	save_table(FLUSH_TABLE_FILE, flush)
+
+### Call this function to load the precomputed probability tables, computing them first if needed.
+### Tables are memory-mapped read only, so processes forked afterwards share their pages.
+def load_probability_tables():
+	global cardinality_table, straight_table, flush_table
+	if cardinality_table is not None:
+		return
+	if not all(os.path.exists(f) for f in [CARDINALITY_TABLE_FILE, STRAIGHT_TABLE_FILE, FLUSH_TABLE_FILE]):
+		precompute_hand_probs()
+	cardinality_table = np.load(CARDINALITY_TABLE_FILE, mmap_mode='r')
+	straight_table = np.load(STRAIGHT_TABLE_FILE, mmap_mode='r')
+	flush_table = np.load(FLUSH_TABLE_FILE, mmap_mode='r')
+
+### Returns table[index] as a float, or 0 if the index is outside the table
+def lookup_probability(table, index):
+	for i, size in zip(index, table.shape):
+		if i < 0 or i >= size:
+			return 0.0
+	return table.item(index)
+
+### Probability lookups. Without loaded tables they are answered directly by hand_probabilities.
+def cardinality_probability(target_freq, row_freq, deck_freq, num_to_draw, deck_size):
+	if cardinality_table is None:
+		return hand_probabilities.at_least_probability(target_freq - row_freq, deck_freq, num_to_draw, deck_size)
+	return lookup_probability(cardinality_table, (target_freq, row_freq, deck_freq, num_to_draw, deck_size))
+
+def straight_probability(multiplicity, num_to_draw, deck_size):
+	if straight_table is None:
+		return hand_probabilities.all_present_probability(multiplicity, num_to_draw, deck_size)
+	return lookup_probability(straight_table, (multiplicity_index(multiplicity), num_to_draw, deck_size))
+
+def flush_probability(num_empty_space, num_suit_left, num_to_draw, deck_size):
+	if num_empty_space <= 0:
+		return 0.0
+	if flush_table is None:
+		return hand_probabilities.at_least_probability(num_empty_space, num_suit_left, num_to_draw, deck_size)
+	return lookup_probability(flush_table, (num_empty_space, num_suit_left, num_to_draw, deck_size))
+
+
+### Returns the (rank counts, suit counts) of the deck, which is all feature_extractor_1 reads from it
+def deck_signature(deck):
+	rank_counts = [0] * len(DECK_CARD_VALUES)
+	suit_counts = [0] * len(SUITS)
+	for card in deck:
+		rank_counts[card_value(card) - MIN_VALUE] += 1
+		suit_counts[SUITS.index(card_suit(card))] += 1
+	return tuple(rank_counts), tuple(suit_counts)
+
+
+### Returns a hand probability feature vector of a given row
 ### Inputs:
 ###		row_num 	[int]: row number
 ###		cards 		[set]: set of cards in the given row
@@ -235,6 +191,9 @@ def parse_probability_files():
 ###		Value: 	probability of hand_name at card_value 
 def feature_extractor_1(row_num, cards, deck, num_to_draw):
 	features = defaultdict(float)
+	# Probability tables are keyed by string cards, so convert int cards at the boundary
+	cards = cards_to_strs(cards)
+	deck = cards_to_strs(deck)
 	row_card_freq = get_frequency_map([card[0] for card in cards])
 	deck_card_freq = get_frequency_map([card[0] for card in deck])
 	num_cards = len(cards)
@@ -249,8 +208,7 @@ def feature_extractor_1(row_num, cards, deck, num_to_draw):
 		for target_freq in range(1, 5):
 			if (target_freq == 4 and row_num == 0 or num_empty_space < target_freq - row_freq): 
 				continue
-			key = tuple([str(x) for x in [target_freq, row_freq, deck_freq, num_to_draw, deck_size]])
-			features[(str(target_freq), card_value)] = probability_lookup_table[key]
+			features[(str(target_freq), card_value)] = cardinality_probability(target_freq, row_freq, deck_freq, num_to_draw, deck_size)
 	
 	### Straight / Flush
 	if (row_num > 0):
@@ -273,8 +231,7 @@ def feature_extractor_1(row_num, cards, deck, num_to_draw):
 			if (card_to_value['A'] not in card_values): # Ace
 				needed.append(card_to_value['A'])
 			multiplicity = get_multiplicity(deck_card_freq, needed)
-			key = tuple(str(x) for x in ['St', multiplicity, num_to_draw, deck_size])
-			features[('St', '5')] = probability_lookup_table[key]
+			features[('St', '5')] = straight_probability(multiplicity, num_to_draw, deck_size)
 
 		# Checks for A-5 straight possibility
 		def first_straight(card_values):
@@ -291,8 +248,7 @@ def feature_extractor_1(row_num, cards, deck, num_to_draw):
 			for high_card in range(card_to_value['6'], card_to_value['A'] + 1):
 				needed = [i for i in range(high_card - 4, high_card + 1)]
 				multiplicity = get_multiplicity(deck_card_freq, needed)
-				key = tuple(str(x) for x in ['St', multiplicity, num_to_draw, deck_size])
-				features[('St', DECK_CARD_VALUES[high_card])] = probability_lookup_table[key]
+				features[('St', DECK_CARD_VALUES[high_card])] = straight_probability(multiplicity, num_to_draw, deck_size)
 		else:
 			max_value = max(card_values)
 			min_value = min(card_values)
@@ -307,8 +263,7 @@ def feature_extractor_1(row_num, cards, deck, num_to_draw):
 						if (i not in card_values):
 							needed.append(i)
 					multiplicity = get_multiplicity(deck_card_freq, needed)
-					key = tuple(str(x) for x in ['St', multiplicity, num_to_draw, deck_size])
-					features[('St', DECK_CARD_VALUES[high_card])] = probability_lookup_table[key]
+					features[('St', DECK_CARD_VALUES[high_card])] = straight_probability(multiplicity, num_to_draw, deck_size)
 
 		### Flush
 		for suit in SUITS:
@@ -316,12 +271,82 @@ def feature_extractor_1(row_num, cards, deck, num_to_draw):
 			deck_suit_count = deck_suits.count(suit)
 			if (card_suits.count(suit) == num_cards):
 				num_cards_needed = ROW_LENGTHS[row_num] - num_cards
-				key = tuple([str(x) for x in ['Fl', num_cards_needed, deck_suit_count, num_to_draw, deck_size]])
-				features[('Fl', suit)] = probability_lookup_table[key]
+				features[('Fl', suit)] = flush_probability(num_cards_needed, deck_suit_count, num_to_draw, deck_size)
 
 	return features
 
 
+### Returns the (rank counts, suit counts) arrays of each set of cards, with one row per set
+def count_cards(card_sets):
+	rank_counts = np.zeros((len(card_sets), len(DECK_CARD_VALUES)), dtype=np.intp)
+	suit_counts = np.zeros((len(card_sets), len(SUITS)), dtype=np.intp)
+	for i, cards in enumerate(card_sets):
+		for card in cards:
+			rank_counts[i, card_value(card) - MIN_VALUE] += 1
+			suit_counts[i, SUITS.index(card_suit(card))] += 1
+	return rank_counts, suit_counts
+
+### Batched feature_extractor_1 over rows that share the deck and num_to_draw
+### Inputs:
+###		row_nums 			[array]: row number of each row
+###		rank_counts 		[array]: (num_rows, 13) counts of each card value in each row, see count_cards
+###		suit_counts 		[array]: (num_rows, 4) counts of each suit in each row
+###		deck_rank_counts 	[array]: counts of each card value in the deck, see deck_signature
+###		deck_suit_counts 	[array]: counts of each suit in the deck
+###		num_to_draw 		[int]: remaining number of cards to draw
+### Output:
+###		Return (num_rows, len(FEATURE_1_KEYS)) matrix, where row i holds feature_extractor_1 of row i
+###		in the columns of FEATURE_1_KEYS, and features it leaves out are 0
+def feature_extractor_1_batch(row_nums, rank_counts, suit_counts, deck_rank_counts, deck_suit_counts, num_to_draw):
+	load_probability_tables()
+	row_nums = np.asarray(row_nums)
+	deck_rank_counts = np.asarray(deck_rank_counts)
+	deck_suit_counts = np.asarray(deck_suit_counts)
+	num_rows = len(row_nums)
+	num_cards = rank_counts.sum(axis=1)
+	num_empty_spaces = np.array(ROW_LENGTHS)[row_nums] - num_cards
+	deck_size = deck_rank_counts.sum()
+	assert np.all(num_to_draw >= num_empty_spaces)
+
+	features = np.zeros((num_rows, len(FEATURE_1_KEYS)))
+	# All tables share the (num_to_draw, deck_size) axes, and lookups outside them are 0
+	if num_to_draw >= cardinality_table.shape[-2] or deck_size >= cardinality_table.shape[-1]:
+		return features
+
+	### Single / Pair / Triple / Four of a kind, as (num_rows, target_freq, card_value)
+	target_freqs = np.arange(1, CARDS_PER_VALUE + 1)[np.newaxis, :, np.newaxis]
+	row_freqs = rank_counts[:, np.newaxis, :]
+	probs = cardinality_table[target_freqs, row_freqs, deck_rank_counts, num_to_draw, deck_size]
+	skipped = ((target_freqs == 4) & (row_nums == 0)[:, np.newaxis, np.newaxis]) | \
+		(num_empty_spaces[:, np.newaxis, np.newaxis] < target_freqs - row_freqs)
+	num_cardinality = CARDS_PER_VALUE * len(DECK_CARD_VALUES)
+	features[:, :num_cardinality] = np.where(skipped, 0., probs).reshape(num_rows, num_cardinality)
+
+	### Straight, as (num_rows, high_card)
+	# A straight is possible when all row values are part of it, and needs the values the row lacks
+	present = (rank_counts > 0)[:, np.newaxis, :]
+	possible = ~np.any(present & ~STRAIGHT_VALUE_MASKS, axis=2) & (row_nums > 0)[:, np.newaxis]
+	needed = STRAIGHT_VALUE_MASKS & ~present
+	copies_left = (deck_rank_counts[:, np.newaxis] == np.arange(CARDS_PER_VALUE + 1)).astype(np.intp)
+	needed_by_copies = np.dot(needed.astype(np.intp), copies_left)
+	multiplicity_indices = multiplicity_index_by_counts[tuple(np.rollaxis(needed_by_copies, 2))]
+	probs = straight_table[multiplicity_indices, num_to_draw, deck_size]
+	num_straight = len(STRAIGHT_HIGH_CARDS)
+	features[:, num_cardinality:num_cardinality + num_straight] = np.where(possible, probs, 0.)
+
+	### Flush, as (num_rows, suit)
+	possible = (suit_counts == num_cards[:, np.newaxis]) & ((row_nums > 0) & (num_empty_spaces > 0))[:, np.newaxis]
+	probs = flush_table[num_empty_spaces[:, np.newaxis], deck_suit_counts, num_to_draw, deck_size]
+	features[:, num_cardinality + num_straight:] = np.where(possible, probs, 0.)
+
+	return features
+
+# Batched versions of the row feature extractors, with the keys of their columns
+BATCH_EXTRACTORS = {
+	feature_extractor_1: (feature_extractor_1_batch, FEATURE_1_KEYS),
+}
+
+
 # Feature_extractor_1 with additional information derived from input parameters
 def feature_extractor_2(row_num, cards, deck, num_to_draw):
 	features = feature_extractor_1(row_num, cards, deck, num_to_draw)
@@ -362,6 +387,38 @@ def feature_extractor_3(cardset, deck, num_to_draw):
 		})
 
 
+### Assigns every feature key a fixed column in dense feature vectors, in order of first appearance
+class FeatureRegistry(object):
+	def __init__(self, keys=()):
+		self.keys = []
+		self.columns = {}
+		for key in keys:
+			self.column(key)
+
+	def __len__(self):
+		return len(self.keys)
+
+	# Returns the column of the key, assigning the next column to new keys
+	def column(self, key):
+		if key not in self.columns:
+			self.columns[key] = len(self.keys)
+			self.keys.append(key)
+		return self.columns[key]
+
+	# Returns the dense vector of a dict of features, registering its keys
+	def vector(self, features):
+		columns = [self.column(key) for key in features]
+		vector = np.zeros(len(self))
+		vector[columns] = features.values()
+		return vector
+
+	# Pads a vector with zeros for the columns registered since it was built
+	def pad(self, vector):
+		if len(vector) == len(self):
+			return vector
+		return np.concatenate([vector, np.zeros(len(self) - len(vector))])
+
+
 class QLearningExtractor(object):
 	def __init__(self, game):
 		self.game = game
@@ -390,8 +447,6 @@ class FeatureExtractor3(QLearningExtractor):
 			})
 
 	def extract(self, state, action):
-		state = self.game.sim_place_cards(state, action)
-		num_to_draw = self.game.num_to_draw(state)
 		ranges_and_sims = {
 			3: ([3], 20),
 			6: ([4, 5, 6], 8),
@@ -399,11 +454,11 @@ class FeatureExtractor3(QLearningExtractor):
 			12: ([8, 9, 10, 11, 12], 2)
 		}
 		features = {}
-		draw_range, num_sims = ranges_and_sims[num_to_draw]
-		for num_to_draw2 in draw_range:
-			total = 0.
-			for _ in xrange(num_sims):
-				draw = random.sample(state.remaining, num_to_draw2)
-				total += hand_optimizer.optimize_hand(state.rows, draw)
-			features[(num_to_draw, num_to_draw2)] = total / float(num_sims)
+		with self.game.applied(state, action):
+			num_to_draw = self.game.num_to_draw(state)
+			draw_range, num_sims = ranges_and_sims[num_to_draw]
+			for num_to_draw2 in draw_range:
+				draws = [random.sample(state.remaining, num_to_draw2) for _ in xrange(num_sims)]
+				total = hand_optimizer.optimize_hand_many(state.rows, draws).sum()
+				features[(num_to_draw, num_to_draw2)] = total / float(num_sims)
 		return features
\ No newline at end of file
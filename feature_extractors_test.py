@@ -1,6 +1,9 @@
 from feature_extractors import *
-from game import DECK_CARD_VALUES
+import feature_extractors
+from game import DECK_CARD_VALUES, cards_to_ints
+import hand_probabilities
 import itertools
+import random
 
 def tests():
 	# Testing single / pair / triple
@@ -12,7 +15,84 @@ def tests():
 	assert features[('St', '5')] > 0.0
 	assert features[('Fl', 'C')] > 0.0
 
+	# A finished flush is not a flush draw
+	row = ['2C', '5C', '8C', 'JC', 'KC']
+	assert feature_extractor_1(2, row, full_deck - set(row), 3)[('Fl', 'C')] == 0.0
+	assert feature_extractor_1(2, row[:4], full_deck - set(row), 3)[('Fl', 'C')] > 0.0
+
+def table_tests():
+	# Tables are memory-mapped and agree with the lookups answered directly by hand_probabilities
+	assert isinstance(feature_extractors.cardinality_table, np.memmap)
+	for target_freq, row_freq, deck_freq in itertools.product(range(5), repeat=3):
+		for num_to_draw, deck_size in [(0, 20), (3, 30), (9, 47), (17, 18)]:
+			assert cardinality_probability(target_freq, row_freq, deck_freq, num_to_draw, deck_size) == \
+				hand_probabilities.at_least_probability(target_freq - row_freq, deck_freq, num_to_draw, deck_size)
+	for multiplicity in MULTIPLICITIES:
+		assert straight_probability(multiplicity, 8, 40) == hand_probabilities.all_present_probability(multiplicity, 8, 40)
+	for num_empty_space, num_suit_left in itertools.product(range(1, 6), range(14)):
+		assert flush_probability(num_empty_space, num_suit_left, 8, 40) == \
+			hand_probabilities.at_least_probability(num_empty_space, num_suit_left, 8, 40)
+
+	# Coordinates outside the tables have probability 0
+	assert straight_probability((0, 1, 1, 1, 1), 10, 30) == 0.0
+	assert cardinality_probability(2, 1, 1, 10, 60) == 0.0
+
+def signature_tests():
+	# Decks with the same rank and suit counts give the same row features
+	deck_1 = full_deck - set(['AH', 'KS', '2C', '3D'])
+	deck_2 = full_deck - set(['AS', 'KH', '2D', '3C'])
+	assert deck_signature(deck_1) == deck_signature(deck_2)
+	assert deck_signature(deck_1) != deck_signature(full_deck - set(['AH', 'KH', '2C', '3D']))
+	assert deck_signature(cards_to_ints(deck_1)) == deck_signature(deck_1)
+	row = ['QC', 'JD']
+	assert feature_extractor_1(1, row, deck_1 - set(row), 9) == feature_extractor_1(1, row, deck_2 - set(row), 9)
+
+def batch_tests():
+	# The batched extractor matches feature_extractor_1 row by row, with left out features as 0
+	random.seed(4)
+	columns = {key: i for i, key in enumerate(FEATURE_1_KEYS)}
+	deck = set(random.sample(full_deck, 30))
+	for num_to_draw in [3, 8, 12]:
+		row_nums = []
+		rows = []
+		for _ in range(100):
+			row_num = random.randint(0, 2)
+			num_cards = random.randint(max(0, ROW_LENGTHS[row_num] - num_to_draw), ROW_LENGTHS[row_num])
+			row_nums.append(row_num)
+			rows.append(random.sample(full_deck - deck, num_cards))
+		# A-5 straight draws and flush draws
+		row_nums += [1, 2, 2, 2]
+		rows += [['AH', '3H'], ['6C', '7C', '9C'], ['TS', 'JS', 'QD', 'KH'], ['2D', '5D', '8D', 'JD', 'KD']]
+		rank_counts, suit_counts = count_cards(rows)
+		deck_rank_counts, deck_suit_counts = deck_signature(deck)
+		matrix = feature_extractor_1_batch(row_nums, rank_counts, suit_counts, deck_rank_counts, deck_suit_counts, num_to_draw)
+		assert matrix.shape == (len(rows), len(FEATURE_1_KEYS))
+		for row_num, row, batch_features in zip(row_nums, rows, matrix):
+			features = np.zeros(len(FEATURE_1_KEYS))
+			for key, value in feature_extractor_1(row_num, row, deck, num_to_draw).iteritems():
+				features[columns[key]] = value
+			assert np.array_equal(batch_features, features)
+
+def registry_tests():
+	registry = FeatureRegistry([(0, ('1', 'A')), (1, ('St', '5'))])
+	assert len(registry) == 2 and registry.column((1, ('St', '5'))) == 1
+	assert registry.column((2, ('Fl', 'C'))) == 2
+	assert registry.column((0, ('1', 'A'))) == 0
+	assert list(registry.vector({(2, ('Fl', 'C')): 0.5, (0, ('2', 'K')): 0.25})) == [0, 0, 0.5, 0.25]
+	assert registry.keys[3] == (0, ('2', 'K'))
+	registry.column('new')
+	assert list(registry.pad(np.ones(3))) == [1, 1, 1, 0, 0]
+
 full_deck = set([a + b for a, b in itertools.product(DECK_CARD_VALUES, 'CDHS')])
-parse_probability_files()
 
-tests()
\ No newline at end of file
+# Without tables, lookups are answered directly and match the loaded tables
+row = ['9H', 'TH', 'TC']
+direct_features = feature_extractor_1(2, row, full_deck - set(row), 8)
+load_probability_tables()
+assert feature_extractor_1(2, row, full_deck - set(row), 8) == direct_features
+
+tests()
+table_tests()
+signature_tests()
+batch_tests()
+registry_tests()
@@ -1,16 +1,43 @@
-from collections import namedtuple, defaultdict
-import copy
+from collections import namedtuple, defaultdict, Sequence
+import contextlib
 import itertools
 import random
 
-# rows: list of lists for top, middle, bottom rows
+# rows: tuple of tuples for top, middle, bottom rows
 # draw: whatever has been drawn
-# remaining: set of remaining cards
+# remaining: frozenset of remaining cards
+#
+# Every field holds an immutable value, so states are cloned in O(1) by replace, which shares all
+# fields with the original. Fields are only ever reassigned, never mutated in place.
 class PineappleGame1State(object):
+  __slots__ = ('rows', 'draw', 'remaining')
+  FIELDS = __slots__
+
   def __init__(self, rows, draw, remaining):
-    self.rows = rows
-    self.draw = draw
-    self.remaining = remaining
+    self.rows = tuple(tuple(row) for row in rows)
+    self.draw = tuple(draw) if draw is not None else None
+    self.remaining = frozenset(remaining)
+
+  # Returns a clone of the state with the given fields replaced. Replacement values must already
+  # be immutable.
+  def replace(self, **fields):
+    state = object.__new__(self.__class__)
+    for name in self.FIELDS:
+      setattr(state, name, fields[name] if name in fields else getattr(self, name))
+    return state
+
+  def __copy__(self):
+    return self.replace()
+
+  def __deepcopy__(self, memo):
+    return self.replace()
+
+  def __getstate__(self):
+    return tuple(getattr(self, name) for name in self.FIELDS)
+
+  def __setstate__(self, values):
+    for name, value in zip(self.FIELDS, values):
+      setattr(self, name, value)
 
 '''
 GAME CONSTANTS
@@ -52,6 +79,28 @@ NUM_ROWS = 3
 FILL_CARDS = ['VF', 'WE', 'XE', 'YE', 'ZE']
 SWEEP_SCORE = 6
 
+'''
+CARD ENCODING
+'''
+# Cards can either be two character strings ('AH') or ints from 0 to 51, where the int card is
+# 4 * (value - 2) + suit index. Sets of int cards can also be stored as 52-bit masks, where bit i
+# is set when card i is present.
+NUM_CARDS = 52
+STR_CARDS = [a + b for a, b in itertools.product(DECK_CARD_VALUES, SUITS)]
+INT_CARDS = range(NUM_CARDS)
+FULL_DECK_MASK = (1 << NUM_CARDS) - 1
+CARD_VALUE_TABLE = {}
+CARD_SUIT_TABLE = {}
+CARD_INDEX_TABLE = {}
+for i, card in enumerate(STR_CARDS):
+  for key in (i, card):
+    CARD_VALUE_TABLE[key] = i / len(SUITS) + MIN_VALUE
+    CARD_SUIT_TABLE[key] = SUITS[i % len(SUITS)]
+    CARD_INDEX_TABLE[key] = i
+for card in FILL_CARDS:
+  CARD_VALUE_TABLE[card] = CARD_VALUES.index(card[0]) - 3
+  CARD_SUIT_TABLE[card] = card[1]
+
 '''
 PARAMETERS
 '''
@@ -68,34 +117,75 @@ def get_fantasyland_bonus():
 
 # Return the value of the card (from 2 to 14)
 def card_value(card):
-  return CARD_VALUES.index(card[0]) - 3
+  try:
+    return CARD_VALUE_TABLE[card]
+  except KeyError:
+    return CARD_VALUES.index(card[0]) - 3
+
+# Return the suit of the card as one of SUITS, for both string and int cards
+def card_suit(card):
+  try:
+    return CARD_SUIT_TABLE[card]
+  except KeyError:
+    return card[1]
 
 # Sort the provided cards according to rank. In increasing order if inc=True.
 def sort_cards(cards, inc=True):
-  if inc:
-    return sorted(cards, lambda x, y: cmp(card_value(x), card_value(y)))
-  else:
-    return sorted(cards, lambda x, y: -cmp(card_value(x), card_value(y)))
+  return sorted(cards, key=card_value, reverse=not inc)
 
 # Make the card of the provided value and suit
 def make_card(value, suit):
   return str(CARD_VALUES[value + 3]) + suit
 
+# Make the int card of the provided value and suit
+def make_int_card(value, suit):
+  return (value - MIN_VALUE) * len(SUITS) + SUITS.index(suit)
+
+# Conversions between string cards, int cards and card masks. All of them accept either
+# representation as input.
+def card_to_int(card):
+  return CARD_INDEX_TABLE[card]
+
+def card_to_str(card):
+  return STR_CARDS[CARD_INDEX_TABLE[card]]
+
+def cards_to_ints(cards):
+  return [CARD_INDEX_TABLE[card] for card in cards]
+
+def cards_to_strs(cards):
+  return [STR_CARDS[CARD_INDEX_TABLE[card]] for card in cards]
+
+def cards_to_mask(cards):
+  mask = 0
+  for card in cards:
+    mask |= 1 << CARD_INDEX_TABLE[card]
+  return mask
+
+# Returns the cards in the mask in increasing order, as strings if as_str=True
+def mask_to_cards(mask, as_str=False):
+  cards = []
+  while mask:
+    low_bit = mask & -mask
+    index = low_bit.bit_length() - 1
+    cards += [STR_CARDS[index] if as_str else index]
+    mask ^= low_bit
+  return cards
+
 # Turn a list of cards into a multiplicity table
 def cards_to_mults(cards):
   if len(cards) == 0:
     return []
-  cards = sort_cards(cards, inc=False)
+  values = sorted([card_value(card) for card in cards], reverse=True)
   cur_streak = 1
   mults = []
-  for i in range(len(cards) - 1):
-    if cards[i][0] == cards[i+1][0]:
+  for i in range(len(values) - 1):
+    if values[i] == values[i+1]:
       cur_streak += 1
     else:
-      mults += [(cur_streak, card_value(cards[i]))]
+      mults += [(cur_streak, values[i])]
       cur_streak = 1
-  mults += [(cur_streak, card_value(cards[-1]))]
-  mults.sort(lambda x, y: -cmp(x, y))
+  mults += [(cur_streak, values[-1])]
+  mults.sort(reverse=True)
   return mults
 
 # Compute the hand associated with the given cards
@@ -106,7 +196,7 @@ def compute_hand(cards):
     deficit = 3 - len(cards)
   else:
     deficit = 5 - len(cards)
-  cards = cards + FILL_CARDS[:deficit]
+  cards = list(cards) + FILL_CARDS[:deficit]
 
   # Sort cards descending
   cards = sort_cards(cards, False)
@@ -118,7 +208,8 @@ def compute_hand(cards):
   if len(cards) > 3:
     is_straight = is_flush = False
     # Flush
-    if all([card[1] == cards[0][1] for card in cards]):
+    suit = card_suit(cards[0])
+    if all([card_suit(card) == suit for card in cards]):
       is_flush = True
     # Straight
     if len(mults) == 5:
@@ -205,10 +296,10 @@ def total_royalties(rows, fl_bonus=True):
   assert len(rows) == NUM_ROWS
   for i in xrange(NUM_ROWS):
     assert len(rows[i]) == ROW_LENGTHS[i]
-  hands = rows_to_hands(rows)
-  if is_bust(hands):
+  ranks = rows_to_ranks(rows)
+  if ranks_are_bust(ranks):
     return None
-  return sum(royalties(hand, row, fl_bonus) for row, hand in enumerate(hands))
+  return sum(royalties(RANK_TO_HAND[rank], row, fl_bonus) for row, rank in enumerate(ranks))
 
 # Returns the utility earned by hands1 against hands2
 def adv_utility(hands1, hands2):
@@ -229,6 +320,158 @@ def adv_utility(hands1, hands2):
     comp_utility = -6
   return hands1_royalties - hands2_royalties + comp_utility
 
+'''
+HAND RANKS
+
+A hand rank is a single int that orders hands the same way compare_hands does. Top row ranks pad
+missing values with zeros, so rank(top) > rank(mid) exactly when compare_hands(top, mid) > 0.
+
+Ranks are looked up by the product of one prime per card value (fillers included), with separate
+tables for the top row, five card rows and five card flushes. Tables are filled on first sight of
+each key, or all at once with build_rank_tables.
+'''
+RANK_BASE = 19 # Values from -3 to 14 are stored as digits from 1 to 18, with 0 used as padding
+VALUE_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61]
+CARD_PRIME_TABLE = {card: VALUE_PRIMES[value + 3] for card, value in CARD_VALUE_TABLE.iteritems()}
+FILL_PRIME_PRODUCTS = {}
+for num_cards in xrange(6):
+  FILL_PRIME_PRODUCTS[num_cards] = 1
+  for card in FILL_CARDS[:(3 if num_cards <= 3 else 5) - num_cards]:
+    FILL_PRIME_PRODUCTS[num_cards] *= CARD_PRIME_TABLE[card]
+TOP_RANK_TABLE = {}
+RANK_TABLE = {}
+FLUSH_RANK_TABLE = {}
+RANK_TO_HAND = {}
+
+# Convert a hand tuple to its rank
+def hand_to_rank(hand):
+  rank = HAND_ORDER_DICT[hand[0]]
+  values = hand[1:]
+  for i in xrange(5):
+    rank = rank * RANK_BASE + (values[i] + 4 if i < len(values) else 0)
+  RANK_TO_HAND[rank] = hand
+  return rank
+
+def rank_to_hand(rank):
+  return RANK_TO_HAND[rank]
+
+# Return the rank of the hand made by the given cards, matching compute_hand
+def hand_rank(cards):
+  num_cards = len(cards)
+  try:
+    key = FILL_PRIME_PRODUCTS[num_cards]
+    for card in cards:
+      key *= CARD_PRIME_TABLE[card]
+  except KeyError:
+    # Cards outside the deck are left to compute_hand
+    return hand_to_rank(compute_hand(cards))
+  if num_cards <= 3:
+    table = TOP_RANK_TABLE
+  else:
+    table = RANK_TABLE
+    if num_cards == 5:
+      suit = CARD_SUIT_TABLE[cards[0]]
+      if all(CARD_SUIT_TABLE[card] == suit for card in cards):
+        table = FLUSH_RANK_TABLE
+  try:
+    return table[key]
+  except KeyError:
+    rank = table[key] = hand_to_rank(compute_hand(cards))
+    return rank
+
+# Commonly used function to turn rows into list of ranks
+def rows_to_ranks(rows):
+  return [hand_rank(cards) for cards in rows]
+
+# Same as is_bust, but for ranks
+def ranks_are_bust(ranks):
+  return ranks[0] > ranks[1] or ranks[1] > ranks[2]
+
+# Fill the rank tables for every complete row
+def build_rank_tables():
+  for num_cards in (3, 5):
+    for values in itertools.combinations_with_replacement(xrange(MIN_VALUE, MAX_VALUE + 1), num_cards):
+      if any(values.count(value) > 4 for value in values):
+        continue
+      # Spread suits so that only the all distinct case below makes a flush
+      hand_rank([make_card(value, SUITS[i % len(SUITS)]) for i, value in enumerate(values)])
+      if num_cards == 5 and len(set(values)) == 5:
+        hand_rank([make_card(value, SUITS[0]) for value in values])
+
+'''
+ACTIONS
+'''
+
+# Returns all ways of assigning num_cards cards to rows with the given remaining capacities, as
+# tuples of row numbers. Cached per capacity vector.
+PLACEMENT_PATTERNS = {}
+def placement_patterns(remaining_capacities, num_cards):
+  key = (tuple(remaining_capacities), num_cards)
+  if key not in PLACEMENT_PATTERNS:
+    def find_assigns(i, remaining_capacities, cur_assign):
+      if i == num_cards:
+        return [cur_assign]
+      all_assigns = []
+      for j in range(NUM_ROWS):
+        if remaining_capacities[j] > 0:
+          remaining_capacities[j] -= 1
+          all_assigns += find_assigns(i+1, remaining_capacities, cur_assign + (j,))
+          remaining_capacities[j] += 1
+      return all_assigns
+    PLACEMENT_PATTERNS[key] = tuple(find_assigns(0, list(remaining_capacities), ()))
+  return PLACEMENT_PATTERNS[key]
+
+class ActionSpace(Sequence):
+  '''
+  The actions available for a draw, in the format ((card1, placement1), (card2, placement2), ...)
+  with pairs sorted. Actions are built on demand: action i plays card combination
+  i / len(patterns) with placement pattern i % len(patterns).
+  '''
+  def __init__(self, draw, remaining_capacities):
+    self.draw = tuple(draw)
+    self.remaining_capacities = tuple(remaining_capacities)
+    self.num_to_play = 5 if len(draw) == 5 else 2
+    self.card_combos = list(itertools.combinations(self.draw, self.num_to_play))
+    self.patterns = placement_patterns(remaining_capacities, self.num_to_play)
+
+  def __len__(self):
+    return len(self.card_combos) * len(self.patterns)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError("Action index out of range: {}".format(index))
+    cards = self.card_combos[index / len(self.patterns)]
+    return tuple(sorted(zip(cards, self.patterns[index % len(self.patterns)])))
+
+  def __iter__(self):
+    for cards in self.card_combos:
+      for placements in self.patterns:
+        yield tuple(sorted(zip(cards, placements)))
+
+  # Returns an action chosen uniformly at random
+  def sample(self):
+    return self[random.randrange(len(self))]
+
+  # Returns whether the action is legal, regardless of the order of its pairs
+  def is_legal(self, action):
+    if len(action) != self.num_to_play:
+      return False
+    counts = [0] * NUM_ROWS
+    for card, placement in action:
+      if card not in self.draw or placement not in (0, 1, 2):
+        return False
+      counts[placement] += 1
+    if len(set(card for card, _ in action)) != self.num_to_play:
+      return False
+    return all(count <= capacity for count, capacity in zip(counts, self.remaining_capacities))
+
+  def __contains__(self, action):
+    return self.is_legal(action)
+
 '''
 GAME OBJECT
 '''
@@ -237,15 +480,16 @@ class PineappleGame1(object):
   '''
   A game of Pineapple with only one player and opponent cards shown.
   '''
-  def __init__(self):
-    cards = [a + b for a, b in itertools.product(DECK_CARD_VALUES, 'CDHS')]
+  def __init__(self, int_cards=False):
+    cards = INT_CARDS if int_cards else STR_CARDS
+    self.int_cards = int_cards
     self.deck_size = 52
     self.cards = set(cards)
     assert len(self.cards) == self.deck_size
 
   # Randomly choose an initial 5 card draw and create start state
   def get_start_state(self, hero_first):
-    cards = copy.deepcopy(self.cards)
+    cards = set(self.cards)
     if not hero_first:
       opponent_draw = random.sample(cards, 5)
       for card in opponent_draw:
@@ -268,26 +512,7 @@ class PineappleGame1(object):
   # Returns a list of possible actions from the provided state. States are in the format:
   # ((card1, placement1), (card2, placement2))
   def actions(self, state):
-    remaining_capacities = self.get_remaining_capacities(state)
-    actions = []
-
-    def find_assigns(i, num_cards, remaining_capacities, cur_assign):
-      if i == num_cards:
-        return [cur_assign]
-      all_assigns = []
-      for j in range(NUM_ROWS):
-        if remaining_capacities[j] > 0:
-          remaining_capacities[j] -= 1
-          all_assigns += find_assigns(i+1, num_cards, remaining_capacities, cur_assign + [j])
-          remaining_capacities[j] += 1
-      return all_assigns
-
-    num_to_play = 5 if len(state.draw) == 5 else 2
-    placement_combos = find_assigns(0, num_to_play, remaining_capacities, [])
-    for cards in itertools.combinations(state.draw, num_to_play):
-      for placements in placement_combos:
-        actions += [tuple(sorted([(card, placement) for card, placement in zip(cards, placements)]))]
-    return actions
+    return ActionSpace(state.draw, self.get_remaining_capacities(state))
 
   # Returns whether the given state is terminal by checking for full rows
   def is_end(self, state):
@@ -296,45 +521,78 @@ class PineappleGame1(object):
   # Returns whether the given state has busted
   def is_bust(self, state):
     assert self.is_end(state)
-    hands = rows_to_hands(state.rows)
-    return is_bust(hands)
+    return ranks_are_bust(rows_to_ranks(state.rows))
 
   # Utility function for certain policies to simulate the placement of cards according to
   # an action
   def sim_place_cards(self, state, action):
-    state = copy.deepcopy(state)
-    for card, placement in action:
-      state.rows[placement] += [card]
+    state = state.replace()
+    self.apply(state, action)
     return state
 
+  # Places the cards of the action in the provided state, in place. The draw is emptied.
+  # Returns a token that undo uses to restore the state.
+  def apply(self, state, action):
+    token = (state.rows, state.draw)
+    rows = list(state.rows)
+    for card, placement in action:
+      rows[placement] += (card,)
+    state.rows = tuple(rows)
+    state.draw = ()
+    return token
+
+  def undo(self, state, token):
+    state.rows, state.draw = token
+
+  # Context manager that applies the action to the state for the duration of the block and undoes it
+  # on the way out, even if the block raises
+  @contextlib.contextmanager
+  def applied(self, state, action):
+    token = self.apply(state, action)
+    try:
+      yield state
+    finally:
+      self.undo(state, token)
+
+  # Deals the given draw out of the remaining cards, in place. Dead cards (e.g. the opponent's
+  # draw) are also removed from the remaining cards but not given to the player.
+  # Returns a token that undeal uses to restore the state.
+  def deal(self, state, draw, dead=()):
+    token = (state.draw, state.remaining)
+    dealt = frozenset(itertools.chain(draw, dead))
+    if not dealt <= state.remaining:
+      raise KeyError(tuple(dealt - state.remaining))
+    state.remaining = state.remaining - dealt
+    state.draw = tuple(draw)
+    return token
+
+  def undeal(self, state, token):
+    state.draw, state.remaining = token
+
   # Given the state and action, takes the action and then randomly simulates the drawing
   # of cards, returning a state.
   # Does not modify the provided state.
   # The input action does not need to be sorted.
   def get_random_outcome(self, state, action):
-    state = copy.deepcopy(state)
     action = tuple(sorted(action))
-    if action not in self.actions(state):
+    if not self.actions(state).is_legal(action):
       raise RuntimeError("Illegal Action: {}".format(action))
-    for card, placement in action:
-      state.rows[placement] += [card]
+    state = state.replace()
+    self.apply(state, action)
     if len(action) == 5 and self.deck_size - len(state.remaining) == 5:
       opponent_draw = random.sample(state.remaining, 5)
     else:
       opponent_draw = random.sample(state.remaining, 2)
-    for card in opponent_draw:
-      state.remaining.remove(card)
-    state.draw = random.sample(state.remaining, 3)
-    for card in state.draw:
-      state.remaining.remove(card)
+    self.deal(state, [], dead=opponent_draw)
+    self.deal(state, random.sample(state.remaining, 3))
     return state
 
   def is_fantasyland(self, state):
     assert self.is_end(state)
-    hands = rows_to_hands(state.rows)
-    if is_bust(hands):
+    ranks = rows_to_ranks(state.rows)
+    if ranks_are_bust(ranks):
       return False
-    hand = hands[0]
+    hand = RANK_TO_HAND[ranks[0]]
     return (hand[0] == '2' and hand[1] >= 12) or hand[0] == 3
 
   # Only call when is_end is true
@@ -347,52 +605,87 @@ class PineappleGame1(object):
 
   # Pretty print the state for display
   def print_state(self, state):
-    discarded = []
-    for card in self.cards:
-      if card not in state.remaining and\
-          not any([card in row or card in state.draw for row in state.rows]):
-        discarded += [card]
+    seen = cards_to_mask(state.remaining) | cards_to_mask(state.draw)
+    for row in state.rows:
+      seen |= cards_to_mask(row)
+    discarded = mask_to_cards(FULL_DECK_MASK & ~seen, as_str=True)
     print 'Discard:', ' '.join(sort_cards(discarded))
     for row in state.rows:
-      print '| ' + ' '.join(row)
-    print 'Draw:', ' '.join(sorted(state.draw))
+      print '| ' + ' '.join(cards_to_strs(row))
+    print 'Draw:', ' '.join(cards_to_strs(sorted(state.draw)))
 
-# rows: list of lists for top, middle, bottom rows
+class Deck(object):
+  '''
+  A fixed order of cards to deal from. Cards dealt in Pineapple do not depend on the actions taken,
+  so games dealt from equal decks give every seat the same cards.
+  '''
+  def __init__(self, cards):
+    self.cards = list(cards)
+    self.position = 0
+
+  # Returns a deck of the given cards in an order chosen by rng
+  @classmethod
+  def shuffled(cls, cards, rng=random):
+    return cls(rng.sample(sorted(cards), len(cards)))
+
+  def deal(self, num_cards):
+    cards = self.cards[self.position:self.position + num_cards]
+    if len(cards) < num_cards:
+      raise RuntimeError("Deck ran out of cards")
+    self.position += num_cards
+    return cards
+
+# rows: tuple of tuples for top, middle, bottom rows
 # draw: whatever has been drawn
-# remaining: set of remaining cards
+# remaining: frozenset of remaining cards
+# fake_remaining: frozenset of cards the player has not seen
 class PineappleGame2State(PineappleGame1State):
+  __slots__ = ('opp_rows', 'discard', 'fake_remaining')
+  FIELDS = PineappleGame1State.FIELDS + __slots__
+
   def __init__(self, rows, draw, remaining, fake_remaining):
     super(PineappleGame2State, self).__init__(rows, draw, remaining)
-    self.opp_rows = [[], [], []]
-    self.discard = []
-    self.fake_remaining = fake_remaining
+    self.opp_rows = ((), (), ())
+    self.discard = ()
+    self.fake_remaining = frozenset(fake_remaining)
+
+  # The state as seen by the player, with the unseen cards as remaining. Shares all fields with
+  # this state.
+  def fake_view(self):
+    return self.replace(remaining=self.fake_remaining)
 
 '''
 A game of Pineapple allowing two players.
 '''
 class PineappleGame2(PineappleGame1):
-  def __init__(self, name):
-    super(PineappleGame2, self).__init__()
+  # Games share a deck by having the same one set on each of them. Without a deck, cards are drawn
+  # at random.
+  def __init__(self, name, int_cards=False, deck=None):
+    super(PineappleGame2, self).__init__(int_cards)
     self.name = name
+    self.deck = deck
+
+  # Draws num_cards out of cards, from the deck if one is set
+  def draw_cards(self, cards, num_cards):
+    if self.deck is None:
+      return random.sample(cards, num_cards)
+    drawn = self.deck.deal(num_cards)
+    if not all(card in cards for card in drawn):
+      raise RuntimeError("Deck dealt cards that are not available: {}".format(drawn))
+    return drawn
 
   def get_start_state(self):
-    cards = copy.deepcopy(self.cards)
-    player_draw = random.sample(cards, 5)
+    cards = set(self.cards)
+    player_draw = self.draw_cards(cards, 5)
     for card in player_draw:
       cards.remove(card)
-    opp_draw = random.sample(cards, 5)
+    opp_draw = self.draw_cards(cards, 5)
     for card in opp_draw:
       cards.remove(card)
-    player_fake_remaining = copy.deepcopy(self.cards)
-    for card in player_draw:
-      player_fake_remaining.remove(card)
-    opp_fake_remaining = copy.deepcopy(self.cards)
-    for card in opp_draw:
-      opp_fake_remaining.remove(card)
-    player_state = PineappleGame2State(rows=[[], [], []], draw=player_draw, remaining=copy.deepcopy(cards),
-      fake_remaining=player_fake_remaining)
-    opp_state = PineappleGame2State(rows=[[], [], []], draw=opp_draw, remaining=copy.deepcopy(cards),
-      fake_remaining=opp_fake_remaining)
+    player_state = PineappleGame2State(rows=[[], [], []], draw=player_draw, remaining=cards,
+      fake_remaining=self.cards.difference(player_draw))
+    opp_state = PineappleGame2State(rows=[[], [], []], draw=opp_draw, remaining=cards,
+      fake_remaining=self.cards.difference(opp_draw))
     return player_state, opp_state
 
   # Given the state and action, takes the action and returns a state.
@@ -400,23 +693,18 @@ class PineappleGame2(PineappleGame1):
   # The input action does not need to be sorted.
   # Also updates fake remaining fields.
   def get_outcome(self, state, action, opp_state):
-    state = copy.deepcopy(state)
     action = tuple(sorted(action))
-    if action not in self.actions(state):
+    if not self.actions(state).is_legal(action):
       raise RuntimeError("Illegal Action: {}".format(action))
-    for card in state.draw:
-      if (card not in [a[0] for a in action]):
-        state.discard.append(card)
-      else:
-        opp_state.fake_remaining.remove(card)
-    for card, placement in action:
-      state.rows[placement] += [card]
+    state = state.replace()
+    played = [a[0] for a in action]
+    state.discard += tuple(card for card in state.draw if card not in played)
+    opp_state.fake_remaining = opp_state.fake_remaining.difference(played)
+    self.apply(state, action)
     opp_state.opp_rows = state.rows
-    state.draw = random.sample(state.remaining, 3)
-    for card in state.draw:
-      state.remaining.remove(card)
-      state.fake_remaining.remove(card)
-      opp_state.remaining.remove(card)
+    self.deal(state, self.draw_cards(state.remaining, 3))
+    state.fake_remaining = state.fake_remaining.difference(state.draw)
+    opp_state.remaining = opp_state.remaining.difference(state.draw)
     return state
 
   # Returns the total royalties earned by the current hand
@@ -443,12 +731,12 @@ class PineappleGame2(PineappleGame1):
       royalties = 0 if royalties is None else royalties
       opp_royalties = 0 if opp_royalties is None else opp_royalties
       return royalties - opp_royalties + comparison_utility
-    hands = rows_to_hands(state.rows)
-    opp_hands = rows_to_hands(state.opp_rows)
-    for i in range(len(hands)):
-      if (compare_hands(hands[i], opp_hands[i]) == 1):
+    ranks = rows_to_ranks(state.rows)
+    opp_ranks = rows_to_ranks(state.opp_rows)
+    for i in range(len(ranks)):
+      if ranks[i] > opp_ranks[i]:
         comparison_utility += 1
-      elif (compare_hands(hands[i], opp_hands[i]) == -1):
+      elif ranks[i] < opp_ranks[i]:
         comparison_utility -= 1
     if comparison_utility == 3:
       comparison_utility = 6
@@ -465,8 +753,8 @@ class PineappleGame2(PineappleGame1):
         missing += [card]
     print 'It is %s\'s turn!' % self.name
     for row in state.opp_rows:
-      print '| ' + ' '.join(row)
-    print 'Missing:', ' '.join(sort_cards(missing))
+      print '| ' + ' '.join(cards_to_strs(row))
+    print 'Missing:', ' '.join(cards_to_strs(sort_cards(missing)))
     for row in state.rows:
-      print '| ' + ' '.join(row)
-    print 'Draw:', ' '.join(sorted(state.draw))
\ No newline at end of file
+      print '| ' + ' '.join(cards_to_strs(row))
+    print 'Draw:', ' '.join(cards_to_strs(sorted(state.draw)))
\ No newline at end of file
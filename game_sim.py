@@ -1,8 +1,12 @@
 import argparse
-import numpy as np
+import itertools
 import json
+import multiprocessing
+import numpy as np
+import random
 
 from game import PineappleGame1, BUST_PENALTY, FANTASYLAND_BONUS, FANTASYLAND_WORTH
+import hand_optimizer
 import policies
 
 parser = argparse.ArgumentParser(description='Simulate policy on pineapple.')
@@ -30,9 +34,42 @@ parser.add_argument('--num-oracle-sims', type=int, default=3,
                     help='number of simulations for oracle_eval to run per action result')
 parser.add_argument('--oracle-outcome-weighting', type=float, default=1.0,
                     help='exponent for how outcomes are weighted for the oracle')
+parser.add_argument('--exact-streets', type=int, default=0,
+                    help='number of final streets (0/1/2) the oracle policies evaluate exactly by enumerating draws '
+                         'instead of sampling')
+parser.add_argument('--endgame', action='store_true',
+                    help='for the oracle policies, solve the last two decisions exactly with the endgame solver')
+parser.add_argument('--endgame-cache-file', type=str, default='',
+                    help='pickle file the endgame solver loads its table from and saves it to on exit')
+parser.add_argument('--common-draws', action='store_true',
+                    help='for the oracle policies, evaluate every action of a decision on the same sampled draws '
+                         'and report the variance saved')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes oracle_eval evaluates actions in (chosen actions do not depend on it)')
+parser.add_argument('--scheduler', type=str, default='halving', choices=['halving', 'race'],
+                    help='how vs_oracle_eval policies split sims between actions: successive halving, or a race that '
+                         'also drops actions once they trail the leader by --race-confidence standard errors')
+parser.add_argument('--race-confidence', type=float, default=2.,
+                    help='standard errors by which an action must trail the leader to be dropped from the race')
+parser.add_argument('--race-tolerance', type=float, default=0.,
+                    help='the race stops once no action can beat the leader by more than this many royalties')
+parser.add_argument('--race-sim-budget', type=int, default=0,
+                    help='max sims per decision for the race (0 for no limit)')
+parser.add_argument('--race-time-budget', type=float, default=0.,
+                    help='max seconds per decision for the race (0 for no limit)')
 parser.add_argument('--distinguish-draws', action='store_true',
                     help='for feature extraction, whether to consider every num_to_draw differently')
+parser.add_argument('--int-cards', action='store_true',
+                    help='represent cards as ints from 0 to 51 instead of strings')
+parser.add_argument('--cache-size', type=int, default=hand_optimizer.DEFAULT_CACHE_SIZE,
+                    help='max entries in the hand optimizer cache (0 disables caching)')
+parser.add_argument('--seed', type=int, default=None,
+                    help='master seed; every game is seeded from it and its game number, so results do not depend '
+                         'on --jobs')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of processes to shard test games across (evaluation only, needs --num-train 0)')
 args = parser.parse_args()
+hand_optimizer.set_cache_size(args.cache_size)
 
 policy_name_to_policy = {
   'human': policies.HumanPolicy,
@@ -49,7 +86,7 @@ policy_name_to_policy = {
 def prompt_bool():
   return raw_input('(Y/N)? ').upper() == 'Y'
 
-game = PineappleGame1()
+game = PineappleGame1(int_cards=args.int_cards)
 
 utilities = []
 non_bust_utilities = []
@@ -60,30 +97,56 @@ if args.policy not in policy_name_to_policy:
 policy = policy_name_to_policy[args.policy](game, args)
 if type(policy) == policies.HumanPolicy:
   args.print_util_freq = 1
-
-for game_num in range(args.num_test + args.num_train):
-  # No exploration during testing
+if args.jobs > 1:
+  if args.num_train > 0 or type(policy) == policies.HumanPolicy:
+    raise RuntimeError('--jobs only supports evaluation of non human policies (--num-train 0)')
+  if args.workers > 1:
+    raise RuntimeError('--jobs and --workers cannot be combined')
+  if args.seed is None:
+    args.seed = random.randrange(2 ** 31)
+    print "Seed: {}".format(args.seed)
+
+# Plays one game and returns (utility, whether the final board earns fantasyland)
+def play_game(game_num):
+  # No exploration during testing. Every game sets this, since shards may never see game num_train.
   if game_num == args.num_train:
     print "Training ended. Now testing:"
+  if game_num >= args.num_train:
     policy.train = False
-    
-  try:
-    state = game.get_start_state(hero_first=args.hero_first)
-
-    while not game.is_end(state):
-      if args.verbose:
-        game.print_state(state)
-      action = policy.get_action(state)
-      if args.verbose:
-        print "Action:", action
-      new_state = game.get_random_outcome(state, action)
-      if isinstance(policy, policies.RLPolicy):
-        policy.incorporate_feedback(state, action, new_state)
-      state = new_state
-
-    utility = game.utility(state)
+  if args.seed is not None:
+    random.seed(args.seed * 1000003 + game_num)
+
+  state = game.get_start_state(hero_first=args.hero_first)
+  while not game.is_end(state):
+    if args.verbose:
+      game.print_state(state)
+    action = policy.get_action(state)
+    if args.verbose:
+      print "Action:", action
+    new_state = game.get_random_outcome(state, action)
+    if isinstance(policy, policies.RLPolicy):
+      policy.incorporate_feedback(state, action, new_state)
+    state = new_state
+
+  if args.verbose or type(policy) == policies.HumanPolicy:
+    print "Final board:"
+    game.print_state(state)
+  return game.utility(state), game.is_fantasyland(state)
+
+game_nums = xrange(args.num_test + args.num_train)
+if args.jobs > 1:
+  # Shards stream back per game results in game order
+  pool = multiprocessing.Pool(args.jobs)
+  results = pool.imap(play_game, game_nums)
+else:
+  results = itertools.imap(play_game, game_nums)
+
+game_num = -1
+drained = False
+try:
+  for game_num, (utility, is_fantasyland) in enumerate(results):
     utilities += [utility]
-    if game.is_fantasyland(state):
+    if is_fantasyland:
       fantasylands += 1
       utility -= FANTASYLAND_BONUS # For calculation below
     if game_num >= args.num_train:
@@ -93,10 +156,6 @@ for game_num in range(args.num_test + args.num_train):
       else:
         non_bust_utilities += [utility]
 
-    if args.verbose or type(policy) == policies.HumanPolicy:
-      print "Final board:"
-      game.print_state(state)
-
     if args.print_util_freq != -1:
       if (game_num + 1) % args.print_util_freq == 0:
         start_game = game_num - args.print_util_freq + 1
@@ -107,23 +166,29 @@ for game_num in range(args.num_test + args.num_train):
 
     if type(policy) == policies.HumanPolicy:
       print "\n"
-  # keyboard interrupt breaks early
-  except KeyboardInterrupt as e:
-    game_num -= 1
-    break
+  drained = True
+# keyboard interrupt breaks early
+except KeyboardInterrupt as e:
+  pass
+finally:
+  # Let the workers exit after a full run, kill them if it was cut short
+  if args.jobs > 1:
+    if drained:
+      pool.close()
+    else:
+      pool.terminate()
+    pool.join()
+policy.close()
+game_num += 1
 
 if isinstance(policy, policies.RLPolicy):
-  try:
-    with open('weights.json', 'w') as fp:
-      json.dump(policy.weights, fp, sort_keys=True, indent=2, separators=(',', ': '))
-  except Exception:
-    pass
+  with open('weights.json', 'w') as fp:
+    json.dump(policy.labeled_weights(), fp, sort_keys=True, indent=2, separators=(',', ': '))
 
 utilities = np.array(utilities)
 non_bust_utilities = np.array(non_bust_utilities)
 np.save('utilities', utilities)
 utilities = utilities[args.num_train:]
-game_num += 1
 num_test_played = game_num - args.num_train
 
 fl = float(fantasylands) / num_test_played
@@ -141,4 +206,13 @@ print "\n"
 print "Average utility: {} +/- {}".format(np.mean(utilities), np.std(utilities) / np.sqrt(num_test_played))
 print "Royalties per hand: {} +/- {}".format(rph, rph_std)
 print "Bust %: {} / {} = {}".format(busts, game_num, float(busts) / (num_test_played))
-print "Fantasyland %: {} / {} = {}".format(fantasylands, game_num, float(fantasylands) / (num_test_played))
\ No newline at end of file
+print "Fantasyland %: {} / {} = {}".format(fantasylands, game_num, float(fantasylands) / (num_test_played))
+# Shards keep their own caches and reports
+if args.jobs <= 1:
+  print hand_optimizer.format_cache_stats()
+  if policy.variance_report is not None:
+    print policy.variance_report.format()
+  if getattr(policy, 'race', None) is not None:
+    print policy.race.format()
+  if isinstance(policy, policies.QLearningPolicy) and policy.row_cache.hits + policy.row_cache.misses > 0:
+    print policy.format_row_cache_stats()
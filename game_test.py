@@ -133,6 +133,67 @@ def partial_ranking_test():
 
 partial_ranking_test()
 
+'''
+CARD ENCODING
+'''
+
+def card_encoding_test():
+  assert card_to_int('2C') == 0
+  assert card_to_int('AS') == 51
+  assert card_to_str(13) == '5D'
+  assert card_value(51) == card_value('AS') == 14
+  assert card_suit(13) == card_suit('5D') == 'D'
+  assert make_int_card(5, 'D') == 13
+  for card in STR_CARDS:
+    assert card_to_str(card_to_int(card)) == card
+  cards = ['AH', '2C', 'TD', '7S']
+  mask = cards_to_mask(cards)
+  assert mask == cards_to_mask(cards_to_ints(cards))
+  assert mask_to_cards(mask, as_str=True) == ['2C', '7S', 'TD', 'AH']
+  assert mask_to_cards(mask) == sorted(cards_to_ints(cards))
+  assert mask_to_cards(FULL_DECK_MASK) == INT_CARDS
+
+  # Hands are identical for both representations
+  for cards in [['AD', 'KD', 'QD', 'TD', 'JD'], ['2H', '3H', '5H', 'AH', '4C'], ['5C', '5S', '5H', 'AH'],
+                ['2H', 'AD', 'AH'], ['TD']]:
+    assert compute_hand(cards) == compute_hand(cards_to_ints(cards))
+
+  print "Card encoding test passed!"
+
+card_encoding_test()
+
+'''
+HAND RANKS
+'''
+
+def hand_rank_test():
+  build_rank_tables()
+  rng = random.Random(0)
+  def random_rows(num_cards, num_rows):
+    return [rng.sample(STR_CARDS, num_cards) for _ in xrange(num_rows)]
+
+  # Ranks order rows of the same length exactly like compare_hands
+  for num_cards in xrange(6):
+    rows = random_rows(num_cards, 300)
+    for row1, row2 in zip(rows, rows[1:]):
+      assert cmp(hand_rank(row1), hand_rank(row2)) == compare_hands(compute_hand(row1), compute_hand(row2))
+      assert hand_rank(row1) == hand_rank(cards_to_ints(row1))
+  tops = [[make_card(value, SUITS[i]) for i, value in enumerate(values)]
+          for values in itertools.combinations_with_replacement(xrange(MIN_VALUE, MAX_VALUE + 1), 3)]
+  for top1, top2 in itertools.product(tops, tops[::7]):
+    assert cmp(hand_rank(top1), hand_rank(top2)) == compare_hands(compute_hand(top1), compute_hand(top2))
+
+  # Top row compared to middle row keeps the bust semantics of compare_hands
+  for top, mid in itertools.product(tops + random_rows(2, 20), random_rows(5, 100) + random_rows(4, 20)):
+    assert (hand_rank(top) > hand_rank(mid)) == (compare_hands(compute_hand(top), compute_hand(mid)) > 0)
+  for hand in [royal_flush, straight_flush, quad, full_house, flush, wheel, two_pair, pair_A_top, triple_5_top]:
+    assert rank_to_hand(hand_to_rank(hand)) == hand
+  assert ranks_are_bust(rows_to_ranks([['5H', '5D', '5C'], ['2H', '2D', 'AH', '6H', '7C'], ['AD', 'KD', 'QD', 'TD', 'JD']]))
+
+  print "Hand rank test passed!"
+
+hand_rank_test()
+
 '''
 GAME LOGIC
 '''
@@ -140,16 +201,18 @@ GAME LOGIC
 game = PineappleGame1()
 
 def start_state_test():
-  # Remove card from copy of initial state
+  # Remove card from clone of initial state
   start_state = game.get_start_state(hero_first=True)
   assert len(start_state.remaining) == 47
   assert len(start_state.draw) == 5
   removal_cards = ['2C', '3C', '4C', '5C']
   for remove_card in removal_cards:
     if remove_card not in start_state.draw:
-      start_state.remaining.remove(remove_card)
+      clone = start_state.replace(remaining=start_state.remaining - set([remove_card]))
       break
   assert remove_card in game.cards
+  assert remove_card in start_state.remaining and remove_card not in clone.remaining
+  assert clone.rows is start_state.rows
 
   start_state = game.get_start_state(hero_first=False)
   assert len(start_state.remaining) == 42
@@ -200,6 +263,19 @@ def actions_test():
   num_opening = 2 * 2 * 10 + 10 * 2 ** 3 + 5 * 2 ** 4 + 2 ** 5
   assert len(game.actions(start_state)) == num_opening
 
+  # Indexing, iteration and legality agree
+  actions = game.actions(state)
+  assert [actions[i] for i in xrange(len(actions))] == list(actions)
+  assert actions[-1] == list(actions)[-1]
+  assert all(actions.is_legal(action) and action in actions for action in actions)
+  assert actions.is_legal(tuple(reversed(actions[3])))
+  assert actions.sample() in a
+  assert not actions.is_legal((('6H', 1), ('7H', 1)))
+  assert not actions.is_legal((('6H', 0), ('6H', 2)))
+  assert not actions.is_legal((('6H', 0), ('KH', 2)))
+  assert not actions.is_legal((('6H', 0),))
+  assert not actions.is_legal((('6H', 0), ('7H', 2), ('AC', 2)))
+
   print 'Actions test passed!'
 
 def game_royalties_test():
@@ -228,9 +304,50 @@ def game_royalties_test():
   print "Game royalties test passed!"
 
 
+def int_cards_game_test():
+  int_game = PineappleGame1(int_cards=True)
+  state = int_game.get_start_state(hero_first=False)
+  assert all(type(card) == int for card in state.draw)
+  while not int_game.is_end(state):
+    action = random.choice(int_game.actions(state))
+    state = int_game.get_random_outcome(state, action)
+  str_rows = [cards_to_strs(row) for row in state.rows]
+  assert int_game.utility(state) == game.utility(PineappleGame1State(str_rows, None, set()))
+
+  print "Int cards game test passed!"
+
+def apply_undo_test():
+  state = game.get_start_state(hero_first=False)
+  rows, draw, remaining = state.rows, state.draw, state.remaining
+  for action in game.actions(state)[::17]:
+    token = game.apply(state, action)
+    assert game.num_cards_played(state) == 5
+    assert state.rows == game.sim_place_cards(PineappleGame1State(rows, draw, remaining), action).rows
+    new_cards = sorted(remaining)[:5]
+    deal_token = game.deal(state, new_cards[:3], dead=new_cards[3:])
+    assert state.draw == tuple(new_cards[:3])
+    assert len(state.remaining) == len(remaining) - 5
+    game.undeal(state, deal_token)
+    game.undo(state, token)
+    assert state.rows is rows and state.draw is draw and state.remaining is remaining
+
+  # applied undoes the action even if the block raises
+  action = game.actions(state)[0]
+  try:
+    with game.applied(state, action):
+      assert game.num_cards_played(state) == 5
+      raise KeyError(action)
+  except KeyError:
+    pass
+  assert state.rows is rows and state.draw is draw
+
+  print 'Apply/undo test passed!'
+
 start_state_test()
+apply_undo_test()
 actions_test()
 game_royalties_test()
+int_cards_game_test()
 
 '''
 PineappleGame2 tests
@@ -238,6 +355,46 @@ PineappleGame2 tests
 
 game = PineappleGame2('player')
 
+def state_clone_test():
+  import pickle
+  player_state, opp_state = game.get_start_state()
+  view = player_state.fake_view()
+  assert view.remaining is player_state.fake_remaining
+  assert view.rows is player_state.rows and view.fake_remaining is player_state.fake_remaining
+  assert player_state.remaining is not player_state.fake_remaining
+  action = game.actions(view)[0]
+  new_state = game.get_outcome(player_state, action, opp_state)
+  assert opp_state.opp_rows is new_state.rows
+  assert game.num_cards_played(player_state) == 0 and game.num_cards_played(new_state) == 5
+  assert len(new_state.discard) == 0 and len(new_state.draw) == 3
+  assert not any(card in opp_state.remaining for card in new_state.draw)
+  clone = pickle.loads(pickle.dumps(new_state))
+  assert all(getattr(clone, name) == getattr(new_state, name) for name in PineappleGame2State.FIELDS)
+
+  print "State clone test passed!"
+
+def deck_test():
+  deck_cards = Deck.shuffled(game.cards, random.Random(4)).cards
+  assert sorted(deck_cards) == sorted(game.cards)
+  assert Deck.shuffled(game.cards, random.Random(4)).cards == deck_cards
+
+  # Both seats get the same cards from equal decks, whatever actions are taken
+  draws = []
+  for action_index in (0, -1):
+    player_game = PineappleGame2('player', deck=Deck(deck_cards))
+    opp_game = PineappleGame2('opponent', deck=player_game.deck)
+    player_state, opp_state = player_game.get_start_state()
+    seen = [player_state.draw, opp_state.draw]
+    while not player_game.is_end(player_state):
+      player_state = player_game.get_outcome(player_state, player_game.actions(player_state)[action_index], opp_state)
+      opp_state = opp_game.get_outcome(opp_state, opp_game.actions(opp_state)[action_index], player_state)
+      seen += [player_state.draw, opp_state.draw]
+    draws += [seen]
+  assert draws[0] == draws[1]
+  assert list(itertools.chain(*draws[0]))[:len(deck_cards)] == deck_cards[:sum(len(draw) for draw in draws[0])]
+
+  print "Deck test passed!"
+
 def adv_game_utilities_test():
   state = PineappleGame2State(
       rows = [
@@ -280,4 +437,6 @@ def adv_game_utilities_test():
 
   print "Adversarial game utilities test passed!"
 
-adv_game_utilities_test()
\ No newline at end of file
+state_clone_test()
+deck_test()
+adv_game_utilities_test()
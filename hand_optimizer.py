@@ -1,16 +1,170 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import copy
+import heapq
 import itertools
+import numpy as np
 import random
 
 import game as g
+import suit_isomorphism
+
+'''
+CACHING
+'''
+
+# Bounded LRU cache with hit/miss counters. A max_entries of 0 disables caching.
+class LRUCache(object):
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    if key not in self.entries:
+      self.misses += 1
+      return None
+    self.hits += 1
+    value = self.entries.pop(key)
+    self.entries[key] = value
+    return value
+
+  def put(self, key, value):
+    if self.max_entries <= 0:
+      return
+    self.entries.pop(key, None)
+    self.entries[key] = value
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+  def resize(self, max_entries):
+    self.max_entries = max_entries
+    while len(self.entries) > max(max_entries, 0):
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+    self.hits = 0
+    self.misses = 0
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'entries': len(self.entries),
+      'max_entries': self.max_entries,
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': float(self.hits) / lookups if lookups > 0 else 0.,
+    }
+
+DEFAULT_CACHE_SIZE = 100000
+CACHE = LRUCache(DEFAULT_CACHE_SIZE)
+
+def set_cache_size(max_entries):
+  CACHE.resize(max_entries)
+
+def cache_stats():
+  return CACHE.stats()
+
+def format_cache_stats():
+  stats = cache_stats()
+  return "Hand optimizer cache: {} hits / {} misses ({:.1%} hit rate), {} / {} entries".format(
+    stats['hits'], stats['misses'], stats['hit_rate'], stats['entries'], stats['max_entries'])
+
+# Returns compute(), going through the cache under make_key() when caching is enabled
+def cached_call(make_key, compute):
+  if CACHE.max_entries <= 0:
+    return compute()
+  key = make_key()
+  result = CACHE.get(key)
+  if result is None:
+    result = compute()
+    CACHE.put(key, result)
+  return result
+
+# Runs compute(draw) through the cache for every draw, collecting values into a numpy array
+def evaluate_many(draws, make_key, compute, return_combos):
+  if isinstance(draws, np.ndarray):
+    draws = draws.tolist()
+  values = np.empty(len(draws))
+  combos = []
+  for i, draw in enumerate(draws):
+    result = cached_call(lambda: make_key(draw), lambda: compute(draw))
+    if return_combos:
+      values[i], combo = result
+      combos += [combo]
+    else:
+      values[i] = result
+  if return_combos:
+    return values, combos
+  return values
+
+def sorted_rows(rows):
+  return tuple(tuple(sorted(row)) for row in rows)
+
+def value_rows(rows):
+  return tuple(tuple(sorted(g.card_value(card) for card in row)) for row in rows)
+
+# When no flush is reachable, results only depend on card values, so lookups are keyed by the row
+# values and a 13 bucket histogram of the draw. Otherwise royalties are invariant under suit
+# relabeling, so royalty-only lookups share one entry per suit isomorphism class, while combos are
+# keyed by the exact (order-independent) cards, since the tie break between equal royalty combos
+# depends on suit letters.
+def optimize_hand_key(rows, draw, return_combo, fl_bonus, avoid_flush):
+  if suit_isomorphism.suits_irrelevant(rows, len(draw)):
+    return ('ranks', value_rows(rows), suit_isomorphism.value_histogram(draw), return_combo, fl_bonus, avoid_flush)
+  if return_combo:
+    return ('combo', sorted_rows(rows), tuple(sorted(draw)), fl_bonus, avoid_flush)
+  canonical_rows, canonical_draw, _ = suit_isomorphism.canonicalize(rows, draw)
+  return ('royalties', canonical_rows, canonical_draw, fl_bonus, avoid_flush)
+
+# opp_combos is kept in order so cached utilities are bit for bit the uncached ones
+def optimize_hand_adv_key(rows, draw, opp_combos, return_combo, fl_bonus, avoid_flush):
+  opp_combos = tuple(None if opp_combo is None else tuple(opp_combo) for opp_combo in opp_combos)
+  if suit_isomorphism.suits_irrelevant(rows, len(draw)):
+    return ('adv_ranks', value_rows(rows), suit_isomorphism.value_histogram(draw), opp_combos, return_combo,
+            fl_bonus, avoid_flush)
+  return ('adv', sorted_rows(rows), tuple(sorted(draw)), opp_combos, return_combo, fl_bonus, avoid_flush)
 
 # Returns all possible hands that can be made at the given row with existing row and future
 # draw. Returns hands sorted in decreasing order.
 def possible_hands(row, row_num, draw):
+  return possible_hands_prepared(prepare_row(row), row_num, draw)
+
+# Precomputes everything possible_hands needs to know about a row, independently of the draw
+def prepare_row(row):
   row = g.sort_cards(row, inc=False)
-  draw = g.sort_cards(draw, inc=False)
   row_mults = g.cards_to_mults(row)
+  row_values = [g.card_value(card) for card in row]
+  row_info = {
+    'cards': row,
+    'mults': row_mults,
+    'mults_dict': defaultdict(int, {y: x for x, y in row_mults}),
+    'value_set': set(row_values),
+    'present_cards': set((g.card_value(card), g.card_suit(card)) for card in row),
+    'presences': set(row_values) | (set([1]) if 14 in row_values else set()),
+    'flush_suit': None,
+  }
+
+  if len(row) >= 1:
+    suit = g.card_suit(row[0])
+    # Check monochrome
+    if all(g.card_suit(card) == suit for card in row):
+      row_info['flush_suit'] = suit
+    # Range must allow straight
+    if max(row_values) - min(row_values) <= 4 and len(set(row_values)) == len(row_values):
+      row_info['straight_starts'] = (max(max(row_values) - 4, 1), min(min(row_values), 10))
+    else:
+      row_info['straight_starts'] = (0, -1)
+  else:
+    row_info['straight_starts'] = (1, 10)
+  return row_info
+
+# possible_hands for a row prepared with prepare_row
+def possible_hands_prepared(row_info, row_num, draw):
+  row = row_info['cards']
+  draw = g.sort_cards(draw, inc=False)
+  row_mults = row_info['mults']
   draw_mults = g.cards_to_mults(draw)
 
   flushes = []
@@ -20,13 +174,12 @@ def possible_hands(row, row_num, draw):
   if row_num >= 1:
     suit_counts = defaultdict(int)
     for card in draw:
-      suit_counts[card[1]] += 1
+      suit_counts[g.card_suit(card)] += 1
 
     # Check flush possibilities
     if len(row) >= 1:
-      suit = row[0][1]
-      # Check monochrome
-      if all(card[1] == suit for card in row):
+      suit = row_info['flush_suit']
+      if suit is not None:
         if suit_counts[suit] + len(row) >= 5:
           flushes += [('Fl', suit)]
     else:
@@ -35,24 +188,21 @@ def possible_hands(row, row_num, draw):
           flushes += [('Fl', suit)]
 
     # Check straight possibilities
-    all_presences = set()
-    for card in row + draw:
+    all_presences = set(row_info['presences'])
+    present_cards = row_info['present_cards'] | set((g.card_value(card), g.card_suit(card)) for card in draw)
+    for card in draw:
       all_presences.add(g.card_value(card))
       # Add ace at 0 for wheel
       if g.card_value(card) == 14:
         all_presences.add(1)
-    if len(row) >= 1:
-      row_values = [g.card_value(card) for card in row]
-      # Range must allow straight
-      if max(row_values) - min(row_values) <= 4 and len(set(row_values)) == len(row_values):
-        min_start = max(max(row_values) - 4, 1)
-        max_start = min(min(row_values), 10)
-      else:
-        min_start = 0
-        max_start = -1
+    min_start, max_start = row_info['straight_starts']
+    # Row cards are part of the straight, so a straight flush needs a monochrome row
+    if len(row) == 0:
+      straight_flush_suits = g.SUITS
+    elif row_info['flush_suit'] is not None:
+      straight_flush_suits = [row_info['flush_suit']]
     else:
-      min_start = 1
-      max_start = 10
+      straight_flush_suits = []
     for i in xrange(min_start, max_start + 1):
       possible = True
       for j in xrange(i, i + 5):
@@ -61,11 +211,10 @@ def possible_hands(row, row_num, draw):
           break
       if possible:
         straights += [('St', i + 4)]
-        for suit in g.SUITS:
+        for suit in straight_flush_suits:
           straight_flush_possible = True
           for value in xrange(i, i+5):
-            card = g.make_card(value, suit)
-            if card not in row and card not in draw:
+            if (value, suit) not in present_cards:
               straight_flush_possible = False
               break
           if straight_flush_possible:
@@ -76,7 +225,7 @@ def possible_hands(row, row_num, draw):
 
   # Check N of a kind possibilities
   num_left = (3 if row_num == 0 else 5) - len(row)
-  row_mults_dict = defaultdict(int, {y: x for x, y in row_mults})
+  row_mults_dict = row_info['mults_dict']
   draw_mults_dict = defaultdict(int, {y: x for x, y in draw_mults})
   singles = []
   pairs = []
@@ -94,7 +243,7 @@ def possible_hands(row, row_num, draw):
       quads += [('4', value)]
 
   # Eliminate useless single hands
-  all_values = sorted(list(set([g.card_value(card) for card in row] + [g.card_value(card) for card in draw])))
+  all_values = sorted(list(row_info['value_set'] | set([g.card_value(card) for card in draw])))
   if len(all_values) < g.ROW_LENGTHS[row_num]:
     min_single = 15
   else:
@@ -106,7 +255,6 @@ def possible_hands(row, row_num, draw):
   # Determine full house / two pair
   two_pairs = []
   full_houses = []
-  present_cards = [x[1] for x in row_mults]
   if row_num >= 1:
     # Full house logic
     for _, value in triples:
@@ -154,7 +302,9 @@ def total_royalties(hands, fl_bonus=True):
     total += g.royalties(hand, row_num, fl_bonus)
   return total
 
-# Returns whether or not the specified combo can be made from rows and draw. Possible input hands:
+# Reference implementation of is_makeable that searches every completion and filler assignment.
+# Kept to check is_makeable against. Note it indexes the precom defaultdicts, so it needs a fresh
+# precom per call. Possible input hands:
 # ('RoFl', High)
 # ('StFl', High)
 # ('Fl', Suit)
@@ -166,7 +316,7 @@ def total_royalties(hands, fl_bonus=True):
 # ('2', High)
 # ('1', High)
 # Also needs to perform finer grained checks to ensure final hand doesn't bust.
-def is_makeable(rows, draw, combo, precom):
+def is_makeable_reference(rows, draw, combo, precom):
   possible_completions = []
   # fillers_needed will contain the list of fillers required
   fillers_needed = [0] * len(rows)
@@ -184,10 +334,10 @@ def is_makeable(rows, draw, combo, precom):
       for needed_value in xrange(high_value - 4, high_value + 1):
         if needed_value == 1:
           needed_value == 14
-        needed_card = g.make_card(needed_value, suit)
-        if needed_card not in row:
-          assert needed_card in draw
-          completion += [needed_card]
+        if not any(g.card_suit(card) == suit for card in precom['all_row_values'][row_num][needed_value]):
+          needed_cards = [card for card in precom['draw_values'][needed_value] if g.card_suit(card) == suit]
+          assert len(needed_cards) == 1
+          completion += needed_cards
       possible_completions += [[tuple(completion)]]
     elif hand[0] == 'St':
       draw_possibilities = []
@@ -280,8 +430,11 @@ def is_makeable(rows, draw, combo, precom):
     # Try to assign filler
     possible_fillers = [[] for _ in xrange(g.NUM_ROWS)]
     for card in cards_left:
+      # filler_avoid holds values, which never matched string cards. Keep comparing against the
+      # string card so int cards behave identically.
+      card_str = g.card_to_str(card)
       for i, avoid_set in enumerate(filler_avoid):
-        if card not in avoid_set:
+        if card_str not in avoid_set:
           possible_fillers[i] += [card]
     filler_combos = [list(itertools.combinations(possible_fillers[i], fillers_needed[i]))
                      for i in xrange(g.NUM_ROWS)]
@@ -303,6 +456,199 @@ def is_makeable(rows, draw, combo, precom):
   
   return False
 
+SUITED_HANDS = ('Fl', 'StFl', 'RoFl')
+SUIT_MASKS = {suit: g.cards_to_mask(card for card in g.INT_CARDS if g.card_suit(card) == suit) for suit in g.SUITS}
+
+def popcount(mask):
+  return bin(mask).count('1')
+
+def row_value_count(precom, row_num, value):
+  return len(precom['all_row_values'][row_num].get(value, ()))
+
+def draw_cards_of_value(precom, value):
+  return precom['draw_values'].get(value, [])
+
+# Returns the number of filler cards the given hand needs at row_num on top of its own cards
+def fillers_needed(row, row_num, hand, precom):
+  if hand[0] == '4':
+    return 1 - (len(row) - row_value_count(precom, row_num, hand[1]))
+  elif hand[0] == '2+2':
+    return 1 - (len(row) - row_value_count(precom, row_num, hand[1]) - row_value_count(precom, row_num, hand[2]))
+  elif hand[0] == '3':
+    return 2 - (len(row) - row_value_count(precom, row_num, hand[1])) if row_num >= 1 else 0
+  elif hand[0] == '2':
+    return (3 if row_num >= 1 else 1) - (len(row) - row_value_count(precom, row_num, hand[1]))
+  elif hand[0] == '1':
+    return (4 if row_num >= 1 else 2) - (len(row) - row_value_count(precom, row_num, hand[1]))
+  return 0
+
+# Returns a dictionary mapping values to the number of cards of that value the hand takes from the
+# draw, or None for hands that need specific suits
+def value_demand(row_num, hand, precom):
+  demand = defaultdict(int)
+  if hand[0] == 'St':
+    for needed_value in xrange(hand[1] - 4, hand[1] + 1):
+      if needed_value == 1:
+        needed_value = 14
+      if row_value_count(precom, row_num, needed_value) == 0:
+        demand[needed_value] += 1
+  elif hand[0] == '4':
+    demand[hand[1]] += len(draw_cards_of_value(precom, hand[1]))
+  elif hand[0] in ('3+2', '2+2'):
+    demand[hand[1]] += (3 if hand[0] == '3+2' else 2) - row_value_count(precom, row_num, hand[1])
+    demand[hand[2]] += 2 - row_value_count(precom, row_num, hand[2])
+  elif hand[0] in ('3', '2', '1'):
+    demand[hand[1]] += int(hand[0]) - row_value_count(precom, row_num, hand[1])
+  else:
+    return None
+  return demand
+
+# Returns the possible sets of draw cards (as masks) that complete the hand at row_num, not counting
+# filler
+def completion_masks(row, row_num, hand, precom):
+  if hand[0] == 'StFl' or hand[0] == 'RoFl':
+    _, high_value, suit = hand
+    if any(g.card_suit(card) != suit for card in row):
+      return []
+    mask = 0
+    for needed_value in xrange(high_value - 4, high_value + 1):
+      if not any(g.card_suit(card) == suit for card in precom['all_row_values'][row_num].get(needed_value, ())):
+        needed_cards = [card for card in draw_cards_of_value(precom, needed_value) if g.card_suit(card) == suit]
+        if len(needed_cards) != 1:
+          return []
+        mask |= g.cards_to_mask(needed_cards)
+    return [mask]
+  elif hand[0] == 'Fl':
+    num_left = g.ROW_LENGTHS[row_num] - len(row)
+    return [g.cards_to_mask(cards) for cards in
+            itertools.combinations(precom['draw_suits'].get(hand[1], []), num_left)]
+  demand = value_demand(row_num, hand, precom)
+  if any(count < 0 for count in demand.itervalues()):
+    return []
+  per_value = [[g.cards_to_mask(cards) for cards in itertools.combinations(draw_cards_of_value(precom, value), count)]
+               for value, count in demand.iteritems()]
+  return list(set(sum(masks) for masks in itertools.product(*per_value)))
+
+# Used when suits can be ignored: every hand only needs cards of given values, so any cards of the
+# right value are interchangeable and makeability reduces to counting.
+def is_makeable_by_counts(rows, draw, combo, precom):
+  total_demand = defaultdict(int)
+  total_fillers = 0
+  for row_num, (row, hand) in enumerate(zip(rows, combo)):
+    for value, count in value_demand(row_num, hand, precom).iteritems():
+      if count < 0:
+        return False
+      total_demand[value] += count
+    total_fillers += fillers_needed(row, row_num, hand, precom)
+  for value, count in total_demand.iteritems():
+    if count > len(draw_cards_of_value(precom, value)):
+      return False
+  return len(draw) - sum(total_demand.itervalues()) >= total_fillers
+
+# Checks that fillers can be assigned from the cards in left_mask. filler_groups is a list of
+# (count, eligible mask) demands, which can be met by disjoint cards iff every subset of demands
+# has at least as many eligible cards as it needs (Hall's theorem).
+def fillers_assignable(left_mask, filler_groups):
+  filler_groups = [(count, mask & left_mask) for count, mask in filler_groups if count > 0]
+  for subset in xrange(1, 1 << len(filler_groups)):
+    needed = 0
+    eligible = 0
+    for i, (count, mask) in enumerate(filler_groups):
+      if subset & (1 << i):
+        needed += count
+        eligible |= mask
+    if popcount(eligible) < needed:
+      return False
+  return True
+
+# Returns the filler demands for rows given their chosen completions. If avoid_flush is set, a five
+# card row whose own cards are all one suit must take at least one filler of another suit so that it
+# does not accidentally become a flush.
+def filler_groups(row_masks, completions, needed, avoid_flush):
+  groups = []
+  for row_num, (row_mask, completion, count) in enumerate(zip(row_masks, completions, needed)):
+    if count <= 0:
+      continue
+    made = row_mask | completion
+    flush_suit = None
+    if avoid_flush and g.ROW_LENGTHS[row_num] == 5 and made != 0:
+      flush_suit = next((suit for suit in g.SUITS if made & ~SUIT_MASKS[suit] == 0), None)
+    if flush_suit is None:
+      groups += [(count, g.FULL_DECK_MASK)]
+    else:
+      groups += [(1, g.FULL_DECK_MASK & ~SUIT_MASKS[flush_suit]), (count - 1, g.FULL_DECK_MASK)]
+  return groups
+
+def is_makeable_by_masks(rows, draw, combo, precom, avoid_flush):
+  draw_mask = g.cards_to_mask(draw)
+  row_masks = [g.cards_to_mask(row) for row in rows]
+  needed = [fillers_needed(row, row_num, hand, precom) for row_num, (row, hand) in enumerate(zip(rows, combo))]
+  options = [completion_masks(row, row_num, hand, precom) for row_num, (row, hand) in enumerate(zip(rows, combo))]
+
+  # Propagate rows with a single completion: their cards are unavailable to every other row
+  changed = True
+  while changed:
+    changed = False
+    forced_mask = 0
+    for row_options in options:
+      if len(row_options) == 0:
+        return False
+      if len(row_options) == 1:
+        if forced_mask & row_options[0]:
+          return False
+        forced_mask |= row_options[0]
+    for row_num, row_options in enumerate(options):
+      if len(row_options) > 1:
+        remaining_options = [mask for mask in row_options if mask & forced_mask == 0]
+        if len(remaining_options) < len(row_options):
+          options[row_num] = remaining_options
+          changed = True
+
+  # Search the remaining choices, most constrained row first
+  order = sorted(xrange(len(rows)), key=lambda row_num: len(options[row_num]))
+  completions = [0] * len(rows)
+  total_fillers = sum(needed)
+  def search(i, used_mask):
+    if i == len(order):
+      left_mask = draw_mask & ~used_mask
+      if not avoid_flush:
+        return popcount(left_mask) >= total_fillers
+      return fillers_assignable(left_mask, filler_groups(row_masks, completions, needed, avoid_flush))
+    row_num = order[i]
+    for mask in options[row_num]:
+      if mask & used_mask == 0:
+        completions[row_num] = mask
+        if search(i + 1, used_mask | mask):
+          return True
+    return False
+  return search(0, 0)
+
+# Returns whether or not the specified combo can be made from rows and draw (see
+# is_makeable_reference for the possible hands). Completions are card masks, rows with a single
+# completion are propagated to the others, and fillers are assigned as a matching. Suits are
+# ignored entirely when no hand needs them. If avoid_flush is set, fillers never turn a five card
+# row into an accidental flush.
+def is_makeable(rows, draw, combo, precom, avoid_flush=False):
+  if not avoid_flush and not any(hand[0] in SUITED_HANDS for hand in combo):
+    return is_makeable_by_counts(rows, draw, combo, precom)
+  return is_makeable_by_masks(rows, draw, combo, precom, avoid_flush)
+
+# Row-only work shared by every draw evaluated against the same rows
+def prepare_rows(rows):
+  return {
+    'rows': rows,
+    'row_infos': [prepare_row(row) for row in rows],
+    'all_row_values': [tabulate_values(row) for row in rows],
+  }
+
+# Returns the precom used by is_makeable for the given prepared rows and draw
+def draw_precom(prepared, draw):
+  return {
+    'all_row_values': prepared['all_row_values'],
+    'draw_values': tabulate_values(draw),
+    'draw_suits': tabulate_suits(draw),
+  }
+
 # Given a set of cards, constructs a dictionary mapping values to cards
 def tabulate_values(cards):
   counts = defaultdict(list)
@@ -314,35 +660,30 @@ def tabulate_values(cards):
 def tabulate_suits(cards):
   counts = defaultdict(list)
   for card in cards:
-    counts[card[1]] += [card]
+    counts[g.card_suit(card)] += [card]
   return counts
 
 # Given the current rows and a future draw, return the highest royalty value achievable from the
 # current hand.
 # If return_combo is True, it will also return the best combo (None if busted)
-def optimize_hand(rows, draw, return_combo=False, fl_bonus=True):
-  num_play = sum(g.ROW_LENGTHS) - sum(len(row) for row in rows)
-  hands_for_row = []
-  for row_num, row in enumerate(rows):
-    hands_for_row += [possible_hands(row, row_num, draw)]
+# If avoid_flush is True, filler cards are never allowed to make an accidental flush
+def optimize_hand(rows, draw, return_combo=False, fl_bonus=True, avoid_flush=False):
+  return cached_call(lambda: optimize_hand_key(rows, draw, return_combo, fl_bonus, avoid_flush),
+                     lambda: optimize_hand_uncached(rows, draw, return_combo, fl_bonus, avoid_flush))
 
-  possible_combos = []
-  for row1, row2, row3 in itertools.product(*hands_for_row):
-    # Skip bust hands
-    # WARNING: currently, the use of >= makes it impossible to have two rows with the same
-    # hand name (you can't have two different two pairs with the same high card on different rows)
-    if g.compare_hands(row1, row2) >= 0 or g.compare_hands(row2, row3) >= 0:
-      continue
-    possible_combos += [(row1, row2, row3)]
+def optimize_hand_uncached(rows, draw, return_combo=False, fl_bonus=True, avoid_flush=False):
+  return optimize_hand_prepared(prepare_rows(rows), draw, return_combo, fl_bonus, avoid_flush)
 
-  hands_with_royalties = sorted([(total_royalties(combo, fl_bonus), combo) for combo in possible_combos], lambda x, y: -cmp(x,y))
-  precom = {
-    'all_row_values': [tabulate_values(row) for row in rows],
-    'draw_values': tabulate_values(draw),
-    'draw_suits': tabulate_suits(draw),
-  }
-  for royalties, combo in hands_with_royalties:
-    if is_makeable(rows, draw, combo, precom):
+# optimize_hand for rows prepared with prepare_rows
+def optimize_hand_prepared(prepared, draw, return_combo=False, fl_bonus=True, avoid_flush=False):
+  rows = prepared['rows']
+  hands_for_row = []
+  for row_num, row_info in enumerate(prepared['row_infos']):
+    hands_for_row += [possible_hands_prepared(row_info, row_num, draw)]
+
+  precom = draw_precom(prepared, draw)
+  for royalties, combo in combos_by_royalties(hands_for_row, fl_bonus):
+    if is_makeable(rows, draw, combo, precom, avoid_flush):
       if return_combo:
         return royalties, combo
       return royalties
@@ -352,6 +693,72 @@ def optimize_hand(rows, draw, return_combo=False, fl_bonus=True):
     return g.BUST_PENALTY, None
   return g.BUST_PENALTY
 
+# Evaluates optimize_hand for the same rows against every draw in draws (a list of draws or a 2-D
+# array of int cards), doing the row-only work once. Returns a numpy array of values, and the list
+# of combos as well if return_combos is True.
+def optimize_hand_many(rows, draws, return_combos=False, fl_bonus=True, avoid_flush=False):
+  prepared = prepare_rows(rows)
+  compute = lambda draw: optimize_hand_prepared(prepared, draw, return_combos, fl_bonus, avoid_flush)
+  make_key = lambda draw: optimize_hand_key(rows, draw, return_combos, fl_bonus, avoid_flush)
+  return evaluate_many(draws, make_key, compute, return_combos)
+
+# Lazily yields the non bust (royalties, combo) pairs from the product of hands_for_row in
+# decreasing order, with ties broken by decreasing combo. Rows are sorted by royalties and the
+# product is explored best-first with a heap, so only the combos down to the first makeable one are
+# ever generated.
+def combos_by_royalties(hands_for_row, fl_bonus=True):
+  if any(len(hands) == 0 for hands in hands_for_row):
+    return
+  sorted_rows = []
+  for row_num, hands in enumerate(hands_for_row):
+    hand_royalties = [(g.royalties(hand, row_num, fl_bonus), hand) for hand in hands]
+    hand_royalties.sort(key=lambda x: x[0], reverse=True)
+    sorted_rows += [hand_royalties]
+  rows1, rows2, rows3 = sorted_rows
+
+  def entry(i, j, k):
+    # Summed in row order so totals match total_royalties exactly
+    royalties = 0
+    royalties += rows1[i][0]
+    royalties += rows2[j][0]
+    royalties += rows3[k][0]
+    return (-royalties, i, j, k)
+
+  # Every index triple is pushed exactly once: i advances from anywhere, j only while i == 0 and k
+  # only while i == j == 0
+  heap = [entry(0, 0, 0)]
+  while heap:
+    group_royalties = -heap[0][0]
+    group = []
+    while heap and -heap[0][0] == group_royalties:
+      _, i, j, k = heapq.heappop(heap)
+      if i + 1 < len(rows1):
+        heapq.heappush(heap, entry(i + 1, j, k))
+      if i == 0 and j + 1 < len(rows2):
+        heapq.heappush(heap, entry(i, j + 1, k))
+      if i == 0 and j == 0 and k + 1 < len(rows3):
+        heapq.heappush(heap, entry(i, j, k + 1))
+      row1, row2, row3 = rows1[i][1], rows2[j][1], rows3[k][1]
+      # Skip bust hands
+      # WARNING: currently, the use of >= makes it impossible to have two rows with the same
+      # hand name (you can't have two different two pairs with the same high card on different rows)
+      if g.compare_hands(row1, row2) >= 0 or g.compare_hands(row2, row3) >= 0:
+        continue
+      group += [(row1, row2, row3)]
+    group.sort(reverse=True)
+    for combo in group:
+      yield group_royalties, combo
+
+# Evaluates optimize_hand on every possible draw of draw_size cards from remaining, once per class of
+# equivalent draws (see suit_isomorphism.draw_classes). Returns numpy arrays of the values and of
+# the number of draws each value stands for, so np.average(values, weights=weights) is the exact
+# expectation.
+def optimize_hand_exact(rows, remaining, draw_size, fl_bonus=True, avoid_flush=False):
+  classes = suit_isomorphism.draw_classes(rows, remaining, draw_size)
+  values = optimize_hand_many(rows, [draw for draw, _ in classes], fl_bonus=fl_bonus, avoid_flush=avoid_flush)
+  weights = np.array([weight for _, weight in classes], dtype=float)
+  return values, weights
+
 # Converts a combo from this hand_optimizer to an actual hand
 def combo_to_hand(combo):
   combo = copy.deepcopy(combo)
@@ -379,34 +786,73 @@ Output:
   as losses (flush vs flush, for instance)
 '''
 def total_utility_adv(combo, opp_combos, fl_bonus=True):
-  total = 0
-  for row_num, hand in enumerate(combo):
-    total += g.royalties(hand, row_num, fl_bonus)
+  return total_utilities_adv([combo], opp_combos, fl_bonus)[0]
+
+# Returns a dictionary mapping each distinct item to its index, and the index of every item
+def index_items(items):
+  indices = {}
+  return indices, np.array([indices.setdefault(item, len(indices)) for item in items], dtype=int)
+
+# Vectorized total_utility_adv for a list of combos, returning a numpy array of utilities. Identical
+# opponent combos are collapsed into weights, each row keeps a win matrix between its distinct
+# candidate and opponent hands (g.compare_hands is called once per distinct pair), and the row wins,
+# scoop bonus and busted opponents for every combo are scored with one broadcast.
+def total_utilities_adv(combos, opp_combos, fl_bonus=True):
+  if len(combos) == 0:
+    return np.zeros(0)
+  royalties = 0
+  for row_num in xrange(g.NUM_ROWS):
+    hand_indices, combo_indices = index_items([combo[row_num] for combo in combos])
+    row_royalties = np.zeros(len(hand_indices))
+    for hand, i in hand_indices.iteritems():
+      row_royalties[i] = g.royalties(hand, row_num, fl_bonus)
+    # Summed in row order so totals match total_royalties exactly
+    royalties = royalties + row_royalties[combo_indices]
+  if len(opp_combos) == 0:
+    return royalties
+
+  num_busts = sum(1 for opp_combo in opp_combos if opp_combo is None)
+  opp_weights = defaultdict(int)
   for opp_combo in opp_combos:
-    if opp_combo is None:
-      total += 6. / len(opp_combos)
-      continue
-    gain = 0.
-    for hand, opp_hand in zip(combo, opp_combo):
-      if g.compare_hands(hand, opp_hand) > 0:
-        gain += 1
-      else:
-        gain -= 1
-    if gain == 3:
-      gain = 6
-    if gain == -3:
-      gain = -6
-    total += gain / len(opp_combos)
-  return total
+    if opp_combo is not None:
+      opp_weights[tuple(opp_combo)] += 1
+  opp_combo_list = opp_weights.keys()
+  weights = np.array([opp_weights[opp_combo] for opp_combo in opp_combo_list], dtype=int)
+
+  row_wins = np.zeros((len(combos), len(opp_combo_list)), dtype=int)
+  if len(opp_combo_list) > 0:
+    for row_num in xrange(g.NUM_ROWS):
+      hand_indices, combo_indices = index_items([combo[row_num] for combo in combos])
+      opp_hand_indices, opp_indices = index_items([opp_combo[row_num] for opp_combo in opp_combo_list])
+      wins = np.zeros((len(hand_indices), len(opp_hand_indices)), dtype=int)
+      for hand, i in hand_indices.iteritems():
+        for opp_hand, j in opp_hand_indices.iteritems():
+          wins[i, j] = g.compare_hands(hand, opp_hand) > 0
+      row_wins += wins[combo_indices[:, np.newaxis], opp_indices[np.newaxis, :]]
+
+  # Ties count as losses; winning or losing every row scoops for 6
+  gains = 2 * row_wins - g.NUM_ROWS
+  gains[gains == g.NUM_ROWS] = 6
+  gains[gains == -g.NUM_ROWS] = -6
+  total_gains = gains.dot(weights) + 6 * num_busts
+  return royalties + total_gains / float(len(opp_combos))
 
 # Given the current rows and a future draw, return the highest average utility achievable from the
 # current hand against the listed opponent combos (in combo format).
 # If return_combo is True, it will also return the best combo (None if busted)
-def optimize_hand_adv(rows, draw, opp_combos, return_combo=False, fl_bonus=True):
-  num_play = sum(g.ROW_LENGTHS) - sum(len(row) for row in rows)
+def optimize_hand_adv(rows, draw, opp_combos, return_combo=False, fl_bonus=True, avoid_flush=False):
+  return cached_call(lambda: optimize_hand_adv_key(rows, draw, opp_combos, return_combo, fl_bonus, avoid_flush),
+                     lambda: optimize_hand_adv_uncached(rows, draw, opp_combos, return_combo, fl_bonus, avoid_flush))
+
+def optimize_hand_adv_uncached(rows, draw, opp_combos, return_combo=False, fl_bonus=True, avoid_flush=False):
+  return optimize_hand_adv_prepared(prepare_rows(rows), draw, opp_combos, return_combo, fl_bonus, avoid_flush)
+
+# optimize_hand_adv for rows prepared with prepare_rows
+def optimize_hand_adv_prepared(prepared, draw, opp_combos, return_combo=False, fl_bonus=True, avoid_flush=False):
+  rows = prepared['rows']
   hands_for_row = []
-  for row_num, row in enumerate(rows):
-    hands_for_row += [possible_hands(row, row_num, draw)]
+  for row_num, row_info in enumerate(prepared['row_infos']):
+    hands_for_row += [possible_hands_prepared(row_info, row_num, draw)]
 
   possible_combos = []
   for row1, row2, row3 in itertools.product(*hands_for_row):
@@ -417,16 +863,12 @@ def optimize_hand_adv(rows, draw, opp_combos, return_combo=False, fl_bonus=True)
       continue
     possible_combos += [(row1, row2, row3)]
 
-  hands_with_royalties = sorted([(total_utility_adv(combo, opp_combos, fl_bonus), combo) for combo in possible_combos],
-    lambda x, y: -cmp(x,y))
+  utilities = total_utilities_adv(possible_combos, opp_combos, fl_bonus).tolist()
+  hands_with_royalties = sorted(zip(utilities, possible_combos), lambda x, y: -cmp(x,y))
 
-  precom = {
-    'all_row_values': [tabulate_values(row) for row in rows],
-    'draw_values': tabulate_values(draw),
-    'draw_suits': tabulate_suits(draw),
-  }
+  precom = draw_precom(prepared, draw)
   for royalties, combo in hands_with_royalties:
-    if is_makeable(rows, draw, combo, precom):
+    if is_makeable(rows, draw, combo, precom, avoid_flush):
       if return_combo:
         return royalties, combo
       return royalties
@@ -434,4 +876,12 @@ def optimize_hand_adv(rows, draw, opp_combos, return_combo=False, fl_bonus=True)
   # No hands were makeable, only bust is possible
   if return_combo:
     return g.BUST_PENALTY, None
-  return g.BUST_PENALTY
\ No newline at end of file
+  return g.BUST_PENALTY
+
+# optimize_hand_adv for the same rows and opponent combos against every draw in draws. See
+# optimize_hand_many.
+def optimize_hand_adv_many(rows, draws, opp_combos, return_combos=False, fl_bonus=True, avoid_flush=False):
+  prepared = prepare_rows(rows)
+  compute = lambda draw: optimize_hand_adv_prepared(prepared, draw, opp_combos, return_combos, fl_bonus, avoid_flush)
+  make_key = lambda draw: optimize_hand_adv_key(rows, draw, opp_combos, return_combos, fl_bonus, avoid_flush)
+  return evaluate_many(draws, make_key, compute, return_combos)
@@ -1,5 +1,7 @@
 from hand_optimizer import *
 
+import itertools
+import random
 import time
 
 # Testing
@@ -20,7 +22,7 @@ import time
 start = time.time()
 for _ in xrange(1000):
   #possible_hands([], 1, ['2H', '2S', 'JC', '8C', '7H', 'TH', 'JH', 'QH', 'TC', 'TD', '8S', '8H'])
-  optimize_hand([['TH', 'TC'], ['2H', '2D', '3S', '4C'], ['7S', '8S', '9S', 'TS']], ['TD', 'JC', 'QS', '2C', '3C', '4D'])
+  optimize_hand_uncached([['TH', 'TC'], ['2H', '2D', '3S', '4C'], ['7S', '8S', '9S', 'TS']], ['TD', 'JC', 'QS', '2C', '3C', '4D'])
 print "Average time for possible_hands: {}".format((time.time() - start) / 1000.)
 
 # print optimize_hand([['TH', 'TC'], ['2H', '2D', '3S', '4C'], ['8S', '9S', 'TS']], ['7S', '7D', 'TD', 'JC', 'QS', '2C', '3C', '4D'])
@@ -29,10 +31,189 @@ print "Average time for possible_hands: {}".format((time.time() - start) / 1000.
 # print optimize_hand([['TC', 'AH'], ['2H', '2D', '3S', '4C'], ['8S', '8C', 'TS', 'TD', '8D']], ['TH', 'AS', 'AC'], True)
 # print optimize_hand([['AC', 'AD', 'AS'], [], []], ['7D', '2H', '2S', 'JC', '8C', '7H', 'TH', 'JH', 'QH', 'JS', '7C', '9H', 'AH', 'KH'], True)
 
+# Int cards give the same results as string cards
+rows = [['TH', 'TC'], ['2H', '2D', '3S', '4C'], ['7S', '8S', '9S', 'TS']]
+draw = ['TD', 'JC', 'QS', '2C', '3C', '4D', '6S']
+assert optimize_hand(rows, draw, True) == optimize_hand([g.cards_to_ints(row) for row in rows], g.cards_to_ints(draw), True)
+
+# Lazy best-first enumeration returns the same result as the full product and sort
+def reference_optimize_hand(rows, draw, fl_bonus=True):
+  hands_for_row = [possible_hands(row, row_num, draw) for row_num, row in enumerate(rows)]
+  possible_combos = [combo for combo in itertools.product(*hands_for_row)
+                     if g.compare_hands(combo[0], combo[1]) < 0 and g.compare_hands(combo[1], combo[2]) < 0]
+  hands_with_royalties = sorted([(total_royalties(combo, fl_bonus), combo) for combo in possible_combos],
+    lambda x, y: -cmp(x,y))
+  precom = {
+    'all_row_values': [tabulate_values(row) for row in rows],
+    'draw_values': tabulate_values(draw),
+    'draw_suits': tabulate_suits(draw),
+  }
+  for royalties, combo in hands_with_royalties:
+    if is_makeable(rows, draw, combo, precom):
+      return royalties, combo
+  return g.BUST_PENALTY, None
+
+random.seed(11)
+for _ in xrange(300):
+  cards = random.sample(g.STR_CARDS, 13)
+  num_placed = random.randint(0, 10)
+  placed = cards[:num_placed]
+  rows = [[], [], []]
+  for card in placed:
+    open_rows = [i for i in xrange(g.NUM_ROWS) if len(rows[i]) < g.ROW_LENGTHS[i]]
+    rows[random.choice(open_rows)] += [card]
+  draw = cards[num_placed:]
+  for fl_bonus in [True, False]:
+    assert optimize_hand_uncached(rows, draw, True, fl_bonus) == reference_optimize_hand(rows, draw, fl_bonus)
+
+# is_makeable agrees with the exhaustive reference on every combo of random boards, and the
+# accidental flush guard only ever rules combos out
+def make_precom(rows, draw):
+  return {
+    'all_row_values': [tabulate_values(row) for row in rows],
+    'draw_values': tabulate_values(draw),
+    'draw_suits': tabulate_suits(draw),
+  }
+
+random.seed(5)
+for _ in xrange(100):
+  cards = random.sample(g.STR_CARDS, 17)
+  num_placed = random.choice([0, 0, 2, 5, 8, 10])
+  rows = [[], [], []]
+  for card in cards[:num_placed]:
+    open_rows = [i for i in xrange(g.NUM_ROWS) if len(rows[i]) < g.ROW_LENGTHS[i]]
+    rows[random.choice(open_rows)] += [card]
+  draw = cards[num_placed:num_placed + random.choice([3, 6, 9])]
+  hands_for_row = [possible_hands(row, row_num, draw) for row_num, row in enumerate(rows)]
+  for combo in itertools.product(*hands_for_row):
+    if g.compare_hands(combo[0], combo[1]) >= 0 or g.compare_hands(combo[1], combo[2]) >= 0:
+      continue
+    makeable = is_makeable_reference(rows, draw, combo, make_precom(rows, draw))
+    assert is_makeable(rows, draw, combo, make_precom(rows, draw)) == makeable
+    if is_makeable(rows, draw, combo, make_precom(rows, draw), avoid_flush=True) != makeable:
+      assert makeable
+
+# Filling an ace high middle row with the remaining hearts would make a flush
+rows = [['2C', '3D', '4S'], ['AH', 'KH'], ['5C', '5D', '5S', '6C', '6D']]
+combo = (('1', 4), ('1', 14), ('3+2', 5, 6))
+draw = ['QH', '9H', '7H', '2H']
+assert is_makeable(rows, draw, combo, make_precom(rows, draw))
+assert not is_makeable(rows, draw, combo, make_precom(rows, draw), avoid_flush=True)
+draw = ['QH', '9H', '7H', '3C']
+assert is_makeable(rows, draw, combo, make_precom(rows, draw), avoid_flush=True)
+
+# Batch evaluation matches evaluating every draw separately
+random.seed(13)
+rows = [['TH', 'TC'], ['2H', '2D', '3S'], ['7S', '8S', '9S']]
+remaining = [card for card in g.STR_CARDS if not any(card in row for row in rows)]
+draws = [random.sample(remaining, 6) for _ in xrange(20)]
+values = optimize_hand_many(rows, draws)
+assert isinstance(values, np.ndarray) and values.shape == (20,)
+assert list(values) == [optimize_hand_uncached(rows, draw) for draw in draws]
+values, combos = optimize_hand_many(rows, draws, return_combos=True)
+assert zip(values, combos) == [optimize_hand_uncached(rows, draw, True) for draw in draws]
+int_rows = [g.cards_to_ints(row) for row in rows]
+int_draws = np.array([g.cards_to_ints(draw) for draw in draws])
+assert list(optimize_hand_many(int_rows, int_draws)) == list(values)
+opp_combos = combos[:5]
+assert list(optimize_hand_adv_many(rows, draws, opp_combos)) == \
+  [optimize_hand_adv_uncached(rows, draw, opp_combos) for draw in draws]
+
+# Cached results match uncached ones, independent of card order and suit labels
+CACHE.clear()
+assert optimize_hand(rows, draw) == optimize_hand_uncached(rows, draw)
+assert CACHE.hits == 0 and CACHE.misses == 1
+swap = {'C': 'D', 'D': 'C', 'H': 'S', 'S': 'H'}
+swapped_rows = [[card[0] + swap[card[1]] for card in reversed(row)] for row in rows]
+swapped_draw = [card[0] + swap[card[1]] for card in reversed(draw)]
+assert optimize_hand(swapped_rows, swapped_draw) == optimize_hand_uncached(rows, draw)
+assert CACHE.hits == 1
+assert optimize_hand(rows, draw, True) == optimize_hand_uncached(rows, draw, True)
+assert optimize_hand(rows, list(reversed(draw)), True) == optimize_hand_uncached(rows, draw, True)
+opp_combos = [[('2', 3), ('2', 4), ('Fl', 'C')], None]
+assert optimize_hand_adv(rows, draw, opp_combos, True) == optimize_hand_adv_uncached(rows, draw, opp_combos, True)
+assert optimize_hand_adv(rows, draw, opp_combos, True) == optimize_hand_adv_uncached(rows, draw, opp_combos, True)
+assert CACHE.hits == 3 and CACHE.misses == 3
+
+# Without reachable flushes, draws with the same values share one entry keyed by the value histogram
+random.seed(19)
+rows = [['QH', 'QD'], ['2H', '2D', '3S', '4C'], ['7S', '8D', '9S', 'TC']]
+used = set(card for row in rows for card in row)
+assert suit_isomorphism.suits_irrelevant(rows, 3) and not suit_isomorphism.suits_irrelevant([[], [], []], 5)
+for _ in xrange(50):
+  draw = random.sample([card for card in g.STR_CARDS if card not in used], 3)
+  resuited = []
+  for card in draw:
+    options = [card[0] + suit for suit in g.SUITS if card[0] + suit not in used and card[0] + suit not in resuited]
+    resuited += [random.choice([option for option in options if option not in draw] or [card])]
+  CACHE.clear()
+  assert optimize_hand(rows, draw, True) == optimize_hand_uncached(rows, draw, True)
+  assert optimize_hand(rows, resuited, True) == optimize_hand_uncached(rows, resuited, True)
+  assert CACHE.hits == 1
+
+# Suited draws cannot make a straight flush on a row holding off-suit cards, so they share the value
+# histogram entry with the same draw of mixed suits
+rows = [['AC', 'KD'], ['9S', '9C', 'TD', 'JD'], ['2C', '3D']]
+suited = ['2H', '3H', '4H', '5H', '6H', '7C', '8D']
+mixed = ['2H', '3S', '4H', '5H', '6H', '7C', '8D']
+assert suit_isomorphism.suits_irrelevant(rows, len(suited))
+assert optimize_hand_uncached(rows, suited) == optimize_hand_uncached(rows, mixed) == 2
+for first, second in [(suited, mixed), (mixed, suited)]:
+  CACHE.clear()
+  assert optimize_hand(rows, first) == optimize_hand_uncached(rows, first)
+  assert optimize_hand(rows, second) == optimize_hand_uncached(rows, second)
+  assert CACHE.hits == 1
+# A monochrome row can still make one
+assert optimize_hand_uncached([['AC', 'KD'], ['9S', '9C', 'TD', 'JD'], ['2H', '3H']], suited) == 15
+
+# LRU eviction
+cache = LRUCache(2)
+cache.put('a', 1)
+cache.put('b', 2)
+assert cache.get('a') == 1
+cache.put('c', 3)
+assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+assert cache.stats()['entries'] == 2
+cache.resize(0)
+cache.put('d', 4)
+assert cache.get('d') is None and len(cache.entries) == 0
+
 assert total_utility_adv([('2', 11), ('St', 10), ('Fl', 'C')], [[('2', 10), ('St', 8), ('St', 10)]]) == 20
 assert total_utility_adv([('2', 11), ('St', 10), ('Fl', 'C')], [[('2', 10), ('St', 12), ('Fl', 'S')]]) == 13
 assert total_utility_adv([('2', 11), ('St', 10), ('Fl', 'C')], [None, [('2', 10), ('St', 12), ('Fl', 'S')]]) == 16.5
 
+# Vectorized utilities match scoring every combo against every opponent combo in turn
+def reference_total_utility_adv(combo, opp_combos, fl_bonus=True):
+  total = 0
+  for row_num, hand in enumerate(combo):
+    total += g.royalties(hand, row_num, fl_bonus)
+  for opp_combo in opp_combos:
+    if opp_combo is None:
+      total += 6. / len(opp_combos)
+      continue
+    gain = 0.
+    for hand, opp_hand in zip(combo, opp_combo):
+      gain += 1 if g.compare_hands(hand, opp_hand) > 0 else -1
+    gain = {3: 6., -3: -6.}.get(gain, gain)
+    total += gain / len(opp_combos)
+  return total
+
+random.seed(17)
+rows = [['TH'], ['2H', '2D', '3S'], ['7S', '8S']]
+remaining = [card for card in g.STR_CARDS if not any(card in row for row in rows)]
+draws = [random.sample(remaining, 8) for _ in xrange(20)]
+_, opp_combos = optimize_hand_many(rows, draws, return_combos=True)
+opp_combos += opp_combos[:5] + [None, None]
+opp_combos += [g.rows_to_hands([['AH', 'AD', '2C'], ['KS', 'KD', 'KC', '3D', '4H'], ['5H', '6H', '9H', 'JH', 'QH']])]
+hands_for_row = [possible_hands([], row_num, remaining[:14]) for row_num in xrange(g.NUM_ROWS)]
+combos = [combo for combo in itertools.product(*hands_for_row)
+          if g.compare_hands(combo[0], combo[1]) < 0 and g.compare_hands(combo[1], combo[2]) < 0]
+utilities = total_utilities_adv(combos, opp_combos)
+assert len(combos) > 100
+for combo, utility in zip(combos, utilities):
+  assert abs(utility - reference_total_utility_adv(combo, opp_combos)) < 1e-9
+assert total_utilities_adv(combos, []).tolist() == [total_royalties(combo) for combo in combos]
+
 # Show that optimization is different when taking into account opponent hand
 # print optimize_hand(
 #     [['7H', '2D'], ['8S', '9S', 'TH', 'JH'], ['3D', '3H', '3C', 'KS', 'KD']],
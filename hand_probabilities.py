@@ -0,0 +1,79 @@
+import itertools
+import numpy as np
+
+import game as g
+
+'''
+Hand probabilities
+
+Exact probabilities of completing a hand when num_to_draw cards are drawn without replacement from a
+deck of deck_size cards, for the quantities the feature extractors use:
+  - at least num_needed of the num_available cards of some value (N of a kind) or suit (flush)
+  - at least one card of every needed value, given how many of each are left (straight)
+
+Both functions return a grid indexed by [num_to_draw, deck_size], for up to MAX_DRAW cards drawn from
+decks of up to g.NUM_CARDS cards, and memoize it on their arguments. Grid cells where the deck cannot
+hold the available cards or where more cards are drawn than the deck holds are 0.
+'''
+
+MAX_DRAW = 17
+GRID_SHAPE = (MAX_DRAW + 1, g.NUM_CARDS + 1)
+
+# BINOMIAL[n, k] is n choose k, exact in float64 for n up to 52
+BINOMIAL = np.zeros((g.NUM_CARDS + 1, g.NUM_CARDS + 1))
+for n in xrange(g.NUM_CARDS + 1):
+  BINOMIAL[n, 0] = 1.
+  for k in xrange(1, n + 1):
+    BINOMIAL[n, k] = BINOMIAL[n - 1, k - 1] + BINOMIAL[n - 1, k]
+
+# num_to_draw and deck_size coordinates of the grid
+DRAWS = np.arange(GRID_SHAPE[0])[:, np.newaxis]
+DECK_SIZES = np.arange(GRID_SHAPE[1])[np.newaxis, :]
+
+# n choose k elementwise, 0 outside 0 <= k <= n
+def binomial(n, k):
+  n, k = np.broadcast_arrays(n, k)
+  valid = (k >= 0) & (k <= n)
+  return np.where(valid, BINOMIAL[np.clip(n, 0, g.NUM_CARDS), np.clip(k, 0, g.NUM_CARDS)], 0.)
+
+# Divides the grid of favorable draw counts by the number of draws, on cells where the deck holds at
+# least num_cards cards
+def normalize(favorable, num_cards):
+  valid = (DECK_SIZES >= num_cards) & (DRAWS <= DECK_SIZES)
+  total = np.where(valid, binomial(DECK_SIZES, DRAWS), 1.)
+  return np.where(valid, np.clip(favorable / total, 0., 1.), 0.)
+
+AT_LEAST = {}
+def at_least_probabilities(num_needed, num_available):
+  key = (num_needed, num_available)
+  if key not in AT_LEAST:
+    # Hypergeometric tail: j of the available cards and num_to_draw - j of the others
+    favorable = np.zeros(GRID_SHAPE)
+    for j in xrange(max(num_needed, 0), num_available + 1):
+      favorable += binomial(num_available, j) * binomial(DECK_SIZES - num_available, DRAWS - j)
+    AT_LEAST[key] = normalize(favorable, num_available)
+  return AT_LEAST[key]
+
+ALL_PRESENT = {}
+def all_present_probabilities(multiplicity):
+  multiplicity = tuple(sorted(multiplicity))
+  if multiplicity not in ALL_PRESENT:
+    # Inclusion-exclusion over the subsets of needed values that are missing from the draw
+    favorable = np.zeros(GRID_SHAPE)
+    for size in xrange(len(multiplicity) + 1):
+      for missing in itertools.combinations(multiplicity, size):
+        favorable += (-1) ** size * binomial(DECK_SIZES - sum(missing), DRAWS)
+    ALL_PRESENT[multiplicity] = normalize(favorable, sum(multiplicity))
+  return ALL_PRESENT[multiplicity]
+
+# Returns grid[num_to_draw, deck_size] as a float, or 0 if the cell is outside the grid
+def grid_value(grid, num_to_draw, deck_size):
+  if num_to_draw < 0 or num_to_draw >= GRID_SHAPE[0] or deck_size < 0 or deck_size >= GRID_SHAPE[1]:
+    return 0.
+  return grid.item(num_to_draw, deck_size)
+
+def at_least_probability(num_needed, num_available, num_to_draw, deck_size):
+  return grid_value(at_least_probabilities(num_needed, num_available), num_to_draw, deck_size)
+
+def all_present_probability(multiplicity, num_to_draw, deck_size):
+  return grid_value(all_present_probabilities(multiplicity), num_to_draw, deck_size)
@@ -0,0 +1,53 @@
+from hand_probabilities import *
+
+import itertools
+import numpy as np
+
+# Fraction of the num_to_draw card draws from deck that satisfy the predicate
+def brute_force_probability(deck, num_to_draw, satisfies):
+  draws = list(itertools.combinations(deck, num_to_draw))
+  return np.mean([satisfies(draw) for draw in draws])
+
+def at_least_test():
+  for num_available, num_needed, deck_size in [(4, 2, 9), (3, 3, 7), (5, 1, 8), (2, 0, 6), (0, 1, 5)]:
+    deck = ['x'] * num_available + ['o'] * (deck_size - num_available)
+    for num_to_draw in xrange(deck_size + 1):
+      expected = brute_force_probability(deck, num_to_draw, lambda draw: draw.count('x') >= num_needed)
+      assert abs(at_least_probability(num_needed, num_available, num_to_draw, deck_size) - expected) < 1e-12
+
+  # Hypergeometric tail of a flush draw: 2 of the 9 spades left in a 47 card deck within 2 cards
+  assert abs(at_least_probability(2, 9, 2, 47) - 36. / 1081) < 1e-12
+
+  print "At least test passed!"
+
+def all_present_test():
+  for multiplicity, deck_size in [((), 4), ((2,), 5), ((1, 3), 7), ((1, 1, 2), 8), ((0, 2), 6), ((2, 2, 1, 1, 1), 10)]:
+    deck = [value for value, count in enumerate(multiplicity) for _ in xrange(count)]
+    deck += [-1] * (deck_size - len(deck))
+    for num_to_draw in xrange(deck_size + 1):
+      expected = brute_force_probability(deck, num_to_draw,
+        lambda draw: all(value in draw for value in xrange(len(multiplicity))))
+      assert abs(all_present_probability(multiplicity, num_to_draw, deck_size) - expected) < 1e-12
+      assert all_present_probability(multiplicity[::-1], num_to_draw, deck_size) == \
+        all_present_probability(multiplicity, num_to_draw, deck_size)
+
+  print "All present test passed!"
+
+def grid_test():
+  grid = all_present_probabilities((1, 2, 3))
+  assert grid.shape == GRID_SHAPE
+  assert all_present_probabilities((3, 2, 1)) is grid
+  assert np.all((grid >= 0) & (grid <= 1))
+  # More draws never hurt
+  assert np.all(np.diff(grid[:, 20:], axis=0) >= -1e-12)
+
+  # Decks too small for the available cards, and draws larger than the deck, are 0
+  assert all_present_probability((4, 4), 8, 7) == 0
+  assert at_least_probability(1, 3, 6, 5) == 0
+  assert at_least_probability(1, 3, MAX_DRAW + 1, 40) == 0
+
+  print "Grid test passed!"
+
+at_least_test()
+all_present_test()
+grid_test()
@@ -1,8 +1,11 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import math
+import multiprocessing
 import numpy as np
 import random
+import time
 
+import endgame
 import feature_extractors
 import game as g
 import hand_optimizer
@@ -15,10 +18,163 @@ class BasePolicy(object):
   def __init__(self, game, args=None):
     self.game = game
 
+  # Set by policies that compare actions on shared draws
+  variance_report = None
+
   # Must return the optimal action as determined by the policy for the given state
   def get_action(self, state):
     raise NotImplementedError
 
+  # Releases resources held by the policy once play ends
+  def close(self):
+    pass
+
+
+class VarianceReport(object):
+  '''
+  Measures what common random numbers save: for the two best actions of each decision evaluated on
+  shared draws, the variance of their per draw value difference, against the variance of the
+  difference had each action been given its own independent draws.
+  '''
+  def __init__(self):
+    self.paired = 0.
+    self.independent = 0.
+    self.num_decisions = 0
+
+  # Records the two actions with the best mean, given the per draw values of every action
+  def add(self, values_by_action):
+    if len(values_by_action) < 2:
+      return
+    best, second = sorted(values_by_action, key=np.mean, reverse=True)[:2]
+    self.paired += np.var(np.subtract(best, second))
+    self.independent += np.var(best) + np.var(second)
+    self.num_decisions += 1
+
+  def format(self):
+    if self.num_decisions == 0:
+      return "Common draws: no sampled decisions"
+    reduction = self.independent / self.paired if self.paired > 0 else float('inf')
+    return "Common draws: paired variance {:.3f} vs {:.3f} independent ({:.1f}x reduction) over {} decisions".format(
+      self.paired / self.num_decisions, self.independent / self.num_decisions, reduction, self.num_decisions)
+
+
+'''
+Action schedulers
+
+Both schedulers split oracle sims between the actions of a decision. evaluate(action, draws) returns
+the per draw values of an action, and sample_draws(num_sims) samples draws. With common_draws, all
+actions evaluated in a round share the same draws.
+'''
+
+# Gives every surviving action num_sims more sims per round and keeps the better half each round
+def successive_halving(actions, evaluate, sample_draws, num_sims, common_draws=False, variance_report=None):
+  actions_with_histories = [(0., action) for action in actions]
+  round_num = 1.
+  while len(actions_with_histories) > 1:
+    draws = sample_draws(num_sims) if common_draws else None
+    results = [evaluate(action, draws if draws is not None else sample_draws(num_sims))
+               for _, action in actions_with_histories]
+    if variance_report is not None:
+      variance_report.add(results)
+    actions_with_histories = [(prev * (1 - 1. / round_num) + np.mean(values) / round_num, action)
+                              for values, (prev, action) in zip(results, actions_with_histories)]
+    actions_with_histories.sort()
+    actions_with_histories = actions_with_histories[len(actions_with_histories) / 2:]
+    round_num += 1
+  return actions_with_histories[0][1]
+
+class ActionRace(object):
+  '''
+  Successive halving with confidence bound elimination and early stopping. Every round gives the
+  surviving actions num_sims more sims, drops each action whose value trails the leader by more
+  than confidence standard errors, and then keeps at most the better half, so a race never spends
+  more than successive halving. With common draws the surviving actions have seen the same draws,
+  and the standard error is the one of their paired differences.
+
+  The race stops when no survivor can beat the leader by more than tolerance, or when the sim or
+  time budget for the decision runs out, and returns the action with the best mean.
+  '''
+  def __init__(self, num_sims, confidence=2., tolerance=0., sim_budget=0, time_budget=0.):
+    self.num_sims = num_sims
+    self.confidence = confidence
+    self.tolerance = tolerance
+    self.sim_budget = sim_budget
+    self.time_budget = time_budget
+    self.total_sims = 0
+    self.num_decisions = 0
+
+  # Returns the variance of each survivor's values (of its differences with the leader's values with
+  # common draws), floored at the average over survivors so that a few equal samples do not make an
+  # action look certain
+  def variances(self, history, leader, survivors, common_draws):
+    if common_draws:
+      variances = dict((action, np.var(history[leader] - history[action], ddof=1)) for action in survivors
+                       if action != leader)
+    else:
+      variances = dict((action, np.var(history[action], ddof=1)) for action in survivors)
+    floor = np.mean(variances.values())
+    return dict((action, max(variance, floor)) for action, variance in variances.iteritems())
+
+  # Returns the survivors that do not trail the leader by more than confidence standard errors, and
+  # whether the leader is separated: no survivor can beat it by more than the tolerance
+  def eliminate(self, history, survivors, common_draws):
+    means = dict((action, np.mean(history[action])) for action in survivors)
+    leader = max((means[action], action) for action in survivors)[1]
+    if len(history[leader]) < 2:
+      return survivors, False
+    variances = self.variances(history, leader, survivors, common_draws)
+    std_errors = {}
+    for action in survivors:
+      if action == leader:
+        continue
+      if common_draws:
+        std_errors[action] = math.sqrt(variances[action] / len(history[action]))
+      else:
+        std_errors[action] = math.sqrt(variances[leader] / len(history[leader]) + variances[action] / len(history[action]))
+    survivors = [action for action in survivors
+                 if action == leader or means[leader] - means[action] <= self.confidence * std_errors[action]]
+    separated = all(means[action] - means[leader] + self.confidence * std_errors[action] <= self.tolerance
+                    for action in survivors if action != leader)
+    return survivors, separated
+
+  def run(self, actions, evaluate, sample_draws, common_draws=False, variance_report=None):
+    start = time.time()
+    history = dict((action, np.zeros(0)) for action in actions)
+    survivors = list(actions)
+    num_sims_used = 0
+    while len(survivors) > 1:
+      if num_sims_used > 0:
+        if self.sim_budget > 0 and num_sims_used + len(survivors) * self.num_sims > self.sim_budget:
+          break
+        if self.time_budget > 0 and time.time() - start > self.time_budget:
+          break
+      draws = sample_draws(self.num_sims) if common_draws else None
+      results = [evaluate(action, draws if draws is not None else sample_draws(self.num_sims)) for action in survivors]
+      if variance_report is not None:
+        variance_report.add(results)
+      for action, values in zip(survivors, results):
+        history[action] = np.concatenate([history[action], values])
+        num_sims_used += len(values)
+      survivors, separated = self.eliminate(history, survivors, common_draws)
+      if separated:
+        break
+      survivors.sort(key=lambda action: (np.mean(history[action]), action))
+      survivors = survivors[len(survivors) / 2:]
+    self.total_sims += num_sims_used
+    self.num_decisions += 1
+    return max((np.mean(history[action]) if len(history[action]) else 0., action) for action in survivors)[1]
+
+  def format(self):
+    return "Race: {:.1f} sims per decision over {} decisions".format(
+      self.total_sims / float(max(self.num_decisions, 1)), self.num_decisions)
+
+# Returns the race the args ask for, or None for successive halving
+def make_race(args):
+  if args.scheduler != 'race':
+    return None
+  return ActionRace(args.num_oracle_sims, args.race_confidence, args.race_tolerance, args.race_sim_budget,
+    args.race_time_budget)
+
 
 class HumanPolicy(BasePolicy):
   '''
@@ -47,8 +203,7 @@ class RandomPolicy(BasePolicy):
   '''
 
   def get_action(self, state):
-    actions = self.game.actions(state)
-    return random.sample(actions, 1)[0]
+    return self.game.actions(state).sample()
 
 
 class BaselinePolicy(BasePolicy):
@@ -118,9 +273,9 @@ class NeverBustPolicy(BasePolicy):
   def get_action(self, state):
     actions = self.game.actions(state)
     def eval_action(action):
-      outcome = self.game.sim_place_cards(state, action)
-      hands = [g.compute_hand(row) for row in outcome.rows]
-      return g.compare_hands(hands[1], hands[0]) >= 0 and g.compare_hands(hands[2], hands[1]) >= 0
+      with self.game.applied(state, action):
+        ranks = g.rows_to_ranks(state.rows)
+      return not g.ranks_are_bust(ranks)
     evals = [(eval_action(action), action) for action in actions]
     viable = [y for x, y in evals if x == max(evals)[0]]
     return random.sample(viable, 1)[0]
@@ -151,12 +306,11 @@ class HeuristicNeverBustPolicy(BasePolicy):
         'RoFl': 50  
       }
     def eval_action(action):
-      outcome = self.game.sim_place_cards(state, action)
-      hands = [g.compute_hand(row) for row in outcome.rows]
-      total_value = sum(self.hand_values[hand[0]] for hand in hands)
-      flexibility = sum([x ** 0.3 for x in self.game.get_remaining_capacities(outcome)])
-      return (g.compare_hands(hands[1], hands[0]) >= 0 and g.compare_hands(hands[2], hands[1]) >= 0,
-              total_value, flexibility)
+      with self.game.applied(state, action):
+        ranks = g.rows_to_ranks(state.rows)
+        total_value = sum(self.hand_values[g.rank_to_hand(rank)[0]] for rank in ranks)
+        flexibility = sum([x ** 0.3 for x in self.game.get_remaining_capacities(state)])
+      return (not g.ranks_are_bust(ranks), total_value, flexibility)
     evals = [(eval_action(action), action) for action in actions]
     viable = [y for x, y in evals if x == max(evals)[0]]
     return random.sample(viable, 1)[0]
@@ -169,6 +323,10 @@ class RLPolicy(BasePolicy):
   def incorporate_feedback(self, state, action, new_state):
     raise NotImplementedError
 
+  # Returns the weights keyed by the string form of their feature keys, e.g. to save them as JSON
+  def labeled_weights(self):
+    return {str(key): weight for key, weight in self.weights.iteritems()}
+
 
 class QLearningPolicy(RLPolicy):
   '''
@@ -190,38 +348,126 @@ class QLearningPolicy(RLPolicy):
     self.exploration_prob = args.exploration_prob
     self.train = True
     self.step_size = args.step_size
-    self.weights = defaultdict(float)
-    feature_extractors.parse_probability_files()
+    # Weights are a float array over the columns of the feature registry, which grow as new features
+    # are seen
+    self.registry = feature_extractors.FeatureRegistry()
+    self.weights = np.zeros(0)
+    # Row features as (columns, values), keyed by (row_num, row cards, deck signature, num_to_draw). An
+    # action only changes one or two rows, so the actions of a decision share most of their rows, and
+    # incorporate_feedback hits on the action get_action already scored.
+    self.row_cache = hand_optimizer.LRUCache(args.cache_size)
+    # Extractors with a batched version extract the uncached rows of a decision in one pass, into blocks
+    # of registry columns per prefix
+    self.batch_extractor, self.batch_keys = feature_extractors.BATCH_EXTRACTORS.get(self.feature_extractor, (None, None))
+    self.block_columns = {}
+    self.signature_deck = None
+    self.signature = None
+    feature_extractors.load_probability_tables()
 
   def get_step_size(self):
     return self.step_size
 
+  # Returns the deck signature of the remaining cards, which only change between decisions
+  def deck_signature(self, remaining):
+    if remaining is not self.signature_deck:
+      self.signature_deck = remaining
+      self.signature = feature_extractors.deck_signature(remaining)
+    return self.signature
+
+  def labeled_weights(self):
+    return dict(zip(map(str, self.registry.keys), self.registry.pad(self.weights).tolist()))
+
+  def format_row_cache_stats(self):
+    stats = self.row_cache.stats()
+    return "Row feature cache: {} hits / {} misses ({:.1%} hit rate), {} / {} entries".format(
+      stats['hits'], stats['misses'], stats['hit_rate'], stats['entries'], stats['max_entries'])
+
+  # Returns {(row_num, cards): (columns, values)} with the features of each row, for rows that share the
+  # remaining cards and num_to_draw. Rows missing from the cache are extracted together.
+  def get_row_features(self, rows, remaining, num_to_draw):
+    signature = self.deck_signature(remaining)
+    row_features = {}
+    missing = []
+    for row_num, cards in rows:
+      features = self.row_cache.get((row_num, cards, signature, num_to_draw))
+      if features is None:
+        missing.append((row_num, cards))
+      else:
+        row_features[(row_num, cards)] = features
+    for row, features in zip(missing, self.extract_rows(missing, remaining, num_to_draw)):
+      self.row_cache.put(row + (signature, num_to_draw), features)
+      row_features[row] = features
+    return row_features
+
+  # Returns (columns, values) arrays of the features of each (row_num, cards) row, registering new features
+  def extract_rows(self, rows, remaining, num_to_draw):
+    prefixes = [(num_to_draw, row_num) if self.distinguish_draws else (row_num,) for row_num, _ in rows]
+    if self.batch_extractor is None:
+      results = []
+      for prefix, (row_num, cards) in zip(prefixes, rows):
+        features = self.feature_extractor(row_num, cards, remaining, num_to_draw)
+        columns = [self.registry.column(prefix + (k,)) for k in features]
+        results.append((np.array(columns, dtype=np.intp), np.array(features.values())))
+      return results
+    if len(rows) == 0:
+      return []
+    rank_counts, suit_counts = feature_extractors.count_cards([cards for _, cards in rows])
+    deck_rank_counts, deck_suit_counts = self.deck_signature(remaining)
+    matrix = self.batch_extractor([row_num for row_num, _ in rows], rank_counts, suit_counts,
+      deck_rank_counts, deck_suit_counts, num_to_draw)
+    for prefix in prefixes:
+      if prefix not in self.block_columns:
+        self.block_columns[prefix] = np.array([self.registry.column(prefix + (k,)) for k in self.batch_keys], dtype=np.intp)
+    return [(self.block_columns[prefix], matrix[i]) for i, prefix in enumerate(prefixes)]
+
+  # Returns (columns, values) arrays of the features of the state after each action, none of which may
+  # end the game, registering new features
+  def get_features_many(self, state, actions):
+    outcomes = []
+    for action in actions:
+      with self.game.applied(state, action):
+        num_to_draw = self.game.num_to_draw(state)
+        outcomes.append(tuple(enumerate(state.rows)))
+    unique_rows = OrderedDict.fromkeys(row for rows in outcomes for row in rows)
+    row_features = self.get_row_features(unique_rows, state.remaining, num_to_draw)
+    features = []
+    for rows in outcomes:
+      columns, values = zip(*[row_features[row] for row in rows])
+      features.append((np.concatenate(columns), np.concatenate(values)))
+    return features
+
   def get_features(self, state, action):
-    state = self.game.sim_place_cards(state, action)
-    num_to_draw = self.game.num_to_draw(state)
-    features = {}
-    for row_num, cards in enumerate(state.rows):
-      for k, v in self.feature_extractor(row_num, cards, state.remaining, num_to_draw).iteritems():
-        if self.distinguish_draws:
-          features[(num_to_draw, row_num, k)] = v
+    return self.get_features_many(state, [action])[0]
+
+  # Returns the Q values of the actions, from one product of their feature matrix with the weights
+  def get_q_values(self, state, actions):
+    q_values = np.zeros(len(actions))
+    indices = []
+    for i, action in enumerate(actions):
+      # Find exact solution if about to finish
+      with self.game.applied(state, action):
+        if self.game.is_end(state):
+          q_values[i] = self.game.utility(state)
         else:
-          features[(row_num, k)] = v
-    return features
+          indices.append(i)
+    if indices:
+      # Otherwise use linear approximation
+      features = self.get_features_many(state, [actions[i] for i in indices])
+      self.weights = self.registry.pad(self.weights)
+      matrix = np.zeros((len(features), len(self.registry)))
+      for j, (columns, values) in enumerate(features):
+        matrix[j, columns] = values
+      q_values[indices] = matrix.dot(self.weights)
+    return q_values
 
   def get_q(self, state, action):
-    # Find exact solution if about to finish
-    final_state = self.game.sim_place_cards(state, action)
-    if self.game.is_end(final_state):
-      return self.game.utility(final_state)
-    # Otherwise use linear approximation
-    features = self.get_features(state, action)
-    return sum(self.weights[key] * features[key] for key in features)
+    return self.get_q_values(state, [action])[0]
 
   def get_action(self, state):
     actions = self.game.actions(state)
     if self.train and random.random() < self.exploration_prob:
       return random.choice(actions)
-    return max((self.get_q(state, action), action) for action in actions)[1]
+    return max(zip(self.get_q_values(state, actions), actions))[1]
 
   def incorporate_feedback(self, state, action, new_state):
     if not self.train:
@@ -230,14 +476,11 @@ class QLearningPolicy(RLPolicy):
       return
     else:
       prediction = self.get_q(state, action)
-      V_opt = max(self.get_q(new_state, a) for a in self.game.actions(new_state))
-    features = self.get_features(state, action)
+      V_opt = self.get_q_values(new_state, self.game.actions(new_state)).max()
+    columns, values = self.get_features(state, action)
     deviation = prediction - V_opt
-    total_update = 0
-    for (name, value) in features.iteritems():
-      self.weights[name] -= self.get_step_size() * deviation * value
-      total_update += abs(self.get_step_size() * deviation * value)
-    # print "Total update:", total_update, "Deviation:", deviation, "len(features):", len(features) #,
+    self.weights = self.registry.pad(self.weights)
+    self.weights[columns] -= self.get_step_size() * deviation * np.asarray(values)
 
 
 class QLearningPolicy2(QLearningPolicy):
@@ -248,11 +491,46 @@ class QLearningPolicy2(QLearningPolicy):
   def __init__(self, game, args):
     super(QLearningPolicy2, self).__init__(game, args)
     self.feature_extractor = self.feature_extractor(self.game)
-    self.weights = self.feature_extractor.default_weights()
+    self.weights = self.registry.vector(self.feature_extractor.default_weights())
 
   def get_features(self, state, action):
-    return self.feature_extractor.extract(state, action)
+    features = self.feature_extractor.extract(state, action)
+    return [self.registry.column(key) for key in features], features.values()
+
+  def get_features_many(self, state, actions):
+    return [self.get_features(state, action) for action in actions]
+
+
+'''
+Oracle evaluation tasks
+
+OracleEvalPolicy evaluates the outcome of each action in a task that can run in a worker process.
+Tasks hold the outcome rows and the remaining cards as card masks, and an RNG seed derived from a
+per decision seed and the action index, so results do not depend on which process runs a task.
+'''
 
+# Returns (value, sampled values) for the outcome rows, where value is the alpha weighted average of
+# the oracle royalties over the draws, and sampled values is None when the draws were enumerated
+def oracle_outcome_value(rows, remaining, num_to_draw, exact, num_sims, alpha, rng):
+  if exact:
+    values, weights = hand_optimizer.optimize_hand_exact(rows, remaining, num_to_draw)
+    sampled_values = None
+  else:
+    draws = [rng.sample(remaining, num_to_draw) for _ in xrange(num_sims)]
+    values = sampled_values = hand_optimizer.optimize_hand_many(rows, draws)
+    weights = None
+  return (np.average(np.sign(values) * np.abs(values) ** alpha, weights=weights)) ** (1. / alpha), sampled_values
+
+def evaluate_oracle_task(task):
+  row_masks, remaining_mask, num_to_draw, exact, num_sims, alpha, seed, int_cards = task
+  rows = [g.mask_to_cards(mask, as_str=not int_cards) for mask in row_masks]
+  remaining = g.mask_to_cards(remaining_mask, as_str=not int_cards)
+  return oracle_outcome_value(rows, remaining, num_to_draw, exact, num_sims, alpha, random.Random(seed))
+
+# Warms up a worker process: sizes its hand optimizer cache and fills the rank tables
+def init_oracle_worker(cache_size):
+  hand_optimizer.set_cache_size(cache_size)
+  g.build_rank_tables()
 
 class OracleEvalPolicy(BasePolicy):
   '''
@@ -263,24 +541,58 @@ class OracleEvalPolicy(BasePolicy):
     super(OracleEvalPolicy, self).__init__(game, args)
     self.num_sims = args.num_oracle_sims
     self.alpha = args.oracle_outcome_weighting
+    self.exact_streets = args.exact_streets
+    self.endgame = endgame.get_solver(args.endgame_cache_file) if args.endgame else None
+    self.common_draws = args.common_draws
+    if self.common_draws:
+      self.variance_report = VarianceReport()
+    self.workers = args.workers
+    self.pool = None
+    if self.workers > 1:
+      self.pool = multiprocessing.Pool(self.workers, initializer=init_oracle_worker, initargs=(args.cache_size,))
+
+  def map_tasks(self, tasks):
+    if self.pool is None:
+      return map(evaluate_oracle_task, tasks)
+    return self.pool.map(evaluate_oracle_task, tasks, chunksize=max(1, len(tasks) / (4 * self.workers)))
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
+      self.pool = None
 
   def get_action(self, state):
     actions = self.game.actions(state)
-    def eval_action(action):
-      outcome = self.game.sim_place_cards(state, action)
-      values = []
-      if self.game.num_to_draw(outcome) == 0:
-        return self.game.utility(outcome)
-      num_to_draw_map = {12: 8, 9: 6, 6: 5, 3: 3}
-      # num_to_draw = int(math.ceil(self.game.num_to_draw(outcome) * 0.7))
-      num_to_draw = num_to_draw_map[self.game.num_to_draw(outcome)]
-      num_sims = self.num_sims
-      for _ in xrange(self.num_sims):
-        draw = random.sample(outcome.remaining, num_to_draw)
-        values += [hand_optimizer.optimize_hand(outcome.rows, draw)]
-      values = np.array(values)
-      return (np.mean(np.sign(values) * np.abs(values) ** self.alpha)) ** (1. / self.alpha)
-    eval_actions = [(eval_action(action), action) for action in actions]
+    num_to_draw_map = {12: 8, 9: 6, 6: 5, 3: 3}
+    # Every action leaves the same remaining cards, so with common draws every task gets the same
+    # seed and samples the same draws
+    decision_seed = random.getrandbits(32)
+    remaining_mask = g.cards_to_mask(state.remaining)
+    values = [None] * len(actions)
+    tasks = []
+    task_indices = []
+    for i, action in enumerate(actions):
+      with self.game.applied(state, action):
+        num_to_draw = self.game.num_to_draw(state)
+        if num_to_draw == 0:
+          values[i] = self.game.utility(state)
+        elif self.endgame is not None and num_to_draw <= 3:
+          values[i] = self.endgame.chance_value(state.rows, state.remaining)
+        else:
+          seed = decision_seed if self.common_draws else decision_seed * len(actions) + i
+          tasks += [(tuple(g.cards_to_mask(row) for row in state.rows), remaining_mask, num_to_draw_map[num_to_draw],
+                     num_to_draw <= 3 * self.exact_streets, self.num_sims, self.alpha, seed, self.game.int_cards)]
+          task_indices += [i]
+
+    sampled_values = []
+    for i, (value, sampled) in zip(task_indices, self.map_tasks(tasks)):
+      values[i] = value
+      if sampled is not None:
+        sampled_values += [sampled]
+    if self.variance_report is not None and len(sampled_values) == len(actions):
+      self.variance_report.add(sampled_values)
+    eval_actions = zip(values, actions)
     # print "Estimated value: {}".format(max(eval_actions)[0])
     return max(eval_actions)[1]
 
@@ -292,30 +604,39 @@ class VarSimOracleEvalPolicy(BasePolicy):
   def __init__(self, game, args):
     super(VarSimOracleEvalPolicy, self).__init__(game, args)
     self.num_sims = args.num_oracle_sims
+    self.exact_streets = args.exact_streets
+    self.endgame = endgame.get_solver(args.endgame_cache_file) if args.endgame else None
+    self.common_draws = args.common_draws
+    if self.common_draws:
+      self.variance_report = VarianceReport()
+    self.race = make_race(args)
 
   def get_action(self, state):
     actions = self.game.actions(state)
-    outcomes = [(self.game.sim_place_cards(state, action), action) for action in actions]
     num_to_draw_map = {12: 8, 9: 6, 6: 5, 3: 3, 0: 0}
 
-    def interpolate_action(prev, outcome, num_sims, round_num):
-      values = []
-      num_to_draw = num_to_draw_map[self.game.num_to_draw(outcome)]
-      for _ in xrange(num_sims):
-        draw = random.sample(outcome.remaining, num_to_draw)
-        values += [hand_optimizer.optimize_hand(outcome.rows, draw)]
-      values = np.array(values)
-      return prev * (1 - 1. / round_num) + np.mean(values) / round_num
-
-    outcomes_with_histories = [(0., outcome, action) for outcome, action in outcomes]
-    round_num = 1.
-    while len(outcomes_with_histories) > 1:
-      outcomes_with_histories = [(interpolate_action(prev, outcome, self.num_sims, round_num), outcome, action)
-                                  for prev, outcome, action in outcomes_with_histories]
-      outcomes_with_histories.sort()
-      outcomes_with_histories = outcomes_with_histories[len(outcomes_with_histories) / 2:]
-      round_num += 1
-    return outcomes_with_histories[0][2]
+    # Close enough to the end, evaluate every action exactly once instead of sampling in rounds
+    with self.game.applied(state, actions[0]):
+      num_to_draw = self.game.num_to_draw(state)
+    if self.endgame is not None and num_to_draw <= 3:
+      return self.endgame.best_action(self.game, state)
+    if self.exact_streets > 0 and num_to_draw <= 3 * self.exact_streets:
+      def exact_value(action):
+        with self.game.applied(state, action):
+          values, weights = hand_optimizer.optimize_hand_exact(state.rows, state.remaining, num_to_draw_map[num_to_draw])
+        return np.average(values, weights=weights)
+      return max((exact_value(action), action) for action in actions)[1]
+
+    def sample_draws(num_sims):
+      return [random.sample(state.remaining, num_to_draw_map[num_to_draw]) for _ in xrange(num_sims)]
+
+    def evaluate(action, draws):
+      with self.game.applied(state, action):
+        return hand_optimizer.optimize_hand_many(state.rows, draws)
+
+    if self.race is not None:
+      return self.race.run(actions, evaluate, sample_draws, self.common_draws, self.variance_report)
+    return successive_halving(actions, evaluate, sample_draws, self.num_sims, self.common_draws, self.variance_report)
 
 
 class TDLearningPolicy(RLPolicy):
@@ -338,7 +659,7 @@ class TDLearningPolicy(RLPolicy):
     self.train = True
     self.step_size = args.step_size
     self.weights = defaultdict(float)
-    feature_extractors.parse_probability_files()
+    feature_extractors.load_probability_tables()
 
   def get_step_size(self):
     return self.step_size
@@ -367,11 +688,15 @@ class AdvVarSimOracleEvalPolicy(BasePolicy):
     super(AdvVarSimOracleEvalPolicy, self).__init__(game, args)
     self.num_sims = args.num_oracle_sims
     self.num_opp_sims = args.num_opp_sims
+    self.common_draws = args.common_draws
+    if self.common_draws:
+      self.variance_report = VarianceReport()
+    self.race = make_race(args)
 
   def get_action(self, state):
     actions = self.game.actions(state)
-    outcomes = [(self.game.sim_place_cards(state, action), action) for action in actions]
-    num_to_draw = self.game.num_to_draw(outcomes[0][0])
+    with self.game.applied(state, actions[0]):
+      num_to_draw = self.game.num_to_draw(state)
     table = {0: 17, 5: 12, 7: 9, 9: 6, 11: 3, 13: 0}
     opp_num_to_draw = table[sum(len(x) for x in state.opp_rows)]
     opp_rows = state.opp_rows
@@ -383,35 +708,25 @@ class AdvVarSimOracleEvalPolicy(BasePolicy):
       opp_combos = []
       if opp_num_to_draw > 0:
         num_to_draw_sim = opp_num_to_draw_map[opp_num_to_draw]
-        for _ in xrange(self.num_opp_sims):
-          # state.remaining and outcome.remaining for any outcome should be equal
-          draw = random.sample(state.remaining, num_to_draw_sim)
-          # Assume opponent just plays to maximize their royalties
-          value, combo = hand_optimizer.optimize_hand(opp_rows, draw, return_combo=True)
-          opp_combos += [combo]
+        # state.remaining and outcome.remaining for any outcome should be equal
+        draws = [random.sample(state.remaining, num_to_draw_sim) for _ in xrange(self.num_opp_sims)]
+        # Assume opponent just plays to maximize their royalties
+        _, opp_combos = hand_optimizer.optimize_hand_many(opp_rows, draws, return_combos=True)
       else:
         opp_combos = [[g.compute_hand(cards) for cards in opp_rows]]
-      value_fn = lambda rows, draw: hand_optimizer.optimize_hand_adv(rows, draw, opp_combos)
+      values_fn = lambda rows, draws: hand_optimizer.optimize_hand_adv_many(rows, draws, opp_combos)
     else:
-      value_fn = lambda rows, draw: hand_optimizer.optimize_hand(rows, draw)
+      values_fn = lambda rows, draws: hand_optimizer.optimize_hand_many(rows, draws)
 
     num_to_draw_map = {12: 8, 9: 6, 6: 5, 3: 3, 0: 0}
 
-    def interpolate_action(prev, outcome, num_sims, round_num):
-      values = []
-      num_to_draw_sim = num_to_draw_map[num_to_draw]
-      for _ in xrange(num_sims):
-        draw = random.sample(outcome.remaining, num_to_draw_sim)
-        values += [value_fn(outcome.rows, draw)]
-      values = np.array(values)
-      return prev * (1 - 1. / round_num) + np.mean(values) / round_num
-
-    outcomes_with_histories = [(0., outcome, action) for outcome, action in outcomes]
-    round_num = 1.
-    while len(outcomes_with_histories) > 1:
-      outcomes_with_histories = [(interpolate_action(prev, outcome, self.num_sims, round_num), outcome, action)
-                                  for prev, outcome, action in outcomes_with_histories]
-      outcomes_with_histories.sort()
-      outcomes_with_histories = outcomes_with_histories[len(outcomes_with_histories) / 2:]
-      round_num += 1
-    return outcomes_with_histories[0][2]
+    def sample_draws(num_sims):
+      return [random.sample(state.remaining, num_to_draw_map[num_to_draw]) for _ in xrange(num_sims)]
+
+    def evaluate(action, draws):
+      with self.game.applied(state, action):
+        return values_fn(state.rows, draws)
+
+    if self.race is not None:
+      return self.race.run(actions, evaluate, sample_draws, self.common_draws, self.variance_report)
+    return successive_halving(actions, evaluate, sample_draws, self.num_sims, self.common_draws, self.variance_report)
@@ -0,0 +1,152 @@
+from collections import defaultdict
+import itertools
+
+import game as g
+
+'''
+Suit isomorphism
+
+Boards that only differ by a relabeling of suits play identically. canonicalize relabels the suits
+of (rows, draw) so that all isomorphic inputs map to the same canonical form, and returns the suit
+map that was applied so that actions and combos can be mapped back.
+
+Suits are ordered by their profile: for every group of cards (each row, the draw, and optionally
+dead or remaining cards), the sorted values of the cards of that suit. Two suits with the same
+profile can be swapped without changing the board, so ties do not affect the canonical form.
+'''
+
+# Returns the card with its suit replaced by suit_map[suit], keeping the card representation
+def relabel_card(card, suit_map):
+  suit = g.card_suit(card)
+  if isinstance(card, int):
+    return card - g.SUITS.index(suit) + g.SUITS.index(suit_map[suit])
+  return card[0] + suit_map[suit]
+
+def relabel_cards(cards, suit_map):
+  return [relabel_card(card, suit_map) for card in cards]
+
+def invert_suit_map(suit_map):
+  return {v: k for k, v in suit_map.iteritems()}
+
+# Returns the suit map (original suit -> canonical suit) for the given groups of cards
+def canonical_suit_map(groups):
+  profiles = dict((suit, []) for suit in g.SUITS)
+  for cards in groups:
+    values = dict((suit, []) for suit in g.SUITS)
+    for card in cards:
+      values[g.card_suit(card)].append(g.card_value(card))
+    for suit in g.SUITS:
+      profiles[suit].append(tuple(sorted(values[suit], reverse=True)))
+  ordered = sorted(g.SUITS, key=lambda suit: profiles[suit], reverse=True)
+  return {suit: g.SUITS[i] for i, suit in enumerate(ordered)}
+
+# Returns (rows, draw, suit_map) where rows and draw are the canonical relabeling of the inputs.
+# Rows are tuples of cards sorted by (value, suit) and the draw is sorted the same way, so the
+# output is also independent of card order. Dead cards, if given, break ties between suits but are
+# not returned.
+def canonicalize(rows, draw, dead=()):
+  suit_map = canonical_suit_map(list(rows) + [draw, dead])
+  canonical_rows = tuple(sort_key_tuple(relabel_cards(row, suit_map)) for row in rows)
+  return canonical_rows, sort_key_tuple(relabel_cards(draw, suit_map)), suit_map
+
+# Returns (state, suit_map) where state is the canonical relabeling of the provided state, with
+# remaining cards included in the suit profiles
+def canonicalize_state(state):
+  draw = state.draw if state.draw is not None else ()
+  rows, canonical_draw, suit_map = canonicalize(state.rows, draw, state.remaining)
+  canonical_state = state.replace(rows=rows, draw=canonical_draw if state.draw is not None else None,
+    remaining=frozenset(relabel_cards(state.remaining, suit_map)))
+  return canonical_state, suit_map
+
+def sort_key_tuple(cards):
+  return tuple(sorted(cards, key=lambda card: (g.card_value(card), g.card_suit(card))))
+
+# Maps an action on canonical cards back to the original cards
+def uncanonicalize_action(action, suit_map):
+  inverse = invert_suit_map(suit_map)
+  return tuple(sorted((relabel_card(card, inverse), placement) for card, placement in action))
+
+# Maps a hand_optimizer combo on canonical cards back to the original suits. Only flush type hands
+# carry a suit.
+def uncanonicalize_combo(combo, suit_map):
+  if combo is None:
+    return None
+  inverse = invert_suit_map(suit_map)
+  def uncanonicalize_hand(hand):
+    if hand[0] in ('Fl', 'StFl', 'RoFl') and hand[-1] in inverse:
+      return hand[:-1] + (inverse[hand[-1]],)
+    return hand
+  return tuple(uncanonicalize_hand(hand) for hand in combo)
+
+'''
+Draw classes
+
+For a fixed board, suits only matter through flushes, which need a five card row whose cards so far
+all share a suit. Remaining cards whose suit cannot make a flush are interchangeable with other
+cards of the same value, so the possible draws collapse into classes of (value, live suit or None)
+multisets.
+'''
+
+# Returns the suits that can still make a flush on the rows once draw_size more cards are seen
+def live_suits(rows, draw_size):
+  suits = set()
+  for row_num, row in enumerate(rows):
+    if g.ROW_LENGTHS[row_num] < 5 or len(row) == g.ROW_LENGTHS[row_num]:
+      continue
+    if len(row) + draw_size < 5:
+      continue
+    row_suits = set(g.card_suit(card) for card in row)
+    if len(row_suits) == 0:
+      suits.update(g.SUITS)
+    elif len(row_suits) == 1:
+      suits.update(row_suits)
+  return suits
+
+# Checks if suits cannot affect optimize_hand on the rows with a draw of draw_size cards: no row
+# can still make a flush, and no completed row already is one (its suit would show up in combos)
+def suits_irrelevant(rows, draw_size):
+  if live_suits(rows, draw_size):
+    return False
+  for row in rows:
+    if len(row) == 5 and len(set(g.card_suit(card) for card in row)) == 1:
+      return False
+  return True
+
+# Returns the number of cards of each value from 2 to ace
+def value_histogram(cards):
+  histogram = [0] * len(g.DECK_CARD_VALUES)
+  for card in cards:
+    histogram[g.card_value(card) - g.MIN_VALUE] += 1
+  return tuple(histogram)
+
+def n_choose_k(n, k):
+  result = 1
+  for i in xrange(k):
+    result = result * (n - i) / (i + 1)
+  return result
+
+# Returns a list of (draw, weight) pairs covering every draw of draw_size cards from remaining, with
+# one representative draw per class and weight the number of draws in that class. Suits are live if
+# a flush can still be made with the next num_seen cards, by default the draw itself.
+def draw_classes(rows, remaining, draw_size, num_seen=None):
+  live = live_suits(rows, draw_size if num_seen is None else num_seen)
+  cards_by_key = defaultdict(list)
+  for card in remaining:
+    suit = g.card_suit(card)
+    cards_by_key[(g.card_value(card), suit if suit in live else None)] += [card]
+  keys = sorted(cards_by_key)
+  for key in keys:
+    cards_by_key[key].sort()
+
+  classes = []
+  def add_classes(i, size_left, draw, weight):
+    if size_left == 0:
+      classes.append((draw, weight))
+      return
+    if i == len(keys):
+      return
+    cards = cards_by_key[keys[i]]
+    for count in xrange(min(len(cards), size_left), -1, -1):
+      add_classes(i + 1, size_left - count, draw + cards[:count], weight * n_choose_k(len(cards), count))
+  add_classes(0, draw_size, [], 1)
+  return classes
@@ -0,0 +1,96 @@
+from suit_isomorphism import *
+
+import itertools
+import numpy as np
+import random
+
+import game as g
+from hand_optimizer import optimize_hand, optimize_hand_exact
+
+'''
+CANONICALIZATION
+'''
+
+def permute_suits(cards, suits):
+  suit_map = dict(zip(g.SUITS, suits))
+  return relabel_cards(cards, suit_map)
+
+def invariance_test():
+  random.seed(7)
+  for _ in xrange(200):
+    cards = random.sample(g.STR_CARDS, 11)
+    rows = [cards[0:2], cards[2:5], cards[5:8]]
+    draw = cards[8:11]
+    canonical = canonicalize(rows, draw)
+    for suits in itertools.permutations(g.SUITS):
+      permuted_rows = [permute_suits(row, suits) for row in rows]
+      permuted_draw = permute_suits(draw, suits)
+      random.shuffle(permuted_draw)
+      assert canonicalize(permuted_rows, permuted_draw)[:2] == canonical[:2]
+
+  # Int cards canonicalize to the same board as str cards
+  rows = [['AH', 'AD'], ['2C', '3C', '4S'], []]
+  draw = ['KH', 'QD', '9S']
+  str_rows, str_draw, _ = canonicalize(rows, draw)
+  int_rows, int_draw, _ = canonicalize([g.cards_to_ints(row) for row in rows], g.cards_to_ints(draw))
+  assert [list(g.cards_to_strs(row)) for row in int_rows] == [list(row) for row in str_rows]
+  assert list(g.cards_to_strs(int_draw)) == list(str_draw)
+
+  print "Invariance test passed!"
+
+def class_count_test():
+  # Known number of 3 card hands up to suit isomorphism
+  classes = set(canonicalize([], draw)[1] for draw in itertools.combinations(g.INT_CARDS, 3))
+  assert len(classes) == 1755
+
+  print "Class count test passed!"
+
+def state_test():
+  game = g.PineappleGame1()
+  random.seed(3)
+  state = game.get_start_state(hero_first=True)
+  canonical_state, suit_map = canonicalize_state(state)
+  assert len(canonical_state.remaining) == len(state.remaining)
+  assert sorted(canonical_state.remaining) == sorted(relabel_cards(state.remaining, suit_map))
+  assert sorted(uncanonicalize_action(((card, 0) for card in canonical_state.draw), suit_map)) == \
+    sorted((card, 0) for card in state.draw)
+
+  print "State test passed!"
+
+def uncanonicalize_test():
+  rows = [['TH', 'TC'], ['2H', '2D', '3S', '4C'], ['7S', '8S', '9S', 'TS']]
+  draw = ['TD', 'JC', 'QS', '2C', '3C', '4D']
+  canonical_rows, canonical_draw, suit_map = canonicalize(rows, draw)
+  royalties, combo = optimize_hand(canonical_rows, canonical_draw, return_combo=True)
+  assert (royalties, uncanonicalize_combo(combo, suit_map)) == optimize_hand(rows, draw, return_combo=True)
+  combo = uncanonicalize_combo(combo, suit_map)
+  assert combo[2][-1] == 'S'
+  assert uncanonicalize_combo(None, suit_map) is None
+
+  print "Uncanonicalize test passed!"
+
+def draw_classes_test():
+  rows = [['AH', 'AD'], ['2C', '3C', '4C', '9C'], ['7S', '7D', 'KH', 'KS']]
+  used = set(card for row in rows for card in row)
+  remaining = [card for card in g.STR_CARDS if card not in used][:24]
+  assert live_suits(rows, 3) == set(['C'])
+  assert live_suits(rows, 0) == set()
+  assert live_suits([[], [], []], 5) == set(g.SUITS)
+
+  classes = draw_classes(rows, remaining, 3)
+  assert sum(weight for _, weight in classes) == n_choose_k(len(remaining), 3)
+  assert len(classes) < n_choose_k(len(remaining), 3) / 4
+  assert all(len(draw) == 3 and set(draw) <= set(remaining) for draw, _ in classes)
+
+  # The exact expectation over classes is the average over every possible draw
+  values, weights = optimize_hand_exact(rows, remaining, 3)
+  all_values = [optimize_hand(rows, list(draw)) for draw in itertools.combinations(remaining, 3)]
+  assert abs(np.average(values, weights=weights) - np.mean(all_values)) < 1e-9
+
+  print "Draw classes test passed!"
+
+invariance_test()
+class_count_test()
+state_test()
+uncanonicalize_test()
+draw_classes_test()